@@ -0,0 +1,122 @@
+# -*- coding: UTF-8 -*-
+"""
+   Copyright 2017 Esri
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+
+   you may not use this file except in compliance with the License.
+
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+
+   distributed under the License is distributed on an "AS IS" BASIS,
+
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+
+   See the License for the specific language governing permissions and
+
+   limitations under the License.​
+
+    This benchmarks the matching of source and destination features in copy_project.py (indexes of GlobalIDs and
+    userIds) against the original nested loops, using randomly generated assignments and workers, at growing sizes.
+    The nested loops are only run for a sample of the source features at the larger sizes, and their time is
+    extrapolated. No requests are made
+"""
+import argparse
+import random
+import time
+import uuid
+import arcgis
+import copy_project
+
+
+def generate_features(count, field, copied=0.5):
+    """
+    Generates random source features and the destination features that half (by default) of them were copied to
+    :param count: (int) The number of source features
+    :param field: (string) The field the features are matched by (GlobalID or userId)
+    :param copied: (float) The fraction of the source features that are in the destination
+    :return: (tuple<list<Feature>>) The source and destination features
+    """
+    values = ["{{{}}}".format(str(uuid.UUID(int=random.getrandbits(128), version=4)).upper()) for _ in range(count)]
+    source = [arcgis.features.Feature(attributes={"OBJECTID": i + 1, field: value}) for i, value in enumerate(values)]
+    destination = [arcgis.features.Feature(attributes={"OBJECTID": i + 1, field: value})
+                   for i, value in enumerate(random.sample(values, int(count * copied)))]
+    return source, destination
+
+
+def match_nested(source_features, destination_features, field):
+    """
+    The original matching of copy_project.py: every destination feature is searched for each source feature
+    :param source_features: (list<Feature>) The source features
+    :param destination_features: (list<Feature>) The destination features
+    :param field: (string) The field the features are matched by
+    :return: (tuple<list<Feature>>) The features to add and the features to update
+    """
+    features_to_add = []
+    features_to_update = []
+    for source_feature in source_features:
+        to_add_flag = True
+        for f in destination_features:
+            if source_feature.attributes[field] == f.attributes[field]:
+                source_feature.attributes["OBJECTID"] = f.attributes["OBJECTID"]
+                features_to_update.append(source_feature)
+                to_add_flag = False
+                break
+        if to_add_flag:
+            features_to_add.append(source_feature)
+    return features_to_add, features_to_update
+
+
+def benchmark(count, field, sample_size):
+    """
+    Times both matchings for one size
+    :param count: (int) The number of source features
+    :param field: (string) The field the features are matched by
+    :param sample_size: (int) The maximum number of source features to run the nested loops for
+    :return: (tuple) The seconds of the nested loops (extrapolated) and the index, and the number of mismatches
+    """
+    source, destination = generate_features(count, field)
+    sample = source[:sample_size]
+    start_time = time.time()
+    expected_add, expected_update = match_nested(sample, destination, field)
+    nested_seconds = (time.time() - start_time) * len(source) / max(len(sample), 1)
+    # The OBJECTIDs of the source features were changed by the nested loops
+    for i, feature in enumerate(source):
+        feature.attributes["OBJECTID"] = i + 1
+    start_time = time.time()
+    features_to_add, features_to_update = copy_project.match_features(
+        source, copy_project.index_features(destination, field), field)
+    index_seconds = time.time() - start_time
+    sample_ids = set(id(feature) for feature in sample)
+    mismatches = len(set(id(f) for f in expected_add) ^ set(id(f) for f in features_to_add if id(f) in sample_ids))
+    return nested_seconds, index_seconds, mismatches
+
+
+def main(args):
+    random.seed(args.seed)
+    for field, total in [("GlobalID", args.assignments), ("userId", args.workers)]:
+        count = max(total // 100, 1)
+        while True:
+            nested_seconds, index_seconds, mismatches = benchmark(count, field, args.sample)
+            print("{} x {}: nested loops {:.3f} seconds{}, index {:.3f} seconds ({:.0f}x faster), {} mismatches".format(
+                count, count // 2, nested_seconds, " (extrapolated)" if count > args.sample else "", index_seconds,
+                nested_seconds / max(index_seconds, 1e-9), mismatches))
+            if count >= total:
+                break
+            count = min(count * 10, total)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Benchmark the matching of source and destination features of copy_project")
+    parser.add_argument('-assignments', dest='assignments', type=int, default=100000,
+                        help="The number of source assignments (matched by GlobalID)")
+    parser.add_argument('-workers', dest='workers', type=int, default=1000,
+                        help="The number of source workers (matched by userId)")
+    parser.add_argument('-sample', dest='sample', type=int, default=1000,
+                        help="The maximum number of source features to run the nested loops for")
+    parser.add_argument('-seed', dest='seed', type=int, default=0, help="The seed for the random values")
+    main(parser.parse_args())
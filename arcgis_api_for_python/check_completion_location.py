@@ -23,14 +23,16 @@
     This sample copies assignments from one project to another feature service if the assignments were not completed properly
 """
 import argparse
-import datetime
 import json
 import logging
 import logging.handlers
-import math
+import time
 import traceback
 import sys
 import arcgis
+import featurewriter
+import fieldmapper
+import trackhelpers
 
 
 def initialize_logging(log_file):
@@ -108,12 +110,16 @@ def validate_config(target_fl, field_mappings):
     return True
 
 
-def get_completed_assignments(assignment_fl, worker_fl, workers):
+def get_completed_assignments(assignment_fl, worker_fl, workers, state_file=None, project_id=None, settings=None):
     """
-    Gets the assignments that have been completed by one of the specified workers
+    Gets the assignments that have been completed by one of the specified workers. If a state file is provided, only
+    the assignments that were completed or edited since they were last checked are returned
     :param assignment_fl: (string) The FS layer that has the assignments
     :param worker_fl: (string) The FS layer that has the workers
     :param workers: (List<string) The list of worker usernames
+    :param state_file: (string) The SQLite database that stores the results of earlier runs
+    :param project_id: (string) The id of the project
+    :param settings: (string) The settings of the check (see trackhelpers.get_settings)
     :return: (List<Feature>) The list of assignments
     """
     # Get the workers ids
@@ -128,11 +134,74 @@ def get_completed_assignments(assignment_fl, worker_fl, workers):
         return
     logging.getLogger().info("Querying source features...")
     assignment_query = "workerId in ({}) AND completedDate is not NULL".format(",".join(["'{}'".format(w) for w in worker_ids]))
+    # The workers are queried together, so use the oldest watermarks of the workers (if they all have one)
+    watermarks = [trackhelpers.get_watermarks(state_file, project_id, worker, settings) for worker in workers]
+    if watermarks and all(None not in watermark for watermark in watermarks):
+        watermark_query = trackhelpers.get_watermark_query(min(w[0] for w in watermarks), min(w[1] for w in watermarks))
+        assignment_query = "{} AND {}".format(assignment_query, watermark_query)
     completed_assignments = assignment_fl.query(assignment_query).features
-    return completed_assignments
+    # Skip the assignments that have not been edited since they were checked
+    checked = trackhelpers.get_verdicts(state_file, [a.attributes["GlobalID"] for a in completed_assignments], settings)
+    return [a for a in completed_assignments if checked.get(a.attributes["GlobalID"]) != a.attributes["EditDate"]]
 
 
-def get_invalid_assignments(assignments, tracks_fl, time_tolerance, distance_tolerance, min_accuracy):
+def get_track_indexes(tracks_fl, editor, completion_dates, time_tolerance, distance_tolerance, min_accuracy,
+                      cache_dir=None, page_size=1000, mode="planar", max_gap=0, timings=None):
+    """
+    Gets the tracks of a worker for the time span of their completions, one page (of OBJECTIDs) at a time, and indexes
+    them by time and location. If a cache folder is provided, the indexes are cached by day and only the days that
+    are not cached are queried
+    :param tracks_fl: (FeatureLayer) The tracks FS layer
+    :param editor: (string) The user that created the tracks (the worker)
+    :param completion_dates: (List<int>) The completion dates (milliseconds since the epoch)
+    :param time_tolerance: (int) The tolerance (in minutes) to use when verifying locations
+    :param distance_tolerance: (float) The distance (in meters) to use when verifiying locations
+    :param min_accuracy: (float) The minimum distance required
+    :param cache_dir: (string) The folder to cache the indexes in
+    :param page_size: (int) The number of tracks to request at a time
+    :param mode: (string) The distance mode (see trackhelpers.get_distance_mode)
+    :param max_gap: (int) The time (in milliseconds) to add before and after the time span, so that the tracks on
+    either side of the completions can be interpolated
+    :param timings: (dict) If provided, the time spent fetching and indexing the tracks is added to it
+    :return: (List<dict>) The indexes (see trackhelpers.get_track_indexes)
+    """
+    fetch_timings = {}
+
+    def fetch(start, end):
+        fetch_start = time.time()
+        try:
+            return query_tracks(start, end)
+        finally:
+            trackhelpers.add_timing(fetch_timings, "fetch", fetch_start)
+
+    def query_tracks(start, end):
+        loc_query_string = trackhelpers.get_tracks_query(editor, start, end, min_accuracy)
+        logging.getLogger().debug("Location Query: {}".format(loc_query_string))
+        oids = sorted(tracks_fl.query(where=loc_query_string, return_ids_only=True).get("objectIds") or [])
+        tracks = []
+        for i in range(0, len(oids), page_size):
+            locations = tracks_fl.query(object_ids=",".join(str(oid) for oid in oids[i:i + page_size]),
+                                        out_fields="CreationDate,Accuracy").features
+            tracks.extend((location.attributes["CreationDate"], location.geometry["x"], location.geometry["y"],
+                           float(location.attributes["Accuracy"])) for location in locations)
+        return tracks
+    start_time = time.time()
+    start, end = trackhelpers.get_time_span(completion_dates, time_tolerance)
+    start -= max_gap
+    end += max_gap
+    track_indexes = trackhelpers.get_track_indexes(fetch, start, end,
+                                                   trackhelpers.get_cell_size(distance_tolerance, mode), cache_dir,
+                                                   (tracks_fl.url, editor, min_accuracy))
+    # The indexes are built (or read from the cache) while the tracks are not being fetched
+    fetch_seconds = fetch_timings.get("fetch", 0)
+    trackhelpers.add_timing(timings, "index", start_time + fetch_seconds)
+    if timings is not None:
+        timings["fetch"] = timings.get("fetch", 0) + fetch_seconds
+    return track_indexes
+
+
+def get_invalid_assignments(assignments, tracks_fl, time_tolerance, distance_tolerance, min_accuracy, cache_dir=None,
+                            mode="planar", max_gap=None, checks=None, timings=None):
     """
     Filters the assignment based on time and distance
     :param assignments: (List<Feature>) The assignments to check
@@ -140,100 +209,127 @@ def get_invalid_assignments(assignments, tracks_fl, time_tolerance, distance_tol
     :param time_tolerance: (int) The tolerance (in minutes) to use when verifying locations
     :param distance_tolerance: (float) The distance (in meters) to use when verifiying locations
     :param min_accuracy: (float) The minimum distance required
+    :param cache_dir: (string) The folder to cache the indexed tracks in
+    :param mode: (string) The distance mode (see trackhelpers.get_distance_mode)
+    :param max_gap: (int) The largest time (in milliseconds) to interpolate the tracks over, None to not interpolate
+    :param checks: (dict) If provided, the check of each assignment (see trackhelpers.check_completion) is added to it
+    by GlobalID
+    :param timings: (dict) If provided, the time spent in each phase (fetch, index and evaluate) is added to it by
+    worker
     :return: (List<Feature>) The list of assigments that are invalid
     """
+    # Group the assignments by the worker that completed them, so the tracks of each worker are only fetched once
+    assignments_by_editor = {}
+    for assignment in assignments or []:
+        assignments_by_editor.setdefault(assignment.attributes["Editor"], []).append(assignment)
     # Find invalid assignments
     invalid_assignments = []
-    for assignment in assignments:
-        # The coordinates of the assignment
-        start_coords = (assignment.geometry["x"], assignment.geometry["y"])
-        # When the assignment was completed
-        completion_date = datetime.datetime.utcfromtimestamp(
-            int(assignment.attributes["completedDate"]) / 1000)
-        # Add/Subtract some minutes to give a little leeway
-        start_date = completion_date - datetime.timedelta(minutes=time_tolerance)
-        end_date = completion_date + datetime.timedelta(minutes=time_tolerance)
-        # Make a query string to select location by the worker during the time period
-        loc_query_string = "Editor = '{}' AND CreationDate >= '{}' AND CreationDate <= '{}' AND Accuracy <= {}" \
-            .format(assignment.attributes["Editor"], start_date.strftime('%Y-%m-%d %H:%M:%S'),
-                    end_date.strftime('%Y-%m-%d %H:%M:%S'),
-                    min_accuracy)
-        # Query the feature layer
-        locations_to_check = tracks_fl.query(where=loc_query_string).features
-        # Bool to see if this assignment is valid or not
-        is_valid = False
-        for location in locations_to_check:
-            # Make a list of coordinate pairs to get the distance of
-            coords = []
-            coords.append((location.geometry["x"], location.geometry["y"]))
-            # If we include the accuracy, we need to make four variations (+- the accuracy)
-            accuracy = float(location.attributes["Accuracy"])
-            coords.append((location.geometry["x"] + accuracy,
-                           location.geometry["y"] + accuracy))
-            coords.append((location.geometry["x"] + accuracy,
-                           location.geometry["y"] - accuracy))
-            coords.append((location.geometry["x"] - accuracy,
-                           location.geometry["y"] + accuracy))
-            coords.append((location.geometry["x"] - accuracy,
-                           location.geometry["y"] - accuracy))
-            distances = [get_simple_distance(start_coords, coordinates) for coordinates in coords]
-            # if any of the distances is less than the threshold then this assignment is valid
-            if any(distance < distance_tolerance for distance in distances):
-                is_valid = True
-                break
-        # if it's not valid add the OBJECTID to the list of invalid assignment OBJECTIDS
-        if not is_valid:
-            logging.debug("Location Query: {}".format(loc_query_string))
-            invalid_assignments.append(assignment)
+    for editor, editor_assignments in assignments_by_editor.items():
+        editor_timings = None
+        if timings is not None:
+            editor_timings = timings.setdefault(editor, {})
+        completion_dates = [int(assignment.attributes["completedDate"]) for assignment in editor_assignments]
+        track_indexes = get_track_indexes(tracks_fl, editor, completion_dates, time_tolerance, distance_tolerance,
+                                          min_accuracy, cache_dir, mode=mode, max_gap=max_gap or 0,
+                                          timings=editor_timings)
+        trajectory = None
+        if max_gap:
+            start_time = time.time()
+            trajectory = trackhelpers.build_trajectory(track_indexes, max_gap, distance_tolerance, mode)
+            trackhelpers.add_timing(editor_timings, "index", start_time)
+        start_time = time.time()
+        for assignment, completion_date in zip(editor_assignments, completion_dates):
+            check = trackhelpers.check_completion(track_indexes, assignment.geometry["x"], assignment.geometry["y"],
+                                                  completion_date, time_tolerance, distance_tolerance, mode=mode,
+                                                  trajectory=trajectory)
+            if checks is not None:
+                checks[assignment.attributes["GlobalID"]] = check
+            # if it's not valid add it to the list of invalid assignments
+            if not check["valid"]:
+                logging.debug("Invalid completion: {}".format(assignment.attributes["OBJECTID"]))
+                invalid_assignments.append(assignment)
+        trackhelpers.add_timing(editor_timings, "evaluate", start_time)
     return invalid_assignments
 
 
-def copy_assignments(assignments, target_fl, field_mappings):
+def get_copied_global_ids(target_fl, global_id_field, global_ids, chunk_size=500):
     """
-    Copies the assignments to the target feature service layer
-    :param assignments: (List<Feature>) The list of assignments to add
-    :param target_fl: (string) The target feature layer to add the assignments to
-    :param field_mappings: (dict) The field mappings that convert the original fields to the target fields
-    :return:
+    Gets which of the provided GlobalIDs are already in the target feature layer. Only the provided GlobalIDs are
+    queried (a chunk at a time), rather than every feature of the target
+    :param target_fl: (FeatureLayer) The target feature layer
+    :param global_id_field: (string) The field of the target that stores the original GlobalID
+    :param global_ids: (list<string>) The GlobalIDs to look for
+    :param chunk_size: (int) The number of GlobalIDs to query at a time
+    :return: (set<string>) The GlobalIDs that are already copied
     """
-    # Query the archived assignments to get all of the currently archived/invalid ones
-    logging.getLogger().info("Querying target features")
-    archived_assignments = target_fl.query(out_fields=field_mappings["GlobalID"])
-    # Create a list of GlobalIDs - These should be unique
-    global_ids = [feature.attributes[field_mappings["GlobalID"]] for feature in archived_assignments.features]
-    # Iterate through the the assignments returned and only add those that don't exist in the Feature Layer
-    # that is storing the archived ones
-    assignments_to_copy = []
-    for assignment in assignments:
-        if assignment.attributes["GlobalID"] not in global_ids:
-            assignments_to_copy.append(assignment)
-    # Create a new list to store the updated feature-dictionaries
-    assignments_to_submit = []
-    # Loop over all assignments that we want to add,
-    for assignment in assignments_to_copy:
-        # map the field names appropriately
-        assignment_attributes = {}
-        for key, value in field_mappings.items():
-            assignment_attributes[value] = assignment.attributes[key]
-        # create the new feature object to send to server
-        assignments_to_submit.append(arcgis.features.Feature(geometry=assignment.geometry, attributes=assignment_attributes))
-    if assignments_to_submit:
-        logging.getLogger().info("Adding invalid assignments to target Feature Service...")
-        response = target_fl.edit_features(adds=arcgis.features.FeatureSet(assignments_to_submit))
-        logging.getLogger().info(response)
-    else:
-        logging.getLogger().info("No invalid completed assignments detected")
-    logging.getLogger().info("Completed")
+    copied = set()
+    for i in range(0, len(global_ids), chunk_size):
+        where = "{} IN ({})".format(global_id_field,
+                                    ",".join("'{}'".format(global_id) for global_id in global_ids[i:i + chunk_size]))
+        copied.update(feature.attributes[global_id_field] for feature in
+                      target_fl.query(where=where, out_fields=global_id_field, return_geometry=False).features)
+    return copied
 
 
-def get_simple_distance(coords1, coords2):
+def find_copied(target_fl, global_id_field, features):
+    """
+    Gets which of the (mapped) features are already in the target feature layer, by the field the GlobalID of the
+    assignment is copied to. Used to check the adds of a request that raised before they are retried
+    :param target_fl: (FeatureLayer) The target feature layer
+    :param global_id_field: (string) The field of the target that stores the original GlobalID
+    :param features: (list<dict>) The features that were added
+    :return: (set<int>) The indexes of the features that are in the target
     """
-    Calculates the simple distance between two x,y points
-    :param coords1: (Tuple) of x and y coordinates
-    :param coords2: (Tuple) of x and y coordinates
-    :return: (float) The distance between the two points
+    copied = get_copied_global_ids(target_fl, global_id_field,
+                                   [feature["attributes"][global_id_field] for feature in features])
+    return set(i for i, feature in enumerate(features) if feature["attributes"][global_id_field] in copied)
+
+
+def get_features(features):
     """
-    return math.sqrt((coords1[0]-coords2[0])**2 + (coords1[1]-coords2[1])**2)
+    Converts the features (dictionaries) that are written by featurewriter to Feature objects
+    :param features: (List<dict>) The features
+    :return: (List<Feature>) The Feature objects
+    """
+    return [arcgis.features.Feature(geometry=feature.get("geometry"), attributes=feature["attributes"])
+            for feature in features]
+
+
+def copy_assignments(assignments, target_fl, field_mappings, batch_size=500, threads=1, map_page=None):
+    """
+    Copies the assignments to the target feature service layer. Only the assignments whose GlobalIDs are not already
+    in the target are added, in batches of up to batch_size assignments, up to "threads" batches at the same time
+    :param assignments: (List<Feature>) The list of assignments to add
+    :param target_fl: (string) The target feature layer to add the assignments to
+    :param field_mappings: (dict) The field mappings that convert the original fields to the target fields
+    :param batch_size: (int) The maximum number of assignments to add per request
+    :param threads: (int) The maximum number of batches to add at the same time
+    :param map_page: (function) The compiled field mappings (compiled from field_mappings if not provided)
+    :return: (dict) The OBJECTIDs that were added, already copied, or failed to be added
+    """
+    map_page = map_page or fieldmapper.compile_field_mappings(field_mappings)
+    # Query only the GlobalIDs of the invalid assignments, rather than all of the copied ones
+    logging.getLogger().info("Querying target features")
+    copied = get_copied_global_ids(target_fl, field_mappings["GlobalID"],
+                                   [assignment.attributes["GlobalID"] for assignment in assignments])
+    results = {"added": [], "failed": [],
+               "copied": [a.attributes["OBJECTID"] for a in assignments if a.attributes["GlobalID"] in copied]}
+    assignments_to_copy = [assignment for assignment in assignments if assignment.attributes["GlobalID"] not in copied]
+    if not assignments_to_copy:
+        logging.getLogger().info("No invalid completed assignments to add")
+        return results
+    logging.getLogger().info("Adding invalid assignments to target Feature Service...")
+    # map the field names of all of the assignments at once
+    mapped_attributes = map_page([assignment.attributes for assignment in assignments_to_copy])
+    edits = ((assignment.attributes["OBJECTID"], "add", {"geometry": assignment.geometry, "attributes": attributes})
+             for assignment, attributes in zip(assignments_to_copy, mapped_attributes))
+    written = featurewriter.write_edits(
+        lambda adds, updates: target_fl.edit_features(adds=get_features(adds), rollback_on_failure=False),
+        edits, max_count=batch_size, threads=threads,
+        find_added=lambda features: find_copied(target_fl, field_mappings["GlobalID"], features))
+    results["added"] = written["added"]
+    results["failed"] = written["failed"]
+    return results
 
 
 def main(args):
@@ -256,14 +352,64 @@ def main(args):
     logging.getLogger().info("Reading field mappings...")
     with open(args.configFile, 'r') as f:
         field_mappings = json.load(f)
+    # Compile the field mappings once (the rest of the script only needs the names of the target fields)
+    map_page = fieldmapper.compile_field_mappings(field_mappings)
+    field_mappings = fieldmapper.get_target_fields(field_mappings)
 
     if not validate_config(target_fl, field_mappings):
         logger.critical("Invalid field mappings detected")
         return
     else:
-        completed_assignments = get_completed_assignments(assignment_fl, worker_fl, args.workers)
-        invalid_assignments = get_invalid_assignments(completed_assignments, tracks_fl, args.timeTol, args.distTol, args.minAccuracy)
-        copy_assignments(invalid_assignments, target_fl, field_mappings)
+        mode = args.distanceMode
+        if mode == "auto":
+            mode = trackhelpers.get_distance_mode(assignment_fl.properties.extent.spatialReference)
+        logger.info("Using the {} distance mode".format(mode))
+        # Interpolate between tracks that are at most a few tracking intervals apart
+        max_gap = None
+        if args.interpolate:
+            max_gap = trackhelpers.get_max_gap(workforce_project_data["tracks"].get("updateInterval"))
+        settings = trackhelpers.get_settings(args.timeTol, args.distTol, args.minAccuracy, mode, max_gap)
+        if args.stateFile:
+            trackhelpers.initialize_state(args.stateFile)
+        start_time = time.time()
+        completed_assignments = get_completed_assignments(assignment_fl, worker_fl, args.workers, args.stateFile,
+                                                          args.projectId, settings)
+        query_timings = {}
+        trackhelpers.add_timing(query_timings, "fetch", start_time)
+        checks = {}
+        worker_timings = {}
+        invalid_assignments = get_invalid_assignments(completed_assignments, tracks_fl, args.timeTol, args.distTol, args.minAccuracy, args.cacheDir, mode, max_gap, checks, worker_timings)
+        results = []
+        if completed_assignments and (args.stateFile or args.report):
+            worker_names = {w.attributes["OBJECTID"]: w.attributes["userId"] for w in
+                            worker_fl.query(out_fields="OBJECTID,userId").features}
+            for assignment in completed_assignments:
+                result = {
+                    "GlobalID": assignment.attributes["GlobalID"],
+                    "OBJECTID": assignment.attributes["OBJECTID"],
+                    "worker": worker_names.get(assignment.attributes["workerId"]),
+                    "completedDate": int(assignment.attributes["completedDate"]),
+                    "EditDate": assignment.attributes["EditDate"]
+                }
+                result.update(checks[assignment.attributes["GlobalID"]])
+                results.append(result)
+        start_time = time.time()
+        copy_results = copy_assignments(invalid_assignments, target_fl, field_mappings, args.batchSize, args.threads,
+                                        map_page)
+        logger.info("{} invalid assignments added, {} already copied, {} failed".format(
+            len(copy_results["added"]), len(copy_results["copied"]), len(copy_results["failed"])))
+        if copy_results["failed"]:
+            # The results are not remembered, so that the assignments are checked and copied again next run
+            logger.error("Not all of the invalid assignments were copied, the results are not saved")
+            trackhelpers.write_report(args.report, results, trackhelpers.get_timings(worker_timings, query_timings),
+                                      settings)
+            return
+        # Only remember the results once the invalid assignments have been copied
+        trackhelpers.save_state(args.stateFile, args.projectId, results, settings)
+        trackhelpers.add_timing(query_timings, "write", start_time)
+        trackhelpers.write_report(args.report, results, trackhelpers.get_timings(worker_timings, query_timings),
+                                  settings)
+        logger.info("Completed")
 
 
 if __name__ == "__main__":
@@ -287,6 +433,23 @@ if __name__ == "__main__":
                         help='The distance tolerance to use (meters- based on SR of Assignments FL)')
     parser.add_argument('-minAccuracy', dest='minAccuracy', default=50,
                         help="The minimum accuracy to use (meters - based on SR of Assignments FL)")
+    parser.add_argument('-cacheDir', dest='cacheDir', default=None,
+                        help="The folder to cache the indexed worker locations in (reused by later runs)")
+    parser.add_argument('-threads', dest='threads', type=int, default=1,
+                        help="The maximum number of batches of invalid assignments to copy at the same time")
+    parser.add_argument('-batchSize', dest='batchSize', type=int, default=500,
+                        help="The number of invalid assignments to copy at a time")
+    parser.add_argument('-stateFile', dest='stateFile', default=None,
+                        help="The SQLite database to remember the checked assignments in, so that later runs only "
+                             "check new or edited assignments")
+    parser.add_argument('-distanceMode', dest='distanceMode', default="auto",
+                        choices=["auto", "planar", "mercator", "geographic"],
+                        help="How to measure distances (auto picks the mode from the spatial reference of the "
+                             "assignments)")
+    parser.add_argument('-interpolate', dest='interpolate', action='store_true', default=False,
+                        help="Interpolate the worker locations between tracks and detect where workers stayed")
+    parser.add_argument('-report', dest='report', default=None,
+                        help="The file to write the result of each assignment and the timings to (json, or .parquet)")
     args = parser.parse_args()
     try:
         main(args)
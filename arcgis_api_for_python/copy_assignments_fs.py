@@ -23,12 +23,24 @@
     This sample copies assignments from one project to another feature service
 """
 import argparse
+import datetime
 import json
 import logging
 import logging.handlers
+import sqlite3
+import time
 import traceback
 import sys
+import uuid
 import arcgis
+import featurewriter
+import fieldmapper
+import projectioncache
+
+
+# The watermark is kept this far (in milliseconds) behind the start of a sync, in case the clock of the server (which
+# sets the EditDates) is ahead of this one
+SYNC_CLOCK_SKEW = 5 * 60 * 1000
 
 
 def initialize_logging(log_file):
@@ -58,6 +70,37 @@ def initialize_logging(log_file):
     return logger
 
 
+def get_global_id_key(global_id):
+    """
+    Converts a GlobalID to a compact key for lookups (the 16 bytes of the UUID, rather than its 38 character string).
+    Braces and case are ignored, so "{0A1B...}" and "0a1b..." have the same key
+    :param global_id: (string) The GlobalID
+    :return: (bytes) The key, or the GlobalID itself if it is not a UUID
+    """
+    try:
+        return uuid.UUID(global_id).bytes
+    except (AttributeError, TypeError, ValueError):
+        return global_id
+
+
+def index_global_ids(target_fl, global_id_field, page_size=1000):
+    """
+    Builds a set of the GlobalID keys of the target features, one page (of OBJECTIDs) at a time, so that only the keys
+    (and not every feature) are held in memory
+    :param target_fl: (FeatureLayer) The target feature layer
+    :param global_id_field: (string) The field of the target that stores the original GlobalID
+    :param page_size: (int) The number of features to request at a time (should not exceed maxRecordCount)
+    :return: (set<bytes>) The GlobalID keys
+    """
+    oids = sorted(target_fl.query(return_ids_only=True).get("objectIds") or [])
+    keys = set()
+    for i in range(0, len(oids), page_size):
+        features = target_fl.query(object_ids=",".join(str(oid) for oid in oids[i:i + page_size]),
+                                   out_fields=global_id_field, return_geometry=False).features
+        keys.update(get_global_id_key(feature.attributes[global_id_field]) for feature in features)
+    return keys
+
+
 def validate_config(target_fl, field_mappings):
     """
     Validates the field mappings to make sure the fields exist
@@ -106,6 +149,272 @@ def validate_config(target_fl, field_mappings):
     return True
 
 
+def initialize_sync_state(db):
+    """
+    Initializes the sync state database and creates the table if necessary
+    :param db: (string) The database to use
+    :return:
+    """
+    conn = sqlite3.connect(db)
+    c = conn.cursor()
+    c.execute("CREATE TABLE IF NOT EXISTS `Syncs` ( "
+              "`source` TEXT, "
+              "`target` TEXT, "
+              "`query` TEXT, "
+              "`EditDate` INTEGER, "
+              "`syncDate` INTEGER, "
+              "PRIMARY KEY(`source`, `target`, `query`) )")
+    conn.commit()
+    conn.close()
+
+
+def get_sync_watermark(db, source_fl_url, target_fl_url, where):
+    """
+    Gets the latest EditDate of the assignments that were synced from the source to the target
+    :param db: (string) The database to use
+    :param source_fl_url: (string) The url to the feature layer the assignments are synced from
+    :param target_fl_url: (string) The url to the feature layer the assignments are synced to
+    :param where: (string) The where clause used to select the assignments
+    :return: (int) The latest EditDate (milliseconds since the epoch), None if the assignments have not been synced
+    """
+    conn = sqlite3.connect(db)
+    c = conn.cursor()
+    c.execute("SELECT EditDate FROM Syncs WHERE source = ? AND target = ? AND query = ?",
+              (source_fl_url, target_fl_url, where))
+    row = c.fetchone()
+    conn.close()
+    return row[0] if row else None
+
+
+def save_sync_watermark(db, source_fl_url, target_fl_url, where, edit_date):
+    """
+    Saves the latest EditDate of the assignments that were synced from the source to the target
+    :param db: (string) The database to use
+    :param source_fl_url: (string) The url to the feature layer the assignments are synced from
+    :param target_fl_url: (string) The url to the feature layer the assignments are synced to
+    :param where: (string) The where clause used to select the assignments
+    :param edit_date: (int) The latest EditDate (milliseconds since the epoch)
+    :return:
+    """
+    conn = sqlite3.connect(db)
+    c = conn.cursor()
+    c.execute("INSERT OR REPLACE INTO Syncs VALUES (?, ?, ?, ?, strftime('%s', 'now') * 1000)",
+              (source_fl_url, target_fl_url, where, edit_date))
+    conn.commit()
+    conn.close()
+
+
+def get_synced_features(target_fl, field_mappings, global_ids, chunk_size=500):
+    """
+    Gets the target features of the provided (source) GlobalIDs. Only the provided GlobalIDs are queried (a chunk at a
+    time), rather than every feature of the target
+    :param target_fl: (FeatureLayer) The feature layer the assignments are synced to
+    :param field_mappings: (dict) The field mappings that convert the original fields to the target fields
+    :param global_ids: (list<string>) The GlobalIDs of the source assignments
+    :param chunk_size: (int) The number of GlobalIDs to query at a time
+    :return: (dict) The attributes (OBJECTID, GlobalID and the EditDate of the assignment) of the target features by
+    the key (from get_global_id_key) of the GlobalID of their assignment, so that they are matched as the copy does
+    """
+    out_fields = [target_fl.properties.get("objectIdField", "OBJECTID"), field_mappings["GlobalID"],
+                  field_mappings["EditDate"]]
+    if target_fl.properties.get("globalIdField"):
+        out_fields.append(target_fl.properties["globalIdField"])
+    synced = {}
+    for i in range(0, len(global_ids), chunk_size):
+        where = "{} IN ({})".format(field_mappings["GlobalID"],
+                                    ",".join("'{}'".format(global_id) for global_id in global_ids[i:i + chunk_size]))
+        for feature in target_fl.query(where=where, out_fields=",".join(out_fields), return_geometry=False).features:
+            synced[get_global_id_key(feature.attributes[field_mappings["GlobalID"]])] = feature.attributes
+    return synced
+
+
+def find_copied(target_fl, field_mappings, features):
+    """
+    Gets which of the (mapped) features are already in the target feature layer, by the field the GlobalID of the
+    assignment is copied to. Used to check the adds of a request that raised before they are retried
+    :param target_fl: (FeatureLayer) The feature layer the assignments are copied to
+    :param field_mappings: (dict) The field mappings that convert the original fields to the target fields
+    :param features: (list<dict>) The features that were added
+    :return: (set<int>) The indexes of the features that are in the target
+    """
+    synced = get_synced_features(target_fl, field_mappings,
+                                 [feature["attributes"][field_mappings["GlobalID"]] for feature in features])
+    return set(i for i, feature in enumerate(features)
+               if get_global_id_key(feature["attributes"][field_mappings["GlobalID"]]) in synced)
+
+
+def get_features(features):
+    """
+    Converts the features (dictionaries) that are written by featurewriter to Feature objects
+    :param features: (List<dict>) The features
+    :return: (List<Feature>) The Feature objects
+    """
+    return [arcgis.features.Feature(geometry=feature.get("geometry"), attributes=feature["attributes"])
+            for feature in features]
+
+
+def get_projector(source_fl, target_fl, projection_cache):
+    """
+    Makes the function that projects assignments (queried in the spatial reference of the source) to the spatial
+    reference of the target feature layer, locally and through the projection cache. Assignments that cannot be
+    projected locally are queried from the source with out_sr
+    :param source_fl: (FeatureLayer) The feature layer to get the assignments from
+    :param target_fl: (FeatureLayer) The feature layer the assignments are copied to
+    :param projection_cache: (string) The SQLite database to cache the projected geometries in
+    :return: (function) Projects a list of assignments (dictionaries)
+    """
+    projectioncache.initialize_cache(projection_cache)
+    in_wkid = projectioncache.get_wkid(dict(source_fl.properties.extent.spatialReference))
+    out_wkid = projectioncache.get_wkid(dict(target_fl.properties.extent.spatialReference))
+
+    def query_projected(oids):
+        features = source_fl.query(object_ids=",".join(str(oid) for oid in oids), out_fields="OBJECTID",
+                                   out_sr=target_fl.properties.extent.spatialReference).features
+        return dict((feature.attributes["OBJECTID"], feature.geometry) for feature in features)
+    return lambda assignments: projectioncache.project_features(assignments, in_wkid, out_wkid, projection_cache,
+                                                                query_projected)
+
+
+def get_copy_edits(assignments, global_ids, map_page, project=None):
+    """
+    Gets the adds of the assignments that are not already in the target feature layer
+    :param assignments: (List<Feature>) The assignments
+    :param global_ids: (set<bytes>) The GlobalID keys of the assignments in the target feature layer
+    :param map_page: (function) The compiled field mappings
+    :param project: (function) Projects a list of assignments to the spatial reference of the target feature layer,
+                    None if the assignments are already projected
+    :return: (generator<tuple>) The edits (OBJECTID of the assignment, "add" and the feature to add)
+    """
+    # Only add the assignments that don't exist in the Feature Layer that is storing the archived ones
+    assignments_to_copy = [{"geometry": assignment.geometry, "attributes": assignment.attributes}
+                           for assignment in assignments
+                           if get_global_id_key(assignment.attributes["GlobalID"]) not in global_ids]
+    # Only the assignments that are copied are projected
+    if project and assignments_to_copy:
+        assignments_to_copy = project(assignments_to_copy)
+    # map the field names of all of the assignments at once
+    mapped_attributes = map_page([assignment["attributes"] for assignment in assignments_to_copy])
+    for assignment, attributes in zip(assignments_to_copy, mapped_attributes):
+        yield assignment["attributes"]["OBJECTID"], "add", {"geometry": assignment["geometry"],
+                                                            "attributes": attributes}
+
+
+def sync_page(assignments, target_fl, field_mappings, map_page, batch_size=featurewriter.MAX_COUNT, threads=1,
+              project=None):
+    """
+    Upserts a page of assignments into the target feature layer: assignments that are not in the target are added,
+    and assignments that were edited since they were copied are updated (in a single applyEdits request)
+    :param assignments: (List<Feature>) The page of assignments to sync
+    :param target_fl: (FeatureLayer) The feature layer the assignments are synced to
+    :param field_mappings: (dict) The field mappings that convert the original fields to the target fields
+    :param map_page: (function) The compiled field mappings
+    :param batch_size: (int) The maximum number of assignments to add or update per request
+    :param threads: (int) The maximum number of batches to write at the same time
+    :param project: (function) Projects a list of assignments to the spatial reference of the target feature layer,
+                    None if the page is already projected
+    :return: (dict) The number of assignments that were added, updated, unchanged and failed
+    """
+    synced = get_synced_features(target_fl, field_mappings,
+                                 [assignment.attributes["GlobalID"] for assignment in assignments])
+    object_id_field = target_fl.properties.get("objectIdField", "OBJECTID")
+    global_id_field = target_fl.properties.get("globalIdField")
+    # Features are identified by their GlobalIDs when the target supports it, and by their OBJECTIDs otherwise
+    use_global_ids = bool(global_id_field and target_fl.properties.get("supportsApplyEditsWithGlobalIds"))
+    unchanged = 0
+    assignments_to_write = []
+    targets = []
+    for assignment in assignments:
+        target = synced.get(get_global_id_key(assignment.attributes["GlobalID"]))
+        if target is not None and target.get(field_mappings["EditDate"]) == assignment.attributes["EditDate"]:
+            unchanged += 1
+        else:
+            assignments_to_write.append({"geometry": assignment.geometry, "attributes": assignment.attributes})
+            targets.append(target)
+    # Only the assignments that are added or updated are projected and mapped
+    if project and assignments_to_write:
+        assignments_to_write = project(assignments_to_write)
+    edits = []
+    # map the field names of all of the assignments at once
+    mapped_attributes = map_page([assignment["attributes"] for assignment in assignments_to_write])
+    for assignment, assignment_attributes, target in zip(assignments_to_write, mapped_attributes, targets):
+        feature = {"geometry": assignment["geometry"], "attributes": assignment_attributes}
+        if target is None:
+            if use_global_ids:
+                assignment_attributes[global_id_field] = assignment["attributes"]["GlobalID"]
+            edits.append((assignment["attributes"]["OBJECTID"], "add", feature))
+        else:
+            if use_global_ids:
+                assignment_attributes[global_id_field] = target[global_id_field]
+            else:
+                assignment_attributes[object_id_field] = target[object_id_field]
+            edits.append((assignment["attributes"]["OBJECTID"], "update", feature))
+    written = featurewriter.write_edits(
+        lambda adds, updates: target_fl.edit_features(adds=get_features(adds), updates=get_features(updates),
+                                                      use_global_ids=use_global_ids, rollback_on_failure=False),
+        edits, max_count=batch_size, threads=threads,
+        find_added=lambda features: find_copied(target_fl, field_mappings, features))
+    return {"added": len(written["added"]), "updated": len(written["updated"]), "unchanged": unchanged,
+            "failed": len(written["failed"])}
+
+
+def sync_assignments(source_fl, target_fl, field_mappings, state_file, where="1=1", page_size=1000, map_page=None,
+                     batch_size=featurewriter.MAX_COUNT, threads=1, projection_cache=None):
+    """
+    Syncs the assignments that were edited since the last sync (the EditDate watermark in the state file) to the target
+    feature layer, one page at a time, so that each run only reads and writes the assignments that changed. The
+    watermark is only moved forward if all of the assignments were synced
+
+    When a projection cache is used, the assignments are projected locally (see get_projector), rather than by the
+    server
+    :param source_fl: (FeatureLayer) The feature layer to get the assignments from
+    :param target_fl: (FeatureLayer) The feature layer to sync the assignments to
+    :param field_mappings: (dict) The field mappings that convert the original fields to the target fields
+    :param state_file: (string) The SQLite database that stores the watermark
+    :param where: (string) The where clause used to select the assignments
+    :param page_size: (int) The number of assignments to sync per request
+    :param map_page: (function) The compiled field mappings (compiled from field_mappings if not provided)
+    :param batch_size: (int) The maximum number of assignments to add or update per request
+    :param threads: (int) The maximum number of batches to write at the same time
+    :param projection_cache: (string) The SQLite database to cache the projected geometries in
+    :return: (dict) The number of assignments that were added, updated, unchanged and failed
+    """
+    map_page = map_page or fieldmapper.compile_field_mappings(field_mappings)
+    initialize_sync_state(state_file)
+    watermark = get_sync_watermark(state_file, source_fl.url, target_fl.url, where)
+    changed_where = where
+    if watermark is not None:
+        # Assignments edited in the same second as the watermark are read again (and are unchanged if already synced)
+        changed_where = "({}) AND EditDate >= '{}'".format(
+            where, datetime.datetime.utcfromtimestamp(watermark / 1000).strftime('%Y-%m-%d %H:%M:%S'))
+    # Assignments can be edited while they are read (after their page was read, or after the OBJECTIDs were queried), so
+    # the watermark is never moved past the start of the sync, and those edits are read again by the next sync
+    run_start = int(time.time() * 1000) - SYNC_CLOCK_SKEW
+    logging.getLogger().info("Syncing assignments ({})...".format(changed_where))
+    if projection_cache:
+        project = get_projector(source_fl, target_fl, projection_cache)
+        assignments = source_fl.query(where=changed_where).features
+    else:
+        project = None
+        assignments = source_fl.query(where=changed_where,
+                                      out_sr=target_fl.properties.extent.spatialReference).features
+    totals = {"added": 0, "updated": 0, "unchanged": 0, "failed": 0}
+    for i in range(0, len(assignments), page_size):
+        page_result = sync_page(assignments[i:i + page_size], target_fl, field_mappings, map_page, batch_size,
+                                threads, project)
+        for key in totals:
+            totals[key] += page_result[key]
+        logging.getLogger().info("Synced a page of assignments: {added} added, {updated} updated, {unchanged} "
+                                 "unchanged, {failed} failed".format(**page_result))
+    if totals["failed"]:
+        # The assignments are read again by the next sync
+        logging.getLogger().error("{} assignments failed to sync, the watermark was not moved".format(
+            totals["failed"]))
+    elif assignments:
+        save_sync_watermark(state_file, source_fl.url, target_fl.url, where,
+                            min(max(assignment.attributes["EditDate"] for assignment in assignments), run_start))
+    return totals
+
+
 def main(args):
     # initialize logging
     logger = initialize_logging(args.logFile)
@@ -125,40 +434,45 @@ def main(args):
     logging.getLogger().info("Reading field mappings...")
     with open(args.configFile, 'r') as f:
         field_mappings = json.load(f)
+    # Compile the field mappings once (the rest of the script only needs the names of the target fields)
+    map_page = fieldmapper.compile_field_mappings(field_mappings)
+    field_mappings = fieldmapper.get_target_fields(field_mappings)
     logging.getLogger().info("Validating field mappings...")
     if not validate_config(target_fl, field_mappings):
         logger.critical("Invalid field mappings detected")
         return
+    elif args.stateFile:
+        # Only sync the assignments that were edited since the last sync
+        totals = sync_assignments(assignment_fl, target_fl, field_mappings, args.stateFile, where=args.where,
+                                  map_page=map_page, batch_size=args.batchSize, threads=args.threads,
+                                  projection_cache=args.projectionCache)
+        logger.info("{added} assignments added, {updated} updated, {unchanged} unchanged, {failed} "
+                    "failed".format(**totals))
+        logger.info("Completed")
     else:
         # Copy the assignments
         # Query the source to get the features specified by the query string
         logger.info("Querying source features...")
-        current_assignments = assignment_fl.query(where=args.where, out_sr=target_fl.properties.extent.spatialReference)
+        if args.projectionCache:
+            # The assignments are projected locally (see get_projector), rather than by the server
+            project = get_projector(assignment_fl, target_fl, args.projectionCache)
+            current_assignments = assignment_fl.query(where=args.where)
+        else:
+            project = None
+            current_assignments = assignment_fl.query(where=args.where,
+                                                      out_sr=target_fl.properties.extent.spatialReference)
 
         # Query the archived assignments to get all of the currently archived ones
         logger.info("Querying target features")
-        archived_assignments = target_fl.query(out_fields=field_mappings["GlobalID"])
-        # Create a list of GlobalIDs - These should be unique
-        global_ids = [feature.attributes[field_mappings["GlobalID"]] for feature in archived_assignments.features]
-        # Iterate through the the assignments returned and only add those that don't exist in the Feature Layer
-        # that is storing the archived ones
-        assignments_to_copy = []
-        for assignment in current_assignments.features:
-            if assignment.attributes["GlobalID"] not in global_ids:
-                assignments_to_copy.append(assignment)
-            # Create a new list to store the updated feature-dictionaries
-        assignments_to_submit = []
-        # Loop over all assignments that we want to add,
-        for assignment in assignments_to_copy:
-            # map the field names appropriately
-            assignment_attributes = {}
-            for key, value in field_mappings.items():
-                assignment_attributes[value] = assignment.attributes[key]
-            # create the new feature object to send to server
-            assignments_to_submit.append(arcgis.features.Feature(geometry=assignment.geometry, attributes=assignment_attributes))
+        # Index the GlobalIDs (as 16 byte keys) as the pages are read - These should be unique
+        global_ids = index_global_ids(target_fl, field_mappings["GlobalID"])
+        # Add the assignments that don't exist in the Feature Layer that is storing the archived ones, in batches
         logger.info("Copying assignments...")
-        response = target_fl.edit_features(adds=arcgis.features.FeatureSet(assignments_to_submit))
-        logger.info(response)
+        written = featurewriter.write_edits(
+            lambda adds, updates: target_fl.edit_features(adds=get_features(adds), rollback_on_failure=False),
+            get_copy_edits(current_assignments.features, global_ids, map_page, project), max_count=args.batchSize,
+            threads=args.threads, find_added=lambda features: find_copied(target_fl, field_mappings, features))
+        logger.info("{} assignments added, {} failed".format(len(written["added"]), len(written["failed"])))
         logger.info("Completed")
 
 
@@ -176,6 +490,16 @@ if __name__ == "__main__":
                         required=True)
     parser.add_argument('-configFile', dest="configFile", help="The json configuration file to use", required=True)
     parser.add_argument('-logFile', dest='logFile', help="The log file to write to", required=True)
+    parser.add_argument('-stateFile', dest='stateFile', default=None,
+                        help="The SQLite database to keep the sync watermark in. When provided, only the assignments "
+                             "edited since the last run are added or updated")
+    parser.add_argument('-batchSize', dest='batchSize', type=int, default=500,
+                        help="The maximum number of assignments to add or update per request")
+    parser.add_argument('-threads', dest='threads', type=int, default=1,
+                        help="The maximum number of requests to send at the same time")
+    parser.add_argument('-projectionCache', dest='projectionCache', default=None,
+                        help="The SQLite database to cache projected geometries in. When provided, the assignments are "
+                             "projected locally (with pyproj, if installed) rather than by the server")
     args = parser.parse_args()
     try:
         main(args)
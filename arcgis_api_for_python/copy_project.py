@@ -24,16 +24,26 @@
 """
 
 import argparse
+import concurrent.futures
 import logging
 import logging.handlers
 import os
+import sqlite3
 import sys
 import traceback
 import arcgis
+import featurewriter
+import trackhelpers
+import userdirectory
 
 import json
 import requests
 
+# The reads and writes of the layers that can run at the same time (see main)
+MAX_TASKS = 8
+# The maximum number of tracks read at a time (a range of CreationDates is split until it has fewer tracks)
+MAX_TRACKS = 10000
+
 def initialize_logger(logFile):
     # Format the logger
     # The format for the logs
@@ -56,6 +66,162 @@ def initialize_logger(logFile):
     logger.addHandler(rh)
     return logger
 
+def initialize_journal(db):
+    """
+    Initializes the journal database and creates the tables if necessary
+    :param db:                      (string) The database to use
+    :return:
+    """
+    conn = sqlite3.connect(db)
+    c = conn.cursor()
+    c.execute("CREATE TABLE IF NOT EXISTS `Stages` ( "
+              "`run` TEXT, "
+              "`stage` TEXT, "
+              "PRIMARY KEY(`run`, `stage`) )")
+    c.execute("CREATE TABLE IF NOT EXISTS `Mappings` ( "
+              "`run` TEXT, "
+              "`layer` TEXT, "
+              "`sourceOID` INTEGER, "
+              "`destinationOID` INTEGER, "
+              "PRIMARY KEY(`run`, `layer`, `sourceOID`) )")
+    c.execute("CREATE TABLE IF NOT EXISTS `Written` ( "
+              "`run` TEXT, "
+              "`layer` TEXT, "
+              "`GlobalID` TEXT, "
+              "PRIMARY KEY(`run`, `layer`, `GlobalID`) )")
+    conn.commit()
+    conn.close()
+
+def get_completed_stages(journal):
+    """
+    :param journal:                 (tuple) The journal database and the run (source and destination project ids), None if not used
+    :return:                        set<string> The stages of the run that were completed
+    """
+    if not journal:
+        return set()
+    conn = sqlite3.connect(journal[0])
+    c = conn.cursor()
+    c.execute("SELECT stage FROM Stages WHERE run = ?", (journal[1],))
+    stages = set(row[0] for row in c.fetchall())
+    conn.close()
+    return stages
+
+def complete_stage(journal, stage):
+    """
+    :param journal:                 (tuple) The journal database and the run, None if not used
+    :param stage:                   (string) The stage that was completed (ex. workers)
+    :return:
+    """
+    if not journal:
+        return
+    conn = sqlite3.connect(journal[0])
+    c = conn.cursor()
+    c.execute("INSERT OR REPLACE INTO Stages (run, stage) VALUES (?, ?)", (journal[1], stage))
+    conn.commit()
+    conn.close()
+
+def save_mapping(journal, layer, mapping_oid):
+    """
+    :param journal:                 (tuple) The journal database and the run, None if not used
+    :param layer:                   (string) The layer (workers or dispatchers)
+    :param mapping_oid:             dict The destination OBJECTID of each source OBJECTID
+    :return:
+    """
+    if not journal:
+        return
+    conn = sqlite3.connect(journal[0])
+    c = conn.cursor()
+    c.executemany("INSERT OR REPLACE INTO Mappings (run, layer, sourceOID, destinationOID) VALUES (?, ?, ?, ?)",
+                  [(journal[1], layer, source_oid, destination_oid) for source_oid, destination_oid in mapping_oid.items()])
+    conn.commit()
+    conn.close()
+
+def get_mapping(journal, layer):
+    """
+    :param journal:                 (tuple) The journal database and the run
+    :param layer:                   (string) The layer (workers or dispatchers)
+    :return:                        dict The destination OBJECTID of each source OBJECTID that was saved
+    """
+    conn = sqlite3.connect(journal[0])
+    c = conn.cursor()
+    c.execute("SELECT sourceOID, destinationOID FROM Mappings WHERE run = ? AND layer = ?", (journal[1], layer))
+    mapping_oid = dict(c.fetchall())
+    conn.close()
+    return mapping_oid
+
+def save_written(journal, layer, global_ids):
+    """
+    :param journal:                 (tuple) The journal database and the run, None if not used
+    :param layer:                   (string) The layer (tracks or assignments)
+    :param global_ids:              List<string> The GlobalIDs of the features that were written
+    :return:
+    """
+    if not journal or not global_ids:
+        return
+    conn = sqlite3.connect(journal[0])
+    c = conn.cursor()
+    c.executemany("INSERT OR REPLACE INTO Written (run, layer, GlobalID) VALUES (?, ?, ?)",
+                  [(journal[1], layer, global_id) for global_id in global_ids])
+    conn.commit()
+    conn.close()
+
+def get_written(journal, layer, global_ids):
+    """
+    :param journal:                 (tuple) The journal database and the run, None if not used
+    :param layer:                   (string) The layer (tracks or assignments)
+    :param global_ids:              List<string> The GlobalIDs of the features
+    :return:                        set<string> The GlobalIDs that were written by an earlier attempt of the run
+    """
+    if not journal or not global_ids:
+        return set()
+    conn = sqlite3.connect(journal[0])
+    c = conn.cursor()
+    written = set()
+    # SQLite limits the number of parameters of a statement
+    for i in range(0, len(global_ids), 500):
+        chunk = global_ids[i:i + 500]
+        c.execute("SELECT GlobalID FROM Written WHERE run = ? AND layer = ? AND GlobalID IN ({})".format(
+            ",".join("?" * len(chunk))), [journal[1], layer] + list(chunk))
+        written.update(row[0] for row in c.fetchall())
+    conn.close()
+    return written
+
+def count_written(journal, layer):
+    """
+    :param journal:                 (tuple) The journal database and the run, None if not used
+    :param layer:                   (string) The layer (tracks or assignments)
+    :return:                        (int) The number of features that were written by an earlier attempt of the run
+    """
+    if not journal:
+        return 0
+    conn = sqlite3.connect(journal[0])
+    c = conn.cursor()
+    c.execute("SELECT COUNT(*) FROM Written WHERE run = ? AND layer = ?", (journal[1], layer))
+    count = c.fetchone()[0]
+    conn.close()
+    return count
+
+def journal_edits(submit, journal, layer):
+    """
+    Wraps the function that submits a batch of edits so that the GlobalIDs of the features that were written are saved
+    in the journal as soon as each batch is written
+    :param submit:                  (function) Submits the adds and updates (lists of features), returning the response
+    :param journal:                 (tuple) The journal database and the run, None if not used
+    :param layer:                   (string) The layer (tracks or assignments)
+    :return:                        (function) The wrapped function
+    """
+    if not journal:
+        return submit
+
+    def submit_and_save(adds, updates):
+        response = submit(adds, updates)
+        global_ids = []
+        for features, results in [(adds, response.get("addResults") or []), (updates, response.get("updateResults") or [])]:
+            global_ids.extend(f["attributes"]["GlobalID"] for f, result in zip(features, results) if result.get("success"))
+        save_written(journal, layer, global_ids)
+        return response
+    return submit_and_save
+
 def read_from_source(gis, source_workforce_project_data, feature_option):
     '''
     :param gis:                         Authenticated GIS object
@@ -69,24 +235,52 @@ def read_from_source(gis, source_workforce_project_data, feature_option):
     source_features = features_fl.query().features
     return source_features
 
-def write_to_destination(gis, destination_workforce_project_data, feature_option, source_features):
+def get_features(features):
+    '''
+    :param features:                    List<dict> features written by featurewriter
+    :return:                            List<Feature> The Feature objects
+    '''
+    return [arcgis.features.Feature(geometry=feature.get("geometry"), attributes=feature["attributes"])
+            for feature in features]
+
+def write_to_destination(gis, destination_workforce_project_data, feature_option, source_features, threads=1, journal=None):
 
     '''
     :param gis:                         (GIS) Authenticated GIS object
     :param destination_workforce_project_data:      (string) destination project data
     :param feature_option:              (string) feature considered (workers, dispatchers or assignments)
     :param source_features:             List<dict> values from source
-    :return:                            void
+    :param threads:                     (int) The maximum number of batches to write at the same time
+    :param journal:                     (tuple) The journal database and the run, None if not used
+    :return:                            dict The destination OBJECTID of each source OBJECTID that was written (or, for
+                                        the workers and dispatchers, that is in the destination)
     '''
 
     logger = logging.getLogger()
     features_fl = arcgis.features.FeatureLayer(destination_workforce_project_data[feature_option]["url"], gis)
+    if feature_option in ["assignments", "tracks"]:
+        # Skip the features that were written by an earlier attempt (the workers and dispatchers are written again, as
+        # the OBJECTIDs of all of them are needed to relate the assignments)
+        written_global_ids = get_written(journal, feature_option, [f.attributes["GlobalID"] for f in source_features])
+        if written_global_ids:
+            logger.info("Skipping {} {} that were already written".format(len(written_global_ids), feature_option))
+            source_features = [f for f in source_features if f.attributes["GlobalID"] not in written_global_ids]
+    failed = 0
+    # The OBJECTIDs of the features that are updated are changed to the destination OBJECTIDs when they are filtered
+    source_oids = dict((id(f), f.attributes["OBJECTID"]) for f in source_features)
+    mapping_oid = {}
 
     # Validate/Filter each feature
     logger.info("Validating " + feature_option + "...")
 
     if feature_option == "workers" or feature_option == "dispatchers":
-        source_features_to_add, source_features_to_update = filter_by_user_id(gis, destination_workforce_project_data, feature_option, source_features)
+        source_features_to_add, source_features_to_update, destination_index = filter_by_user_id(
+            gis, destination_workforce_project_data, feature_option, source_features)
+        # Every source worker/dispatcher is mapped to the destination one with the same userId, including the ones whose
+        # users are no longer in the org (and so are not written), so that their assignments are still related to them
+        for f in source_features:
+            if f.attributes["userId"] in destination_index:
+                mapping_oid[source_oids[id(f)]] = destination_index[f.attributes["userId"]]
 
     if feature_option == "assignments" or feature_option == "tracks":
         source_features_to_add, source_features_to_update = filter_by_global_id(gis, destination_workforce_project_data, feature_option, source_features)
@@ -94,18 +288,33 @@ def write_to_destination(gis, destination_workforce_project_data, feature_option
     if source_features_to_update:
         logger.info("Updating " + feature_option + "...")
 
-        response = features_fl.edit_features(updates=arcgis.features.FeatureSet(source_features_to_update))
-        logger.info(response)
+        # The features are written in batches (bounded by count and size), and the ones that fail are retried one at a time
+        written = featurewriter.write_edits(
+            journal_edits(lambda adds, updates: features_fl.edit_features(updates=get_features(updates), rollback_on_failure=False),
+                          journal, feature_option),
+            ((i, "update", f.as_dict) for i, f in enumerate(source_features_to_update)), threads=threads)
+        failed += len(written["failed"])
+        logger.info("{} {} updated, {} failed".format(len(written["updated"]), feature_option, len(written["failed"])))
+    for f in source_features_to_update:
+        mapping_oid[source_oids[id(f)]] = f.attributes["OBJECTID"]
 
     if source_features_to_add:
         logger.info("Adding " + feature_option + "...")
 
-        response = features_fl.edit_features(adds=arcgis.features.FeatureSet(source_features_to_add), use_global_ids=True)
-        logger.info(response)
-
-        if feature_option == "workers" or feature_option == "dispatchers":
-            # Need to make sure the user is part of the workforce group
-            source_feature_ids = [f.attributes["userId"] for f in source_features_to_add]
+        # The adds keep the GlobalIDs of the source features, so they are sent separately from the updates
+        written = featurewriter.write_edits(
+            journal_edits(lambda adds, updates: features_fl.edit_features(adds=get_features(adds), use_global_ids=True,
+                                                                          rollback_on_failure=False),
+                          journal, feature_option),
+            ((i, "add", f.as_dict) for i, f in enumerate(source_features_to_add)), threads=threads)
+        failed += len(written["failed"])
+        logger.info("{} {} added, {} failed".format(len(written["added"]), feature_option, len(written["failed"])))
+        for i in written["added"]:
+            mapping_oid[source_oids[id(source_features_to_add[i])]] = written["results"][i].get("objectId")
+
+        if (feature_option == "workers" or feature_option == "dispatchers") and written["added"]:
+            # Need to make sure the user is part of the workforce group (only the users that were added)
+            source_feature_ids = [source_features_to_add[i].attributes["userId"] for i in sorted(written["added"])]
             group = arcgis.gis.Group(gis, destination_workforce_project_data["groupId"])
             logger.info("Adding " + feature_option + " to project group...")
             response = group.add_users(source_feature_ids)
@@ -113,6 +322,282 @@ def write_to_destination(gis, destination_workforce_project_data, feature_option
         logger.info("Completed")
     else:
         logger.info("There are no new and valid " + feature_option + " to add")
+    if not failed:
+        # A stage with failed features is written again by the next attempt
+        save_mapping(journal, feature_option, mapping_oid)
+        complete_stage(journal, feature_option)
+    return mapping_oid
+
+def copy_layer(gis, destination_workforce_project_data, feature_option, source_features, threads=1, journal=None):
+    '''
+    Writes the features of a layer as soon as they are read
+    :param gis:                         (GIS) Authenticated GIS object
+    :param destination_workforce_project_data:      (string) destination project data
+    :param feature_option:              (string) feature considered (workers, dispatchers or tracks)
+    :param source_features:             Future<List<Feature>> The read of the source features
+    :param threads:                     (int) The maximum number of batches to write at the same time
+    :param journal:                     (tuple) The journal database and the run, None if not used
+    :return:                            dict The destination OBJECTID of each source OBJECTID that was written
+    '''
+    return write_to_destination(gis, destination_workforce_project_data, feature_option, source_features.result(), threads,
+                                journal)
+
+def copy_assignments(gis, destination_workforce_project_data, source_assignments, worker_oids, dispatcher_oids, threads=1,
+                     journal=None):
+    '''
+    Writes the assignments as soon as they are read and the workers and dispatchers are written
+    :param gis:                         (GIS) Authenticated GIS object
+    :param destination_workforce_project_data:      (string) destination project data
+    :param source_assignments:          Future<List<Feature>> The read of the source assignments
+    :param worker_oids:                 Future<dict> The write of the workers (destination OBJECTID of each source OBJECTID)
+    :param dispatcher_oids:             Future<dict> The write of the dispatchers
+    :param threads:                     (int) The maximum number of batches to write at the same time
+    :param journal:                     (tuple) The journal database and the run, None if not used
+    :return:                            dict The destination OBJECTID of each source OBJECTID that was written
+    '''
+    logger = logging.getLogger()
+    source_assignments = source_assignments.result()
+    if source_assignments:
+        source_assignments = copy_relationship(source_assignments, worker_oids.result(), dispatcher_oids.result())
+    else:
+        logger.info("Empty source assignments")
+        logger.info(source_assignments)
+    return write_to_destination(gis, destination_workforce_project_data, "assignments", source_assignments, threads, journal)
+
+def get_track_dates(source_fl):
+    '''
+    :param source_fl:                   (FeatureLayer) The source tracks
+    :return:                            tuple The first and last CreationDates of the tracks, None if there are no tracks
+    '''
+    statistics = [{"statisticType": statistic, "onStatisticField": "CreationDate", "outStatisticFieldName": statistic}
+                  for statistic in ["min", "max"]]
+    dates = source_fl.query(out_statistics=statistics).features
+    if not dates or dates[0].attributes["min"] is None:
+        return None
+    return dates[0].attributes["min"], dates[0].attributes["max"]
+
+def get_track_ranges(source_fl, start, end, max_tracks=MAX_TRACKS, counts=None):
+    '''
+    Splits the CreationDates of the tracks into ranges of up to max_tracks tracks (a day at most), using count queries
+    :param source_fl:                   (FeatureLayer) The source tracks
+    :param start:                       (int) The first CreationDate (milliseconds since the epoch)
+    :param end:                         (int) The last CreationDate (milliseconds since the epoch)
+    :param max_tracks:                  (int) The maximum number of tracks in a range
+    :param counts:                      List<tuple> The start, end and number of tracks of each count query are appended
+                                        to it, if provided (see plan_copy_tracks)
+    :return:                            generator<tuple> The start and end of each range (whole seconds, the end is exclusive)
+    '''
+    # The dates in the where clauses are in whole seconds
+    ranges = [(day, min(day + trackhelpers.DAY, end // 1000 * 1000 + 1000))
+              for day in range(start // 1000 * 1000, end + 1, trackhelpers.DAY)]
+    while ranges:
+        range_start, range_end = ranges.pop(0)
+        count = source_fl.query(where=get_track_range_query(range_start, range_end), return_count_only=True)
+        if counts is not None:
+            counts.append((range_start, range_end, count))
+        if count > max_tracks and range_end - range_start > 1000:
+            middle = (range_start + range_end) // 2000 * 1000
+            ranges[:0] = [(range_start, middle), (middle, range_end)]
+        elif count:
+            yield range_start, range_end
+
+def get_track_range_query(start, end):
+    '''
+    :param start:                       (int) The start of the range (milliseconds since the epoch)
+    :param end:                         (int) The end of the range (exclusive)
+    :return:                            (string) The where clause that selects the tracks in the range
+    '''
+    return "CreationDate >= '{}' AND CreationDate < '{}'".format(trackhelpers.format_query_date(start),
+                                                                 trackhelpers.format_query_date(end))
+
+def get_destination_global_ids(destination_fl, global_ids, chunk_size=500):
+    '''
+    Gets the GlobalIDs (of a range of tracks) that are already in the destination
+    :param destination_fl:              (FeatureLayer) The destination tracks
+    :param global_ids:                  List<string> The GlobalIDs of the source tracks
+    :param chunk_size:                  (int) The number of GlobalIDs to query at a time
+    :return:                            set<string> The GlobalIDs that are in the destination
+    '''
+    existing = set()
+    for i in range(0, len(global_ids), chunk_size):
+        where = "GlobalID IN ({})".format(",".join("'{}'".format(g) for g in global_ids[i:i + chunk_size]))
+        features = destination_fl.query(where=where, out_fields="GlobalID", return_geometry=False).features
+        existing.update(f.attributes["GlobalID"] for f in features)
+    return existing
+
+def get_track_edits(source_fl, destination_fl, ranges, journal=None):
+    '''
+    Reads the tracks one range at a time, and gets the adds of the tracks that are not in the destination and the
+    updates of the ones that are
+    :param source_fl:                   (FeatureLayer) The source tracks
+    :param destination_fl:              (FeatureLayer) The destination tracks
+    :param ranges:                      iterable<tuple> The ranges of CreationDates (from get_track_ranges)
+    :param journal:                     (tuple) The journal database and the run, None if not used
+    :return:                            generator<tuple> The edits (GlobalID, "add" or "update" and the track)
+    '''
+    logger = logging.getLogger()
+    for range_start, range_end in ranges:
+        tracks = source_fl.query(where=get_track_range_query(range_start, range_end)).features
+        # Skip the tracks that were written by an earlier attempt
+        written = get_written(journal, "tracks", [t.attributes["GlobalID"] for t in tracks])
+        tracks = [t for t in tracks if t.attributes["GlobalID"] not in written]
+        existing = get_destination_global_ids(destination_fl, [t.attributes["GlobalID"] for t in tracks])
+        logger.debug("Read {} tracks from {} ({} already copied)".format(
+            len(tracks), trackhelpers.format_query_date(range_start), len(existing)))
+        for track in tracks:
+            yield track.attributes["GlobalID"], "update" if track.attributes["GlobalID"] in existing else "add", track.as_dict
+
+def copy_tracks(gis, source_workforce_project_data, destination_workforce_project_data, threads=1, max_tracks=MAX_TRACKS,
+                journal=None):
+    '''
+    Copies the tracks a range of CreationDates at a time, so that only a range of tracks (and a few batches of edits)
+    are held in memory, however many tracks there are. The tracks are added or updated by GlobalID
+    :param gis:                         (GIS) Authenticated GIS object
+    :param source_workforce_project_data:       (string) source project data
+    :param destination_workforce_project_data:  (string) destination project data
+    :param threads:                     (int) The maximum number of batches to write at the same time
+    :param max_tracks:                  (int) The maximum number of tracks to read at a time
+    :param journal:                     (tuple) The journal database and the run, None if not used
+    :return:                            dict The GlobalIDs that were added, updated, or failed
+    '''
+    logger = logging.getLogger()
+    source_fl = arcgis.features.FeatureLayer(source_workforce_project_data["tracks"]["url"], gis)
+    destination_fl = arcgis.features.FeatureLayer(destination_workforce_project_data["tracks"]["url"], gis)
+    dates = get_track_dates(source_fl)
+    if not dates:
+        logger.info("There are no tracks to copy")
+        complete_stage(journal, "tracks")
+        return {"added": [], "updated": [], "failed": [], "results": {}}
+    logger.info("Copying tracks...")
+    ranges = get_track_ranges(source_fl, dates[0], dates[1], max_tracks)
+    written = featurewriter.write_edits(
+        journal_edits(lambda adds, updates: destination_fl.edit_features(adds=get_features(adds), updates=get_features(updates),
+                                                                         use_global_ids=True, rollback_on_failure=False),
+                      journal, "tracks"),
+        get_track_edits(source_fl, destination_fl, ranges, journal), threads=threads)
+    logger.info("{} tracks added, {} updated, {} failed".format(len(written["added"]), len(written["updated"]),
+                                                                len(written["failed"])))
+    if not written["failed"]:
+        complete_stage(journal, "tracks")
+    return written
+
+def plan_copy_tracks(source_fl, max_tracks=MAX_TRACKS, chunk_size=500):
+    '''
+    Estimates the reads of copying the tracks, by splitting their CreationDates into ranges the same way copy_tracks
+    does (with count queries)
+    :param source_fl:                   (FeatureLayer) The source tracks
+    :param max_tracks:                  (int) The maximum number of tracks in a range
+    :param chunk_size:                  (int) The number of GlobalIDs queried in the destination at a time
+    :return:                            (int), (int) The number of reads and the number of ranges
+    '''
+    dates = get_track_dates(source_fl)
+    if not dates:
+        return 1, 0
+    counts = []
+    ranges = list(get_track_ranges(source_fl, dates[0], dates[1], max_tracks, counts))
+    range_counts = dict(((range_start, range_end), count) for range_start, range_end, count in counts)
+    # The statistics query, the count queries, and for each range: reading its tracks and querying the destination
+    # for their GlobalIDs (a chunk at a time)
+    reads = 1 + len(counts)
+    for track_range in ranges:
+        reads += 1 + (range_counts[track_range] + chunk_size - 1) // chunk_size
+    return reads, len(ranges)
+
+def plan_copy_project(gis, source_workforce_project_data, destination_workforce_project_data, journal=None):
+    """
+    Estimates the cost of copying the project, using count queries (and a small sample of features). When the copy is
+    resumed from a journal, the completed stages and the features that were already written are left out
+    :param gis:                     (GIS) Authenticated GIS object
+    :param source_workforce_project_data:       (string) source project data
+    :param destination_workforce_project_data:  (string) destination project data
+    :param journal:                 (tuple) The journal database and the run, None if not used
+    :return:                        List<tuple> The plan
+    """
+    completed = get_completed_stages(journal)
+    plan = []
+    if completed:
+        plan.append(("Resuming", "the completed stages are skipped: {}".format(", ".join(sorted(completed)))))
+    reads = 1
+    writes = 0
+    track_ranges = 0
+    for feature_option in ["workers", "dispatchers", "tracks", "assignments"]:
+        if feature_option in completed:
+            plan.append((feature_option, "already copied"))
+            continue
+        source_fl = arcgis.features.FeatureLayer(source_workforce_project_data[feature_option]["url"], gis)
+        destination_fl = arcgis.features.FeatureLayer(destination_workforce_project_data[feature_option]["url"], gis)
+        source_count = source_fl.query(return_count_only=True)
+        destination_count = destination_fl.query(return_count_only=True)
+        # The tracks and assignments that were written by an earlier attempt are not written again (the workers and
+        # dispatchers are)
+        written = count_written(journal, feature_option) if feature_option in ["tracks", "assignments"] else 0
+        to_write = max(source_count - written, 0)
+        # The features that are written are the same size as the source features
+        sample = source_fl.query(result_record_count=10).features if source_count else []
+        feature_size = sum(len(json.dumps(f.as_dict)) for f in sample) // len(sample) if sample else 0
+        plan.append((feature_option, "{} source, {} destination, {}up to {} to write (about {} bytes per feature)".format(
+            source_count, destination_count, "{} already written, ".format(written) if written else "", to_write,
+            feature_size)))
+        if feature_option == "tracks":
+            # The tracks are streamed a range of CreationDates at a time, and only matched by GlobalID in the destination
+            track_reads, track_ranges = plan_copy_tracks(source_fl)
+            reads += track_reads
+        else:
+            # Reading the source and destination features
+            reads += 2
+        if to_write:
+            # The adds and the updates are written in batches of up to 500 features (or 2 MB)
+            writes += max((to_write + featurewriter.MAX_COUNT - 1) // featurewriter.MAX_COUNT,
+                          (to_write * feature_size + featurewriter.MAX_BYTES - 1) // featurewriter.MAX_BYTES) + 1
+        if feature_option in ["workers", "dispatchers"]:
+            # One user search per batch of source features, and adding the users to the project group
+            reads += (source_count + userdirectory.BATCH_SIZE - 1) // userdirectory.BATCH_SIZE
+            writes += 1
+    # The assignment types, project and web maps
+    for stage, stage_writes in [("assignmentTypes", 1), ("integrations", 1), ("webMaps", 4)]:
+        if stage not in completed:
+            writes += stage_writes
+    plan.append(("Requests", "about {} reads and {} writes".format(reads, writes)))
+    if "tracks" not in completed:
+        plan.append(("Tracks", "streamed in {} ranges of CreationDates (of up to {} tracks, a day at most)".format(
+            track_ranges, MAX_TRACKS)))
+    # The tracks are streamed while the other layers are read, and each layer is written as soon as it can be
+    plan.append(("Stages", "stream the tracks (read, match and write a range at a time) while reading the workers, "
+                           "dispatchers and assignments; write the workers and dispatchers as soon as they are read, "
+                           "and the assignments once the workers and dispatchers are written"))
+    return plan
+
+def index_features(features, field):
+    """
+    Indexes features by the value of a field, so that they are matched with a single lookup
+    :param features:                List<Feature> The features to index
+    :param field:                   (string) The field to index the features by (GlobalID or userId)
+    :return:                        dict The OBJECTID of the (first) feature with each value of the field
+    """
+    index = {}
+    for feature in features:
+        index.setdefault(feature.attributes[field], feature.attributes["OBJECTID"])
+    return index
+
+def match_features(source_features, destination_index, field):
+    """
+    Splits the source features into the ones that are new and the ones that are already in the destination (the
+    OBJECTID of which is set to the OBJECTID of the destination feature)
+    :param source_features:         List<Feature> The source features
+    :param destination_index:       dict The destination features (from index_features)
+    :param field:                   (string) The field the features are matched by (GlobalID or userId)
+    :return:                        List<Feature>, List<Feature> The features to add and the features to update
+    """
+    features_to_add = []
+    features_to_update = []
+    for source_feature in source_features:
+        object_id = destination_index.get(source_feature.attributes[field])
+        if object_id is None:
+            features_to_add.append(source_feature)
+        else:
+            source_feature.attributes["OBJECTID"] = object_id
+            features_to_update.append(source_feature)
+    return features_to_add, features_to_update
 
 def filter_by_global_id(gis, destination_workforce_project_data, feature_option, source_features):
     """
@@ -128,19 +613,8 @@ def filter_by_global_id(gis, destination_workforce_project_data, feature_option,
     logger = logging.getLogger()
     destination_features = arcgis.features.FeatureLayer(destination_workforce_project_data[feature_option]["url"], gis).query().features
 
-    features_to_add = []
-    features_to_update = []
-    for source_feature in source_features:
-        to_add_flag = True
-        for f in destination_features:
-            if source_feature.attributes["GlobalID"] == f.attributes["GlobalID"]:
-                source_feature.attributes["OBJECTID"] = f.attributes["OBJECTID"]
-                features_to_update.append(source_feature)
-                to_add_flag = False
-                break
-        if to_add_flag:
-            features_to_add.append(source_feature)
-    return features_to_add, features_to_update
+    # Index the destination features once, rather than searching them for every source feature
+    return match_features(source_features, index_features(destination_features, "GlobalID"), "GlobalID")
 
 def filter_by_user_id(gis, destination_workforce_project_data, feature_option, source_features):
     """
@@ -149,79 +623,60 @@ def filter_by_user_id(gis, destination_workforce_project_data, feature_option, s
     :param destination_workforce_project_data:  (string) destination project data
     :param feature_option:          (string) feature considered (workers, dispatchers or assignments)
     :param source_features:         List<dict> The users to add
-    :return:                        List<dict> The list of users to add
+    :return:                        List<dict>, List<dict>, dict The users to add, the users to update and the OBJECTID
+                                    of the destination feature of each userId (from index_features)
     """
 
     # Grab the item
     logger = logging.getLogger()
     destination_features = arcgis.features.FeatureLayer(destination_workforce_project_data[feature_option]["url"], gis).query().features
+    destination_index = index_features(destination_features, "userId")
 
-    features_to_add = []
-    features_to_update = []
+    # Look up all of the users at once (in batches), the results are kept for later checks
+    users = userdirectory.find_users(lambda query: search_users(gis, query), gis.url,
+                                     [source_feature.attributes["userId"] for source_feature in source_features])
+    valid_features = []
     for source_feature in source_features:
-        if not user_exists(gis, source_feature.attributes["userId"]):
+        if source_feature.attributes["userId"] not in users:
             logger.warning("User '{}' does not exist in your org and will not be added".format(source_feature.attributes["userId"]))
         else:
-            to_add_flag = True
-            for f in destination_features:
-                if source_feature.attributes["userId"] == f.attributes["userId"]:
-                    source_feature.attributes["OBJECTID"] = f.attributes["OBJECTID"]
-                    features_to_update.append(source_feature)
-                    to_add_flag = False
-                    break
-            if to_add_flag:
-                features_to_add.append(source_feature)
-    return features_to_add, features_to_update
+            valid_features.append(source_feature)
+    # Index the destination features once, rather than searching them for every source feature
+    features_to_add, features_to_update = match_features(valid_features, destination_index, "userId")
+    return features_to_add, features_to_update, destination_index
 
-def user_exists(gis, username):
+def search_users(gis, query):
     """
-    Searchs the organization/portal to see if a user exists
+    Searches the organization/portal for users
     :param gis:                     (GIS) The gis to use for searching
-    :param username:                (string) The username to search for
-    :return:                        True if user exists, False if not
+    :param query:                   (string) The query (ex. from userdirectory.get_user_query)
+    :return:                        List<string> The usernames of the users that were found
     """
     user_manager = arcgis.gis.UserManager(gis)
-    users = user_manager.search(query=username)
-    return username in [x["username"] for x in users]
-
-def copy_relationship(gis, source_workforce_project_data, destination_workforce_project_data, source_assignments):
+    # A username can also match similar usernames, so more users than were searched for can be returned. The results
+    # are capped at max_users, so the search is repeated with a larger cap until all of the results are returned
+    max_users = 1000
+    users = user_manager.search(query=query, max_users=max_users)
+    while len(users) >= max_users:
+        max_users *= 4
+        users = user_manager.search(query=query, max_users=max_users)
+    return [x["username"] for x in users]
+
+def copy_relationship(source_assignments, worker_oids, dispatcher_oids):
     """
-    Ensures the assignment is not already added
-    :param gis:                     (GIS) Authenticated GIS object
-    :param source_workforce_project_data:       (string) source project data
-    :param destination_workforce_project_data:  (string) destination project data
+    Relates the assignments to the destination workers and dispatchers
     :param source_assignments:      List<dict> source assignments
+    :param worker_oids:             dict The destination OBJECTID of each source worker (from write_to_destination)
+    :param dispatcher_oids:         dict The destination OBJECTID of each source dispatcher (from write_to_destination)
     :return:                        List<dict> The list of assignments to add
     """
-
-    source_workers = arcgis.features.FeatureLayer(source_workforce_project_data["workers"]["url"], gis).query().features
-    destination_workers = arcgis.features.FeatureLayer(destination_workforce_project_data["workers"]["url"], gis).query().features
-
-    mapping_oid = {}
-
-    for source_worker in source_workers:
-        for destination_worker in destination_workers:
-            if destination_worker.attributes["userId"] == source_worker.attributes["userId"]:
-                mapping_oid[source_worker.attributes["OBJECTID"]] = destination_worker.attributes["OBJECTID"]
-
-    for source_assignment in source_assignments:
-        if source_assignment.attributes["workerId"]:
-            source_assignment.attributes["workerId"] = mapping_oid[source_assignment.attributes["workerId"]]
-
-
-    source_dispatchers = arcgis.features.FeatureLayer(source_workforce_project_data["dispatchers"]["url"], gis).query().features
-    destination_dispatchers = arcgis.features.FeatureLayer(destination_workforce_project_data["dispatchers"]["url"], gis).query().features
-
-    mapping_oid = {}
-
-    for source_dispatcher in source_dispatchers:
-        for destination_dispatcher in destination_dispatchers:
-            if destination_dispatcher.attributes["userId"] == source_dispatcher.attributes["userId"]:
-                mapping_oid[source_dispatcher.attributes["OBJECTID"]] = destination_dispatcher.attributes["OBJECTID"]
-
-    for source_assignment in source_assignments:
-        if source_assignment.attributes["dispatcherId"]:
-            source_assignment.attributes["dispatcherId"] = mapping_oid[source_assignment.attributes["dispatcherId"]]
+    logger = logging.getLogger()
+    for field, mapping_oid in [("workerId", worker_oids), ("dispatcherId", dispatcher_oids)]:
+        for source_assignment in source_assignments:
+            if source_assignment.attributes[field]:
+                if source_assignment.attributes[field] not in mapping_oid:
+                    logger.warning("The {} of assignment {} was not copied".format(field, source_assignment.attributes["GlobalID"]))
+                source_assignment.attributes[field] = mapping_oid.get(source_assignment.attributes[field])
 
     return source_assignments
 
@@ -275,70 +730,115 @@ def main(args):
     logger.info("Connecting to source project")
     source_workforce_project_data = source_workforce_project.get_data()
 
-    # Reading Assignment Types from source
-    source_assignments_fl = arcgis.features.FeatureLayer(source_workforce_project_data["assignments"]["url"], gis)
-    source_assignment_type_definition = source_assignments_fl.query().fields
-
-    source_assignment_type_flag = False
-    if type(source_assignment_type_definition)==list:
-        for field in source_assignment_type_definition:
-            if field["name"] == "assignmentType":
-                source_assignment_type_flag = True
-                source_assignment_type_definition = field
-
-
-    # Extracting different features from source
-    source_workers = read_from_source(gis, source_workforce_project_data, "workers")
-    source_dispatchers = read_from_source(gis, source_workforce_project_data, "dispatchers")
-    source_tracks = read_from_source(gis, source_workforce_project_data, "tracks")
-    source_assignments = read_from_source(gis, source_workforce_project_data, "assignments")
-
-    source_worker_web_map_item = gis.content.get(source_workforce_project_data["workerWebMapId"])
-    source_worker_web_map_item_extent = source_worker_web_map_item.extent
-    source_worker_web_map_obj = arcgis.mapping.WebMap(source_worker_web_map_item)
-
-    source_dispatcher_web_map_item = gis.content.get(source_workforce_project_data["dispatcherWebMapId"])
-    source_dispatcher_web_map_item_extent = source_dispatcher_web_map_item.extent
-    source_dispatcher_web_map_obj = arcgis.mapping.WebMap(source_dispatcher_web_map_item)
-
-    #Get the destination project and data
-    destination_workforce_project = arcgis.gis.Item(gis, args.destination_project_id)
-    logger.info("Connecting to destination project")
-    destination_workforce_project_data = destination_workforce_project.get_data()
-
-    # Writing Assignment Types to destination
-    logger.info("Copying Assignment Types...")
-    if source_assignment_type_flag:
-        url = destination_workforce_project_data["assignments"]["url"]
-        url = url.replace("rest/services", "rest/admin/services") + "/updateDefinition"
-
-        updateDefinition = {"fields":[source_assignment_type_definition]}
-        updateDefinition = json.dumps(updateDefinition)
-
-        data = {"updateDefinition": updateDefinition, "token": token, "f": "json"}
-        response = requests.post(url = url, data = data)
-        logger.info(response.json())
-
-    # Writing Features to destination
-    write_to_destination(gis, destination_workforce_project_data, "workers", source_workers)
-    write_to_destination(gis, destination_workforce_project_data, "dispatchers", source_dispatchers)
-    write_to_destination(gis, destination_workforce_project_data, "tracks", source_tracks)
-
-    if source_assignments:
-        source_assignments = copy_relationship(gis, source_workforce_project_data, destination_workforce_project_data, source_assignments)
-    else:
-        logger.info("Empty source assignments")
-        logger.info(source_assignments)
-    write_to_destination(gis, destination_workforce_project_data, "assignments", source_assignments)
+    # The stages that were completed by an earlier attempt of this copy are skipped (a plan only reads an existing journal)
+    journal = None
+    if args.journal and (not args.plan or os.path.exists(args.journal)):
+        initialize_journal(args.journal)
+        journal = (args.journal, "{}:{}".format(args.source_project_id, args.destination_project_id))
+
+    if args.plan:
+        # Only count queries are used, nothing is read in full or written
+        logger.info("Planning...")
+        destination_workforce_project_data = arcgis.gis.Item(gis, args.destination_project_id).get_data()
+        logger.info("Plan (nothing has been changed):")
+        for label, value in plan_copy_project(gis, source_workforce_project_data, destination_workforce_project_data,
+                                              journal):
+            logger.info("    {}: {}".format(label, value))
+        return
+
+    completed = get_completed_stages(journal)
+    if completed:
+        logger.info("Resuming the copy, skipping the completed stages: {}".format(", ".join(sorted(completed))))
+
+    # The layers are copied as a graph of tasks: the layers are read at the same time, the workers and dispatchers are
+    # written as soon as they are read (while the tracks are streamed), and the assignments are written as soon as the
+    # workers and dispatchers are written (the assignments are related to their destination OBJECTIDs)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_TASKS)
+    try:
+        # Extracting different features from source
+        reads = dict((feature_option, executor.submit(read_from_source, gis, source_workforce_project_data, feature_option))
+                     for feature_option in ["workers", "dispatchers", "assignments"] if feature_option not in completed)
+
+        # Reading Assignment Types from source
+        source_assignments_fl = arcgis.features.FeatureLayer(source_workforce_project_data["assignments"]["url"], gis)
+        source_assignment_type_definition = source_assignments_fl.properties.fields
+
+        source_assignment_type_flag = False
+        if type(source_assignment_type_definition)==list:
+            for field in source_assignment_type_definition:
+                if field["name"] == "assignmentType":
+                    source_assignment_type_flag = True
+                    source_assignment_type_definition = dict(field)
+
+        source_worker_web_map_item = gis.content.get(source_workforce_project_data["workerWebMapId"])
+        source_worker_web_map_item_extent = source_worker_web_map_item.extent
+        source_worker_web_map_obj = arcgis.mapping.WebMap(source_worker_web_map_item)
+
+        source_dispatcher_web_map_item = gis.content.get(source_workforce_project_data["dispatcherWebMapId"])
+        source_dispatcher_web_map_item_extent = source_dispatcher_web_map_item.extent
+        source_dispatcher_web_map_obj = arcgis.mapping.WebMap(source_dispatcher_web_map_item)
+
+        #Get the destination project and data
+        destination_workforce_project = arcgis.gis.Item(gis, args.destination_project_id)
+        logger.info("Connecting to destination project")
+        destination_workforce_project_data = destination_workforce_project.get_data()
+
+        # Writing Features to destination (the OBJECTIDs of the workers and dispatchers that were copied by an earlier
+        # attempt are read from the journal)
+        writes = {}
+        for feature_option in ["workers", "dispatchers"]:
+            if feature_option in completed:
+                writes[feature_option] = executor.submit(get_mapping, journal, feature_option)
+            else:
+                writes[feature_option] = executor.submit(copy_layer, gis, destination_workforce_project_data, feature_option,
+                                                         reads[feature_option], args.threads, journal)
+        # The tracks are streamed (read and written a range at a time), as there can be millions of them
+        if "tracks" not in completed:
+            writes["tracks"] = executor.submit(copy_tracks, gis, source_workforce_project_data,
+                                               destination_workforce_project_data, args.threads, MAX_TRACKS, journal)
+
+        # Writing Assignment Types to destination (before the assignments are written)
+        if "assignmentTypes" not in completed:
+            logger.info("Copying Assignment Types...")
+        if source_assignment_type_flag and "assignmentTypes" not in completed:
+            url = destination_workforce_project_data["assignments"]["url"]
+            url = url.replace("rest/services", "rest/admin/services") + "/updateDefinition"
+
+            updateDefinition = {"fields":[source_assignment_type_definition]}
+            updateDefinition = json.dumps(updateDefinition)
+
+            data = {"updateDefinition": updateDefinition, "token": token, "f": "json"}
+            response = requests.post(url = url, data = data)
+            logger.info(response.json())
+            if "error" not in response.json():
+                complete_stage(journal, "assignmentTypes")
+        elif "assignmentTypes" not in completed:
+            complete_stage(journal, "assignmentTypes")
+
+        if "assignments" not in completed:
+            writes["assignments"] = executor.submit(copy_assignments, gis, destination_workforce_project_data,
+                                                    reads["assignments"], writes["workers"], writes["dispatchers"],
+                                                    args.threads, journal)
+        # Wait for all of the layers to be written (any error is raised here)
+        for feature_option in ["workers", "dispatchers", "tracks", "assignments"]:
+            if feature_option in writes:
+                writes[feature_option].result()
+    finally:
+        executor.shutdown(wait=True)
 
     # Copyting Assignment Integrations to destination and enabling/disabling tracking
-    logger.info("Copying Assignment Integrations...")
-    destination_workforce_project_data["assignmentIntegrations"] = source_workforce_project_data["assignmentIntegrations"]
-    destination_workforce_project_data["tracks"]["enabled"] = source_workforce_project_data["tracks"]["enabled"]
-    destination_workforce_project_data["tracks"]["updateInterval"] = source_workforce_project_data["tracks"]["updateInterval"]
-    status = destination_workforce_project.update(item_properties={"text":json.dumps(destination_workforce_project_data)})
-    logger.info("Copying Assignment Integrations Status: " + str(status))
-
+    if "integrations" not in completed:
+        logger.info("Copying Assignment Integrations...")
+        destination_workforce_project_data["assignmentIntegrations"] = source_workforce_project_data["assignmentIntegrations"]
+        destination_workforce_project_data["tracks"]["enabled"] = source_workforce_project_data["tracks"]["enabled"]
+        destination_workforce_project_data["tracks"]["updateInterval"] = source_workforce_project_data["tracks"]["updateInterval"]
+        status = destination_workforce_project.update(item_properties={"text":json.dumps(destination_workforce_project_data)})
+        logger.info("Copying Assignment Integrations Status: " + str(status))
+        if status:
+            complete_stage(journal, "integrations")
+
+    if "webMaps" in completed:
+        return
 
     # Copying Web Maps
     logger.info("Copying Web Maps")
@@ -356,6 +856,7 @@ def main(args):
 
     destination_dispatcher_web_map_obj = edit_web_map_obj(source_dispatcher_web_map_obj, destination_dispatcher_web_map_obj, source_workforce_project_data, destination_workforce_project_data)
     destination_dispatcher_web_map_obj.update()
+    complete_stage(journal, "webMaps")
 
 
 
@@ -369,6 +870,13 @@ if __name__ == "__main__":
     parser.add_argument('-spid', dest='source_project_id', help='The id of the source project', required=True)
     parser.add_argument('-dpid', dest='destination_project_id', help='The id of the destination project', required=True)
     parser.add_argument('-logFile', dest='logFile', help='The log file to use', default="log.txt")
+    parser.add_argument('-plan', dest='plan', action='store_true',
+                        help="Only report what would be copied and how many requests it would take")
+    parser.add_argument('-threads', dest='threads', type=int, default=1,
+                        help="The maximum number of requests to send at the same time")
+    parser.add_argument('-journal', dest='journal', default=None,
+                        help="The SQLite database to record the completed stages of the copy in, so that running it again "
+                             "resumes from the stage that failed")
     args = parser.parse_args()
     try:
         main(args)
@@ -31,6 +31,7 @@ import os
 import sys
 import traceback
 import arcgis
+import userdirectory
 
 
 def get_workers_from_csv(csvFile, name_field="name", status_field="status", user_id_field="userId", title_field=None, contact_number_field=None):
@@ -66,16 +67,22 @@ def get_workers_from_csv(csvFile, name_field="name", status_field="status", user
     return new_workers
 
 
-def user_exists(gis, username):
+def search_users(gis, query):
     """
-    Searchs the organization/portal to see if a user exists
+    Searches the organization/portal for users
     :param gis: (GIS) The gis to use for searching
-    :param username: (string) The username to search for
-    :return: True if user exists, False if not
+    :param query: (string) The query (ex. from userdirectory.get_user_query)
+    :return: List<string> The usernames of the users that were found
     """
     user_manager = arcgis.gis.UserManager(gis)
-    users = user_manager.search(query=username)
-    return username in [x["username"] for x in users]
+    # A username can also match similar usernames, so more users than were searched for can be returned. The results
+    # are capped at max_users, so the search is repeated with a larger cap until all of the results are returned
+    max_users = 1000
+    users = user_manager.search(query=query, max_users=max_users)
+    while len(users) >= max_users:
+        max_users *= 4
+        users = user_manager.search(query=query, max_users=max_users)
+    return [x["username"] for x in users]
 
 
 def filter_workers(gis, project, workers):
@@ -90,11 +97,15 @@ def filter_workers(gis, project, workers):
     logger = logging.getLogger()
     workers_in_fs = arcgis.features.FeatureLayer(project["workers"]["url"], gis).query().features
 
+    # Look up all of the users at once (in batches), rather than searching for each worker
+    users = userdirectory.find_users(lambda query: search_users(gis, query), gis.url,
+                                     [worker.attributes["userId"] for worker in workers])
+    worker_ids_in_fs = set(w.attributes["userId"] for w in workers_in_fs)
     workers_to_add = []
     for worker in workers:
-        if not user_exists(gis, worker.attributes["userId"]):
+        if worker.attributes["userId"] not in users:
             logger.warning("User '{}' does not exist in your org and will not be added".format(worker.attributes["userId"]))
-        elif worker.attributes["userId"] in [w.attributes["userId"] for w in workers_in_fs]:
+        elif worker.attributes["userId"] in worker_ids_in_fs:
             logger.warning("User '{}' is already part of this project and will not be added".format(worker.attributes["userId"]))
         else:
             workers_to_add.append(worker)
@@ -25,60 +25,104 @@
 """
 import arcrest
 import argparse
-import datetime
 import json
 import logging
 import logging.handlers
-import math
+import time
 import traceback
+from multiprocessing.pool import ThreadPool
+import featurewriter
+import fieldmapper
+import trackhelpers
 import workforcehelpers
 
 
-def copy_assignments(source_fl, target_fl, field_mappings, where="1=1"):
+def get_copied_global_ids(target_fl, global_id_field, global_ids, chunk_size=500):
+    """
+    Gets which of the provided GlobalIDs are already in the target feature layer. Only the provided GlobalIDs are
+    queried (a chunk at a time), rather than every feature of the target
+    :param target_fl: (ArcREST Feature Layer Object) The target layer
+    :param global_id_field: (string) The field of the target that stores the original GlobalID
+    :param global_ids: (list<string>) The GlobalIDs to look for
+    :param chunk_size: (int) The number of GlobalIDs to query at a time
+    :return: (set<string>) The GlobalIDs that are already copied
+    """
+    copied = set()
+    for chunk in workforcehelpers.chunk_list(global_ids, chunk_size):
+        where = "{} IN ({})".format(global_id_field, ",".join("'{}'".format(global_id) for global_id in chunk))
+        for page in workforcehelpers.query_feature_layer_pages(target_fl, where=where, out_fields=global_id_field):
+            copied.update(feature["attributes"][global_id_field] for feature in page)
+    return copied
+
+
+def find_copied(target_fl, global_id_field, features):
+    """
+    Gets which of the (mapped) features are already in the target feature layer, by the field the GlobalID of the
+    assignment is copied to. Used to check the adds of a request that raised before they are retried
+    :param target_fl: (ArcREST Feature Layer Object) The target layer
+    :param global_id_field: (string) The field of the target that stores the original GlobalID
+    :param features: (list<dict>) The features that were added
+    :return: (set<int>) The indexes of the features that are in the target
+    """
+    copied = get_copied_global_ids(target_fl, global_id_field,
+                                   [feature["attributes"][global_id_field] for feature in features])
+    return set(i for i, feature in enumerate(features) if feature["attributes"][global_id_field] in copied)
+
+
+def get_copy_edits(source_fl, target_fl, field_mappings, oids, map_page, copied_oids, page_size=500):
+    """
+    Gets the adds of the assignments that are not already in the target feature layer, a page of OBJECTIDs at a time
+    :param source_fl: (ArcREST Feature Layer Object) The layer to get the assignments from
+    :param target_fl: (ArcREST Feature Layer Object) The layer copy the assignments to
+    :param field_mappings: (dictionary) The mapping of the assignment field to the archive fields
+    :param oids: (list<int>) The OBJECTIDs of the assignments to copy
+    :param map_page: (function) The compiled field mappings
+    :param copied_oids: (list<int>) The OBJECTIDs of the assignments that are already copied are added to this list
+    :param page_size: (int) The number of assignments to query at a time
+    :return: (generator<tuple>) The edits (OBJECTID of the assignment, "add" and the feature to add)
+    """
+    for page_oids in workforcehelpers.chunk_list(oids, page_size):
+        assignments = [assignment.asDictionary for assignment in
+                       source_fl.query(where="OBJECTID in ({})".format(",".join(str(oid) for oid in page_oids)),
+                                       out_fields="*", outSR=target_fl.extent["spatialReference"]["wkid"]).features]
+        copied = get_copied_global_ids(target_fl, field_mappings["GlobalID"],
+                                       [assignment["attributes"]["GlobalID"] for assignment in assignments])
+        copied_oids.extend(a["attributes"]["OBJECTID"] for a in assignments if a["attributes"]["GlobalID"] in copied)
+        assignments_to_copy = [a for a in assignments if a["attributes"]["GlobalID"] not in copied]
+        # Map the fields of the assignments to the fields of the target (the whole page at once)
+        mapped_attributes = map_page([assignment["attributes"] for assignment in assignments_to_copy])
+        for assignment, attributes in zip(assignments_to_copy, mapped_attributes):
+            yield assignment["attributes"]["OBJECTID"], "add", {'geometry': assignment["geometry"],
+                                                                'attributes': attributes}
+
+
+def copy_assignments(source_fl, target_fl, field_mappings, oids, batch_size=500, threads=1, map_page=None):
     """
     This copies assignments (features) from the target feature layer to the source layer, based on the provided field
-    mappings and query to select the assignments to copy over.
+    mappings and the OBJECTIDs of the assignments to copy over.
 
-    The assignments are checked (via GlobalID) to see if they already exist in the target feature layer, if not they
-    are then added
+    The GlobalIDs of each page of assignments are checked to see if they already exist in the target feature layer,
+    and only the ones that don't are added, in batches of up to batch_size assignments, up to "threads" batches at the
+    same time
     :param source_fl: (ArcREST Feature Layer Object) The layer to get the assignments from
     :param target_fl: (ArcREST Feature Layer Object) The layer copy the assignments to
     :param field_mappings: (dictionary) The mapping of the assignment field to the archive fields
-    :param where: (string) The where clause to use to query
-    :return:
+    :param oids: (list<int>) The OBJECTIDs of the assignments to copy
+    :param batch_size: (int) The maximum number of assignments to copy per request
+    :param threads: (int) The maximum number of batches to copy at the same time
+    :param map_page: (function) The compiled field mappings (compiled from field_mappings if not provided)
+    :return: (dict) The OBJECTIDs that were added, already copied, or failed to be added
     """
-    # Query the source to get the features specified by the query string
-    logging.getLogger().debug("Querying source features...")
-    current_assignments = source_fl.query(where=where, out_fields="*",
-                                          outSR=target_fl.extent["spatialReference"]["wkid"]).features
-    # Query the archived assignments to get all of the currently archived ones
-    logging.getLogger().debug("Querying target features")
-    archived_assignments = target_fl.query(where="1=1", out_fields=field_mappings["GlobalID"]).features
-    # Create a list of GlobalIDs - These should be unique
-    global_ids = [feature.asDictionary["attributes"][field_mappings["GlobalID"]] for feature in archived_assignments]
-    # Iterate through the the assignments returned and only add those that don't exist in the Feature Layer
-    # that is storing the archived ones
-    logging.getLogger().debug("")
-    assignments_to_copy = []
-    for assignment in current_assignments:
-        if assignment.asDictionary["attributes"]["GlobalID"] not in global_ids:
-            assignments_to_copy.append(assignment)
-    # Create a new list to store the updated feature-dictionaries
-    assignments_to_copy_dict = []
-    # Loop over all assignments that we want to add,
-    # Map update the field mappings and create a new dictionary object and add it to the list
-    for assignment in assignments_to_copy:
-        assignment_dict = {'geometry': assignment.asDictionary["geometry"],
-                           'attributes': {}}
-        for key, value in field_mappings.items():
-            assignment_dict["attributes"][value] = assignment.asDictionary["attributes"][key]
-        assignments_to_copy_dict.append(assignment_dict)
-    # Convert the list of dictionaries to a list of Feature Objects
-    features = [arcrest.common.general.Feature(x) for x in assignments_to_copy_dict]
-    logging.getLogger().debug("Copying Assignments...")
-    # Add the features to the feature layer
-    response = target_fl.addFeature(features)
-    logging.getLogger().info(response)
+    map_page = map_page or fieldmapper.compile_field_mappings(field_mappings)
+    logging.getLogger().debug("Copying {} assignments...".format(len(oids)))
+    copied_oids = []
+    written = featurewriter.write_edits(
+        lambda adds, updates: target_fl.addFeature([arcrest.common.general.Feature(x) for x in adds],
+                                                   rollbackOnFailure=False),
+        get_copy_edits(source_fl, target_fl, field_mappings, oids, map_page, copied_oids, batch_size),
+        max_count=batch_size, threads=threads,
+        find_added=lambda features: find_copied(target_fl, field_mappings["GlobalID"], features))
+    return {"added": written["added"], "copied": copied_oids, "failed": written["failed"]}
 
 
 def validate_config(config_dict, target_fl):
@@ -126,23 +170,30 @@ def validate_config(config_dict, target_fl):
     return True
 
 
-def get_worker_id(shh, projectId, worker):
+def get_project(shh, projectId):
     """
-    Get the logged in users dispatcher id
+    Gets the layers and workers of the project once, so that they can be shared when checking the workers
     :param shh: The ArcREST security handler helper
     :param projectId: The projectId to use
-    :param worker: The name of the worker to get the id of
-    :return: The OBJECTID of the specified dispatcher
+    :return: (dict) The id, the distance mode, the assignments and location (tracks) feature layers, the tracking
+    interval and the OBJECTID of each worker (userId)
     """
-    logger = logging.getLogger()
-    logger.debug("Getting dispatcher id for: {}...".format(worker))
+    workers = {}
     worker_fl = workforcehelpers.get_workers_feature_layer(shh, projectId)
-    workers = worker_fl.query(where="userId='{}'".format(worker))
-    if workers.features:
-        return workers.features[0].asDictionary["attributes"]["OBJECTID"]
-    else:
-        logger.critical("{} is not a worker".format(worker))
-        return None
+    for page in workforcehelpers.query_feature_layer_pages(worker_fl, out_fields="OBJECTID,userId"):
+        for worker in page:
+            workers[worker["attributes"]["userId"]] = worker["attributes"]["OBJECTID"]
+    assignment_fl = workforcehelpers.get_assignments_feature_layer(shh, projectId)
+    portal_admin = arcrest.manageorg.Administration(securityHandler=shh.securityhandler)
+    project_data = portal_admin.content.getItem(itemId=projectId).itemData(f="json")
+    return {
+        "id": projectId,
+        "assignments": assignment_fl,
+        "distance_mode": trackhelpers.get_distance_mode(assignment_fl.extent["spatialReference"]),
+        "tracks": workforcehelpers.get_location_feature_layer(shh, projectId),
+        "track_interval": project_data["tracks"].get("updateInterval"),
+        "workers": workers
+    }
 
 
 def main(args):
@@ -162,35 +213,221 @@ def main(args):
     if target_fl.hasError():
         logging.getLogger().critical("Error with target feature layer: {}".format(target_fl.error))
         return
-    logging.getLogger().info("Getting assignments feature layer...")
-    assignment_fl = workforcehelpers.get_assignments_feature_layer(shh, args.projectId)
+    # Get the layers and workers of the project (once, they are shared by all of the workers)
+    logging.getLogger().info("Getting project...")
+    project = get_project(shh, args.projectId)
+
+    if args.distanceMode != "auto":
+        project["distance_mode"] = args.distanceMode
+    logging.getLogger().info("Using the {} distance mode".format(project["distance_mode"]))
+    # Interpolate between tracks that are at most a few tracking intervals apart
+    project["max_gap"] = trackhelpers.get_max_gap(project["track_interval"]) if args.interpolate else None
 
     # if a specific workers weren't specified, let's use all workers
-    if not args.workers:
-        features = workforcehelpers.get_workers_feature_layer(shh, args.projectId).query(where="1=1").features
-        workers = [feature.asDictionary["attributes"]["userId"] for feature in features]
-    else:
-        workers = args.workers
+    workers = args.workers or sorted(project["workers"].keys())
 
     # Open the field mappings config file
     logging.getLogger().info("Reading field mappings...")
     with open(args.configFile, 'r') as f:
         field_mappings = json.load(f)
+    # Compile the field mappings once (the rest of the script only needs the names of the target fields)
+    map_page = fieldmapper.compile_field_mappings(field_mappings)
+    field_mappings = fieldmapper.get_target_fields(field_mappings)
     # Check the mapping to the target feature service is valid
     logging.getLogger().info("Validating field mappings...")
     if validate_config(field_mappings, target_fl):
-        for worker in workers:
-            # Get the query string that represents the invalid assignment completions
-            query_string = get_invalid_completions(shh, args.projectId, worker,
-                                                   args.timeTol, args.distTol, args.minAccuracy)
-            # Use that query to copy the assignments to feature service (if they don't already exist)
-            copy_assignments(assignment_fl, target_fl, field_mappings, where=query_string)
+        if args.stateFile:
+            trackhelpers.initialize_state(args.stateFile)
+        # Check the workers (up to -threads at a time) and merge the invalid assignments of all of the workers
+        logging.getLogger().info("Checking {} workers using {} threads...".format(len(workers), args.threads))
+        # Each worker has its own timings, so that the threads do not share them
+        worker_timings = dict((worker, {}) for worker in workers)
+        pool = ThreadPool(args.threads)
+        try:
+            results = pool.map(lambda worker: check_worker(project, worker, args.timeTol, args.distTol,
+                                                           args.minAccuracy, args.cacheDir, args.stateFile,
+                                                           worker_timings[worker]),
+                               workers)
+        finally:
+            pool.close()
+            pool.join()
+        results = [result for worker_results in results for result in worker_results]
+        settings = trackhelpers.get_settings(args.timeTol, args.distTol, args.minAccuracy, project["distance_mode"],
+                                             project["max_gap"])
+        start_time = time.time()
+        invalid_assignment_oids = sorted(set(result["OBJECTID"] for result in results if not result["valid"]))
+        if not invalid_assignment_oids:
+            logging.getLogger().info(
+                "All assignments were completed within the specified time and distance. Nothing to copy.")
+        else:
+            # Copy the invalid assignments to feature service (if they don't already exist), a batch at a time
+            logging.getLogger().info("Copying {} invalid assignments...".format(len(invalid_assignment_oids)))
+            copy_results = copy_assignments(project["assignments"], target_fl, field_mappings,
+                                            invalid_assignment_oids, args.batchSize, args.threads, map_page)
+            logging.getLogger().info("{} invalid assignments added, {} already copied, {} failed".format(
+                len(copy_results["added"]), len(copy_results["copied"]), len(copy_results["failed"])))
+            if copy_results["failed"]:
+                # The results are not remembered, so that the assignments are checked and copied again next run
+                logging.getLogger().error("Not all of the invalid assignments were copied, the results are not saved")
+                trackhelpers.write_report(args.report, results, trackhelpers.get_timings(worker_timings), settings)
+                return
+        # Only remember the results once the invalid assignments have been copied
+        trackhelpers.save_state(args.stateFile, project["id"], results, settings)
+        write_timings = {}
+        trackhelpers.add_timing(write_timings, "write", start_time)
+        trackhelpers.write_report(args.report, results, trackhelpers.get_timings(worker_timings, write_timings),
+                                  settings)
     else:
         logging.getLogger().critical("Invalid field mappings detected")
         return
 
 
-def get_invalid_completions(shh, projectId, worker, time_tolerance, distance_tolerance, min_accuracy):
+def get_track_indexes(location_fl, worker, completion_dates, time_tolerance, distance_tolerance, min_accuracy,
+                      cache_dir=None, mode="planar", max_gap=0, timings=None):
+    """
+    Gets the tracks of a worker for the time span of their completions (one page at a time) and indexes them by time
+    and location. If a cache folder is provided, the indexes are cached by day and only the days that are not cached
+    are queried
+    :param location_fl: (ArcREST Feature Layer Object) The location (tracks) feature layer
+    :param worker: (string) The userId (name) of the worker to use
+    :param completion_dates: (list<int>) The completion dates (milliseconds since the epoch)
+    :param time_tolerance: (int) The number of minutes to use as a tolerance
+    :param distance_tolerance: (float or int) The distance tolerance to use
+    :param min_accuracy: (int or float) The minimum accuracy to require when querying points
+    :param cache_dir: (string) The folder to cache the indexes in
+    :param mode: (string) The distance mode (see trackhelpers.get_distance_mode)
+    :param max_gap: (int) The time (in milliseconds) to add before and after the time span, so that the tracks on
+    either side of the completions can be interpolated
+    :param timings: (dict) If provided, the time spent fetching and indexing the tracks is added to it
+    :return: (list<dict>) The indexes (see trackhelpers.get_track_indexes)
+    """
+    fetch_timings = {}
+
+    def fetch(start, end):
+        fetch_start = time.time()
+        try:
+            return query_tracks(start, end)
+        finally:
+            trackhelpers.add_timing(fetch_timings, "fetch", fetch_start)
+
+    def query_tracks(start, end):
+        where = trackhelpers.get_tracks_query(worker, start, end, min_accuracy)
+        logging.getLogger().debug("Location Query: {}".format(where))
+        tracks = []
+        for page in workforcehelpers.query_feature_layer_pages(location_fl, where=where,
+                                                               out_fields="CreationDate,Accuracy"):
+            tracks.extend((location["attributes"]["CreationDate"], location["geometry"]["x"],
+                           location["geometry"]["y"], float(location["attributes"]["Accuracy"])) for location in page)
+        return tracks
+    start_time = time.time()
+    start, end = trackhelpers.get_time_span(completion_dates, time_tolerance)
+    start -= max_gap
+    end += max_gap
+    track_indexes = trackhelpers.get_track_indexes(fetch, start, end,
+                                                   trackhelpers.get_cell_size(distance_tolerance, mode), cache_dir,
+                                                   (location_fl.url, worker, min_accuracy))
+    # The indexes are built (or read from the cache) while the tracks are not being fetched
+    fetch_seconds = fetch_timings.get("fetch", 0)
+    trackhelpers.add_timing(timings, "index", start_time + fetch_seconds)
+    if timings is not None:
+        timings["fetch"] = timings.get("fetch", 0) + fetch_seconds
+    return track_indexes
+
+
+def check_worker(project, worker, time_tolerance, distance_tolerance, min_accuracy, cache_dir=None, state_file=None,
+                 timings=None):
+    """
+    Checks the completed assignments of a worker. If a state file is provided, only the assignments that were completed
+    or edited since they were last checked are checked
+    :param project: (dict) The layers and workers of the project (from get_project)
+    :param worker: (string) The userId (name) of the worker to use
+    :param time_tolerance: (int) The number of minutes to use as a tolerance
+    :param distance_tolerance: (float or int) The distance tolerance to use
+    :param min_accuracy: (int or float) The minimum accuracy to require when querying points
+    :param cache_dir: (string) The folder to cache the indexed tracks in
+    :param state_file: (string) The SQLite database that stores the results of earlier runs
+    :param timings: (dict) If provided, the time spent in each phase (fetch, index and evaluate) is added to it
+    :return: (list<dict>) The results of the checked assignments (GlobalID, OBJECTID, worker, completedDate, EditDate,
+    valid, and the distance, candidates and seconds of trackhelpers.check_completion)
+    """
+    logging.getLogger().info("Checking {}...".format(worker))
+    worker_id = project["workers"].get(worker)
+    if not worker_id:
+        logging.getLogger().critical("{} is not a worker".format(worker))
+        return []
+    settings = trackhelpers.get_settings(time_tolerance, distance_tolerance, min_accuracy, project["distance_mode"],
+                                         project.get("max_gap"))
+    where = "workerId = {} AND completedDate is not NULL".format(worker_id)
+    watermark_query = trackhelpers.get_watermark_query(*trackhelpers.get_watermarks(state_file, project["id"], worker,
+                                                                                    settings))
+    if watermark_query:
+        where = "{} AND {}".format(where, watermark_query)
+    # Get the completed assignments by the specified worker
+    start_time = time.time()
+    completed_assignments = [assignment.asDictionary for assignment in project["assignments"].query(
+        where=where).features]
+    trackhelpers.add_timing(timings, "fetch", start_time)
+    # Skip the assignments that have not been edited since they were checked
+    checked = trackhelpers.get_verdicts(state_file, [a["attributes"]["GlobalID"] for a in completed_assignments],
+                                        settings)
+    completed_assignments = [a for a in completed_assignments
+                             if checked.get(a["attributes"]["GlobalID"]) != a["attributes"]["EditDate"]]
+    if not completed_assignments:
+        logging.getLogger().info("No new assignments completed by {}".format(worker))
+        return []
+    # Fetch the tracks of the worker once, for the time span of all of their completions
+    completion_dates = [int(assignment["attributes"]["completedDate"]) for assignment in completed_assignments]
+    track_indexes = get_track_indexes(project["tracks"], worker, completion_dates, time_tolerance, distance_tolerance,
+                                      min_accuracy, cache_dir, project["distance_mode"], project.get("max_gap") or 0,
+                                      timings)
+    trajectory = None
+    if project.get("max_gap"):
+        start_time = time.time()
+        trajectory = trackhelpers.build_trajectory(track_indexes, project["max_gap"], distance_tolerance,
+                                                   project["distance_mode"])
+        trackhelpers.add_timing(timings, "index", start_time)
+    start_time = time.time()
+    results = []
+    # Iterate over the assignments and check to see if they were completed within the specified distance
+    for assignment, completion_date in zip(completed_assignments, completion_dates):
+        # Only the four corners of the accuracy (not the track itself) are checked
+        check = trackhelpers.check_completion(track_indexes, assignment["geometry"]["x"], assignment["geometry"]["y"],
+                                              completion_date, time_tolerance, distance_tolerance,
+                                              include_center=False, mode=project["distance_mode"],
+                                              trajectory=trajectory)
+        if not check["valid"]:
+            logging.debug("Invalid completion: {}".format(assignment["attributes"]["OBJECTID"]))
+        result = {
+            "GlobalID": assignment["attributes"]["GlobalID"],
+            "OBJECTID": assignment["attributes"]["OBJECTID"],
+            "worker": worker,
+            "completedDate": completion_date,
+            "EditDate": assignment["attributes"]["EditDate"]
+        }
+        result.update(check)
+        results.append(result)
+    trackhelpers.add_timing(timings, "evaluate", start_time)
+    return results
+
+
+def get_invalid_assignment_oids(project, worker, time_tolerance, distance_tolerance, min_accuracy, cache_dir=None):
+    """
+    Gets the assignments of a worker that were completed either outside of the specified time window or outside of the
+    specified distance
+    :param project: (dict) The layers and workers of the project (from get_project)
+    :param worker: (string) The userId (name) of the worker to use
+    :param time_tolerance: (int) The number of minutes to use as a tolerance
+    :param distance_tolerance: (float or int) The distance tolerance to use
+    :param min_accuracy: (int or float) The minimum accuracy to require when querying points
+    :param cache_dir: (string) The folder to cache the indexed tracks in
+    :return: (list<int>) The OBJECTIDs of the invalid assignment completions
+    """
+    results = check_worker(project, worker, time_tolerance, distance_tolerance, min_accuracy, cache_dir)
+    return [result["OBJECTID"] for result in results if not result["valid"]]
+
+
+def get_invalid_completions(shh, projectId, worker, time_tolerance, distance_tolerance, min_accuracy,
+                            cache_dir=None):
     """
     Generates a query string that represents the assignments that were completed either outside of the
     specified time window or outside of the specified distance
@@ -200,81 +437,20 @@ def get_invalid_completions(shh, projectId, worker, time_tolerance, distance_tol
     :param time_tolerance: (int) The number of minutes to use as a tolerance
     :param distance_tolerance: (float or int) The distance tolerance to use
     :param min_accuracy: (int or float) The minimum accuracy to require when querying points
+    :param cache_dir: (string) The folder to cache the indexed tracks in
     :return: (string) A query that uses the OBJECTID to identify invalid assignment completions
     """
-    logging.getLogger().info("Getting assignments feature layer...")
-    assignment_fl = workforcehelpers.get_assignments_feature_layer(shh, projectId)
-    # Get the locations feature layer
-    logging.getLogger().info("Getting location feature layer...")
-    location_fl = workforcehelpers.get_location_feature_layer(shh, projectId)
-    # Get workerId
-    logging.getLogger().info("Getting workerId for {}".format(worker))
-    worker_id = get_worker_id(shh, projectId, worker)
-    if not worker_id:
-        logging.critical("Invalid worker detected")
-        return
-    # Get the completed assignments by the specified worker
-    completed_assignments = assignment_fl.query(
-        where="workerId = {} AND completedDate is not NULL".format(worker_id)).features
-    invalid_assignment_oids = []
-    # Iterate over the assignments and check to see if they were completed within the specified distance
-    for assignment in completed_assignments:
-        # The coordinates of the assignment
-        start_coords = (assignment.asDictionary["geometry"]["x"], assignment.asDictionary["geometry"]["y"])
-        # When the assignment was completed
-        completion_date = datetime.datetime.utcfromtimestamp(
-            int(assignment.asDictionary["attributes"]["completedDate"])/1000)
-        # Add/Subtract some minutes to give a little leeway
-        start_date = completion_date - datetime.timedelta(minutes=time_tolerance)
-        end_date = completion_date + datetime.timedelta(minutes=time_tolerance)
-        # Make a query string to select location by the worker during the time period
-        loc_query_string = "Editor = '{}' AND CreationDate >= '{}' AND CreationDate <= '{}' AND Accuracy <= {}"\
-            .format(worker, start_date.strftime('%Y-%m-%d %H:%M:%S'), end_date.strftime('%Y-%m-%d %H:%M:%S'),
-                    min_accuracy)
-        # Query the feature layer
-        locations_to_check = location_fl.query(where=loc_query_string).features
-        # Bool to see if this assignment is valid or not
-        is_valid=False
-        for location in locations_to_check:
-            # Make a list of coordinate pairs to get the distance of
-            coords = []
-            # If we include the accuracy, we need to make four variations (+- the accuracy)
-            accuracy = float(location.asDictionary["attributes"]["Accuracy"])
-            coords.append((location.asDictionary["geometry"]["x"]+accuracy,
-                       location.asDictionary["geometry"]["y"]+accuracy))
-            coords.append((location.asDictionary["geometry"]["x"]+accuracy,
-                       location.asDictionary["geometry"]["y"]-accuracy))
-            coords.append((location.asDictionary["geometry"]["x"]-accuracy,
-                       location.asDictionary["geometry"]["y"]+accuracy))
-            coords.append((location.asDictionary["geometry"]["x"]-accuracy,
-                       location.asDictionary["geometry"]["y"]-accuracy))
-            distances = [get_simple_distance(start_coords, coordinates) for coordinates in coords]
-            # if any of the distances is less than the threshold then this assignment is valid
-            if any(distance < distance_tolerance for distance in distances):
-                is_valid = True
-                break
-        # if it's not valid add the OBJECTID to the list of invalid assignment OBJECTIDS
-        if not is_valid:
-            logging.debug("Location Query: {}".format(loc_query_string))
-            invalid_assignment_oids.append(str(assignment.asDictionary["attributes"]["OBJECTID"]))
+    project = get_project(shh, projectId)
+    invalid_assignment_oids = get_invalid_assignment_oids(project, worker, time_tolerance, distance_tolerance,
+                                                          min_accuracy, cache_dir)
     if invalid_assignment_oids:
-        return "OBJECTID in ({})".format(",".join(invalid_assignment_oids))
+        return "OBJECTID in ({})".format(",".join(str(oid) for oid in invalid_assignment_oids))
     else:
         logging.getLogger().info(
             "All assignments were completed within the specified time and distance. Nothing to copy.")
         return "1=0"
 
 
-def get_simple_distance(coords1, coords2):
-    """
-    Calculates the simple distance between two x,y points
-    :param coords1: (Tuple) of x and y coordinates
-    :param coords2: (Tuple) of x and y coordinates
-    :return: (float) The distance between the two points
-    """
-    return math.sqrt((coords1[0]-coords2[0])**2 + (coords1[1]-coords2[1])**2)
-
-
 if __name__ == "__main__":
     # Get all of the commandline arguments
     parser = argparse.ArgumentParser("Export assignments from Workforce Project")
@@ -306,6 +482,23 @@ if __name__ == "__main__":
                         help='The distance tolerance to use (meters- based on SR of Assignments FL)')
     parser.add_argument('-minAccuracy', dest='minAccuracy', type=int, default=50,
                         help="The minimum accuracy to use (meters - based on SR of Assignments FL)")
+    parser.add_argument('-cacheDir', dest='cacheDir', default=None,
+                        help="The folder to cache the indexed worker locations in (reused by later runs)")
+    parser.add_argument('-threads', dest='threads', type=int, default=1,
+                        help="The maximum number of workers to check (and batches to copy) at the same time")
+    parser.add_argument('-batchSize', dest='batchSize', type=int, default=500,
+                        help="The number of invalid assignments to copy at a time")
+    parser.add_argument('-stateFile', dest='stateFile', default=None,
+                        help="The SQLite database to remember the checked assignments in, so that later runs only "
+                             "check new or edited assignments")
+    parser.add_argument('-distanceMode', dest='distanceMode', default="auto",
+                        choices=["auto", "planar", "mercator", "geographic"],
+                        help="How to measure distances (auto picks the mode from the spatial reference of the "
+                             "assignments)")
+    parser.add_argument('-interpolate', dest='interpolate', action='store_true', default=False,
+                        help="Interpolate the worker locations between tracks and detect where workers stayed")
+    parser.add_argument('-report', dest='report', default=None,
+                        help="The file to write the result of each assignment and the timings to (json, or .parquet)")
     args = parser.parse_args()
     workforcehelpers.initialize_logging(args.logFile)
     try:
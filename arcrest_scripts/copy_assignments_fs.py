@@ -25,58 +25,323 @@
 """
 import arcrest
 import argparse
+import datetime
 import json
 import logging
 import logging.handlers
+import sqlite3
+import time
 import traceback
+import featurewriter
+import fieldmapper
+import projectioncache
 import workforcehelpers
 
 
-def copy_assignments(source_fl, target_fl, field_mappings, where="1=1"):
+# The watermark is kept this far (in milliseconds) behind the start of a sync, in case the clock of the server (which
+# sets the EditDates) is ahead of this one
+SYNC_CLOCK_SKEW = 5 * 60 * 1000
+
+
+def get_copy_edits(pages, global_ids, map_page, project=None):
+    """
+    Gets the adds of the assignments that are not already in the target feature layer, a page at a time
+    :param pages: (iterable<list<dict>>) The pages of assignments
+    :param global_ids: (set<bytes>) The GlobalID keys of the assignments in the target feature layer
+    :param map_page: (function) The compiled field mappings
+    :param project: (function) Projects a list of assignments to the spatial reference of the target feature layer,
+                    None if the pages are already projected
+    :return: (generator<tuple>) The edits (OBJECTID of the assignment, "add" and the feature to add)
+    """
+    for page in pages:
+        # Only add the assignments that don't exist in the Feature Layer that is storing the archived ones
+        assignments_to_copy = [a for a in page
+                               if workforcehelpers.get_global_id_key(a["attributes"]["GlobalID"]) not in global_ids]
+        # Only the assignments that are copied are projected
+        if project and assignments_to_copy:
+            assignments_to_copy = project(assignments_to_copy)
+        # Map the attributes of the whole page at once and create a new dictionary object for each
+        mapped_attributes = map_page([assignment["attributes"] for assignment in assignments_to_copy])
+        for assignment, attributes in zip(assignments_to_copy, mapped_attributes):
+            yield assignment["attributes"]["OBJECTID"], "add", {'geometry': assignment["geometry"],
+                                                                'attributes': attributes}
+
+
+def get_projector(source_fl, target_fl, projection_cache):
+    """
+    Makes the function that projects assignments (queried in the spatial reference of the source) to the spatial
+    reference of the target feature layer, locally and through the projection cache. Assignments that cannot be
+    projected locally are queried from the source with outSR
+    :param source_fl: (ArcREST Feature Layer Object) The layer to get the assignments from
+    :param target_fl: (ArcREST Feature Layer Object) The layer copy the assignments to
+    :param projection_cache: (string) The SQLite database to cache the projected geometries in
+    :return: (function) Projects a list of assignments
+    """
+    projectioncache.initialize_cache(projection_cache)
+    in_wkid = projectioncache.get_wkid(source_fl.extent["spatialReference"])
+    out_wkid = projectioncache.get_wkid(target_fl.extent["spatialReference"])
+
+    def query_projected(oids):
+        features = source_fl.query(objectIds=",".join(str(oid) for oid in oids), out_fields="OBJECTID",
+                                   outSR=target_fl.extent["spatialReference"]["wkid"]).features
+        return dict((f.asDictionary["attributes"]["OBJECTID"], f.asDictionary.get("geometry")) for f in features)
+    return lambda assignments: projectioncache.project_features(assignments, in_wkid, out_wkid, projection_cache,
+                                                                query_projected)
+
+
+def copy_assignments(source_fl, target_fl, field_mappings, where="1=1", map_page=None,
+                     batch_size=featurewriter.MAX_COUNT, threads=1, projection_cache=None):
     """
     This copies assignments (features) from the target feature layer to the source layer, based on the provided field
     mappings and query to select the assignments to copy over.
 
     The assignments are checked (via GlobalID) to see if they already exist in the target feature layer, if not they
-    are then added
+    are then added, in batches of up to batch_size assignments, up to "threads" batches at the same time
+
+    When a projection cache is used, the assignments are queried in the spatial reference of the source and projected
+    locally (once per assignment, EditDate and spatial reference), rather than by the server on every copy
     :param source_fl: (ArcREST Feature Layer Object) The layer to get the assignments from
     :param target_fl: (ArcREST Feature Layer Object) The layer copy the assignments to
     :param field_mappings: (dictionary) The mapping of the assignment field to the archive fields
     :param where: (string) The where clause to use to query
-    :return:
+    :param map_page: (function) The compiled field mappings (compiled from field_mappings if not provided)
+    :param batch_size: (int) The maximum number of assignments to add per request
+    :param threads: (int) The maximum number of batches to add at the same time
+    :param projection_cache: (string) The SQLite database to cache the projected geometries in
+    :return: (dict) The OBJECTIDs of the assignments that were added or failed to be added
     """
-    # Query the source to get the features specified by the query string
-    logging.getLogger().debug("Querying source features...")
-    current_assignments = source_fl.query(where=where, out_fields="*",
-                                          outSR=target_fl.extent["spatialReference"]["wkid"]).features
+    map_page = map_page or fieldmapper.compile_field_mappings(field_mappings)
     # Query the archived assignments to get all of the currently archived ones
     logging.getLogger().debug("Querying target features")
-    archived_assignments = target_fl.query(where="1=1", out_fields=field_mappings["GlobalID"]).features
-    # Create a list of GlobalIDs - These should be unique
-    global_ids = [feature.asDictionary["attributes"][field_mappings["GlobalID"]] for feature in archived_assignments]
-    # Iterate through the the assignments returned and only add those that don't exist in the Feature Layer
-    # that is storing the archived ones
-    logging.getLogger().debug("")
-    assignments_to_copy = []
-    for assignment in current_assignments:
-        if assignment.asDictionary["attributes"]["GlobalID"] not in global_ids:
-            assignments_to_copy.append(assignment)
-    # Create a new list to store the updated feature-dictionaries
-    assignments_to_copy_dict = []
-    # Loop over all assignments that we want to add,
-    # Map update the field mappings and create a new dictionary object and add it to the list
-    for assignment in assignments_to_copy:
-        assignment_dict = {'geometry': assignment.asDictionary["geometry"],
-                           'attributes': {}}
-        for key, value in field_mappings.items():
-            assignment_dict["attributes"][value] = assignment.asDictionary["attributes"][key]
-        assignments_to_copy_dict.append(assignment_dict)
-    # Convert the list of dictionaries to a list of Feature Objects
-    features = [arcrest.common.general.Feature(x) for x in assignments_to_copy_dict]
+    # Index the GlobalIDs (as 16 byte keys) as the pages are read - These should be unique
+    global_ids = workforcehelpers.index_global_ids(
+        workforcehelpers.query_feature_layer_pages(target_fl, out_fields=field_mappings["GlobalID"]),
+        field_mappings["GlobalID"])
+    # Query the source to get the features specified by the query string, a page at a time, and add the pages as they
+    # are read
     logging.getLogger().debug("Copying Assignments...")
-    # Add the features to the feature layer
-    response = target_fl.addFeature(features)
-    logging.getLogger().info(response)
+    if projection_cache:
+        project = get_projector(source_fl, target_fl, projection_cache)
+        pages = workforcehelpers.query_feature_layer_pages(source_fl, where=where)
+    else:
+        project = None
+        pages = workforcehelpers.query_feature_layer_pages(source_fl, where=where,
+                                                           out_sr=target_fl.extent["spatialReference"]["wkid"])
+    return featurewriter.write_edits(
+        lambda adds, updates: target_fl.addFeature([arcrest.common.general.Feature(x) for x in adds],
+                                                   rollbackOnFailure=False),
+        get_copy_edits(pages, global_ids, map_page, project), max_count=batch_size, threads=threads,
+        find_added=lambda features: find_copied(target_fl, field_mappings, features))
+
+
+def initialize_sync_state(db):
+    """
+    Initializes the sync state database and creates the table if necessary
+    :param db: (string) The database to use
+    :return:
+    """
+    conn = sqlite3.connect(db)
+    c = conn.cursor()
+    c.execute("CREATE TABLE IF NOT EXISTS `Syncs` ( "
+              "`source` TEXT, "
+              "`target` TEXT, "
+              "`query` TEXT, "
+              "`EditDate` INTEGER, "
+              "`syncDate` INTEGER, "
+              "PRIMARY KEY(`source`, `target`, `query`) )")
+    conn.commit()
+    conn.close()
+
+
+def get_sync_watermark(db, source_fl_url, target_fl_url, where):
+    """
+    Gets the latest EditDate of the assignments that were synced from the source to the target
+    :param db: (string) The database to use
+    :param source_fl_url: (string) The url to the feature layer the assignments are synced from
+    :param target_fl_url: (string) The url to the feature layer the assignments are synced to
+    :param where: (string) The where clause used to select the assignments
+    :return: (int) The latest EditDate (milliseconds since the epoch), None if the assignments have not been synced
+    """
+    conn = sqlite3.connect(db)
+    c = conn.cursor()
+    c.execute("SELECT EditDate FROM Syncs WHERE source = ? AND target = ? AND query = ?",
+              (source_fl_url, target_fl_url, where))
+    row = c.fetchone()
+    conn.close()
+    return row[0] if row else None
+
+
+def save_sync_watermark(db, source_fl_url, target_fl_url, where, edit_date):
+    """
+    Saves the latest EditDate of the assignments that were synced from the source to the target
+    :param db: (string) The database to use
+    :param source_fl_url: (string) The url to the feature layer the assignments are synced from
+    :param target_fl_url: (string) The url to the feature layer the assignments are synced to
+    :param where: (string) The where clause used to select the assignments
+    :param edit_date: (int) The latest EditDate (milliseconds since the epoch)
+    :return:
+    """
+    conn = sqlite3.connect(db)
+    c = conn.cursor()
+    c.execute("INSERT OR REPLACE INTO Syncs VALUES (?, ?, ?, ?, strftime('%s', 'now') * 1000)",
+              (source_fl_url, target_fl_url, where, edit_date))
+    conn.commit()
+    conn.close()
+
+
+def get_synced_features(target_fl, field_mappings, global_ids, chunk_size=500):
+    """
+    Gets the target features of the provided (source) GlobalIDs. Only the provided GlobalIDs are queried (a chunk at a
+    time), rather than every feature of the target
+    :param target_fl: (ArcREST Feature Layer Object) The layer the assignments are synced to
+    :param field_mappings: (dictionary) The mapping of the assignment field to the archive fields
+    :param global_ids: (list<string>) The GlobalIDs of the source assignments
+    :param chunk_size: (int) The number of GlobalIDs to query at a time
+    :return: (dict) The attributes (OBJECTID, GlobalID and the EditDate of the assignment) of the target features by
+    the key (from get_global_id_key) of the GlobalID of their assignment, so that they are matched as the copy does
+    """
+    out_fields = [getattr(target_fl, "objectIdField", None) or "OBJECTID", field_mappings["GlobalID"],
+                  field_mappings["EditDate"]]
+    if getattr(target_fl, "globalIdField", None):
+        out_fields.append(target_fl.globalIdField)
+    synced = {}
+    for chunk in workforcehelpers.chunk_list(global_ids, chunk_size):
+        where = "{} IN ({})".format(field_mappings["GlobalID"],
+                                    ",".join("'{}'".format(global_id) for global_id in chunk))
+        for page in workforcehelpers.query_feature_layer_pages(target_fl, where=where, out_fields=",".join(out_fields)):
+            for feature in page:
+                key = workforcehelpers.get_global_id_key(feature["attributes"][field_mappings["GlobalID"]])
+                synced[key] = feature["attributes"]
+    return synced
+
+
+def find_copied(target_fl, field_mappings, features):
+    """
+    Gets which of the (mapped) features are already in the target feature layer, by the field the GlobalID of the
+    assignment is copied to. Used to check the adds of a request that raised before they are retried
+    :param target_fl: (ArcREST Feature Layer Object) The layer the assignments are copied to
+    :param field_mappings: (dictionary) The mapping of the assignment field to the archive fields
+    :param features: (list<dict>) The features that were added
+    :return: (set<int>) The indexes of the features that are in the target
+    """
+    synced = get_synced_features(target_fl, field_mappings,
+                                 [feature["attributes"][field_mappings["GlobalID"]] for feature in features])
+    return set(i for i, feature in enumerate(features)
+               if workforcehelpers.get_global_id_key(feature["attributes"][field_mappings["GlobalID"]]) in synced)
+
+
+def sync_page(assignments, target_fl, field_mappings, map_page, batch_size=featurewriter.MAX_COUNT, threads=1,
+              project=None):
+    """
+    Upserts a page of assignments into the target feature layer: assignments that are not in the target are added,
+    and assignments that were edited since they were copied are updated (in a single applyEdits request)
+    :param assignments: (list<dict>) The page of assignments to sync
+    :param target_fl: (ArcREST Feature Layer Object) The layer the assignments are synced to
+    :param field_mappings: (dictionary) The mapping of the assignment field to the archive fields
+    :param map_page: (function) The compiled field mappings
+    :param batch_size: (int) The maximum number of assignments to add or update per request
+    :param threads: (int) The maximum number of batches to write at the same time
+    :param project: (function) Projects a list of assignments to the spatial reference of the target feature layer,
+                    None if the page is already projected
+    :return: (dict) The number of assignments that were added, updated, unchanged and failed
+    """
+    synced = get_synced_features(target_fl, field_mappings,
+                                 [assignment["attributes"]["GlobalID"] for assignment in assignments])
+    object_id_field = getattr(target_fl, "objectIdField", None) or "OBJECTID"
+    global_id_field = getattr(target_fl, "globalIdField", None)
+    # Features are identified by their GlobalIDs when the target supports it, and by their OBJECTIDs otherwise
+    use_global_ids = bool(global_id_field and getattr(target_fl, "supportsApplyEditsWithGlobalIds", False))
+    unchanged = 0
+    assignments_to_write = []
+    targets = []
+    for assignment in assignments:
+        target = synced.get(workforcehelpers.get_global_id_key(assignment["attributes"]["GlobalID"]))
+        if target is not None and target.get(field_mappings["EditDate"]) == assignment["attributes"]["EditDate"]:
+            unchanged += 1
+        else:
+            assignments_to_write.append(assignment)
+            targets.append(target)
+    # Only the assignments that are added or updated are projected and mapped
+    if project and assignments_to_write:
+        assignments_to_write = project(assignments_to_write)
+    edits = []
+    mapped_attributes = map_page([assignment["attributes"] for assignment in assignments_to_write])
+    for assignment, attributes, target in zip(assignments_to_write, mapped_attributes, targets):
+        feature = {'geometry': assignment["geometry"], 'attributes': attributes}
+        if target is None:
+            if use_global_ids:
+                feature["attributes"][global_id_field] = assignment["attributes"]["GlobalID"]
+            edits.append((assignment["attributes"]["OBJECTID"], "add", feature))
+        else:
+            if use_global_ids:
+                feature["attributes"][global_id_field] = target[global_id_field]
+            else:
+                feature["attributes"][object_id_field] = target[object_id_field]
+            edits.append((assignment["attributes"]["OBJECTID"], "update", feature))
+    written = featurewriter.write_edits(
+        lambda adds, updates: target_fl.applyEdits(addFeatures=[arcrest.common.general.Feature(x) for x in adds],
+                                                   updateFeatures=[arcrest.common.general.Feature(x) for x in updates],
+                                                   useGlobalIds=use_global_ids, rollbackOnFailure=False),
+        edits, max_count=batch_size, threads=threads,
+        find_added=lambda features: find_copied(target_fl, field_mappings, features))
+    return {"added": len(written["added"]), "updated": len(written["updated"]), "unchanged": unchanged,
+            "failed": len(written["failed"])}
+
+
+def sync_assignments(source_fl, target_fl, field_mappings, state_file, where="1=1", map_page=None,
+                     batch_size=featurewriter.MAX_COUNT, threads=1, projection_cache=None):
+    """
+    Syncs the assignments that were edited since the last sync (the EditDate watermark in the state file) to the target
+    feature layer, one page at a time, so that each run only reads and writes the assignments that changed. The
+    watermark is only moved forward if all of the assignments were synced
+
+    When a projection cache is used, the assignments are projected locally, as they are by copy_assignments
+    :param source_fl: (ArcREST Feature Layer Object) The layer to get the assignments from
+    :param target_fl: (ArcREST Feature Layer Object) The layer to sync the assignments to
+    :param field_mappings: (dictionary) The mapping of the assignment field to the archive fields
+    :param state_file: (string) The SQLite database that stores the watermark
+    :param where: (string) The where clause used to select the assignments
+    :param map_page: (function) The compiled field mappings (compiled from field_mappings if not provided)
+    :param batch_size: (int) The maximum number of assignments to add or update per request
+    :param threads: (int) The maximum number of batches to write at the same time
+    :param projection_cache: (string) The SQLite database to cache the projected geometries in
+    :return: (dict) The number of assignments that were added, updated, unchanged and failed
+    """
+    map_page = map_page or fieldmapper.compile_field_mappings(field_mappings)
+    initialize_sync_state(state_file)
+    watermark = get_sync_watermark(state_file, source_fl.url, target_fl.url, where)
+    changed_where = where
+    if watermark is not None:
+        # Assignments edited in the same second as the watermark are read again (and are unchanged if already synced)
+        changed_where = "({}) AND EditDate >= '{}'".format(
+            where, datetime.datetime.utcfromtimestamp(watermark / 1000.0).strftime('%Y-%m-%d %H:%M:%S'))
+    # Assignments can be edited while they are read (after their page was read, or after the OBJECTIDs were queried), so
+    # the watermark is never moved past the start of the sync, and those edits are read again by the next sync
+    run_start = int(time.time() * 1000) - SYNC_CLOCK_SKEW
+    logging.getLogger().info("Syncing assignments ({})...".format(changed_where))
+    totals = {"added": 0, "updated": 0, "unchanged": 0, "failed": 0}
+    latest_edit = watermark
+    if projection_cache:
+        project = get_projector(source_fl, target_fl, projection_cache)
+        pages = workforcehelpers.query_feature_layer_pages(source_fl, where=changed_where)
+    else:
+        project = None
+        pages = workforcehelpers.query_feature_layer_pages(source_fl, where=changed_where,
+                                                           out_sr=target_fl.extent["spatialReference"]["wkid"])
+    for page in pages:
+        page_result = sync_page(page, target_fl, field_mappings, map_page, batch_size, threads, project)
+        for key in totals:
+            totals[key] += page_result[key]
+        latest_edit = max([latest_edit or 0] + [assignment["attributes"]["EditDate"] for assignment in page])
+        logging.getLogger().info("Synced a page of assignments: {added} added, {updated} updated, {unchanged} "
+                                 "unchanged, {failed} failed".format(**page_result))
+    if totals["failed"]:
+        # The assignments are read again by the next sync
+        logging.getLogger().error("{} assignments failed to sync, the watermark was not moved".format(
+            totals["failed"]))
+    elif latest_edit is not None:
+        save_sync_watermark(state_file, source_fl.url, target_fl.url, where, min(latest_edit, run_start))
+    return totals
 
 
 def validate_config(config_dict, target_fl):
@@ -147,10 +412,25 @@ def main(args):
     logging.getLogger().info("Reading field mappings...")
     with open(args.configFile, 'r') as f:
         field_mappings = json.load(f)
+    # Compile the field mappings once (the rest of the script only needs the names of the target fields)
+    map_page = fieldmapper.compile_field_mappings(field_mappings)
+    field_mappings = fieldmapper.get_target_fields(field_mappings)
     logging.getLogger().info("Validating field mappings...")
     if validate_config(field_mappings, target_fl):
-        # Copy the assignments
-        copy_assignments(assignment_fl, target_fl, field_mappings, where=args.where)
+        if args.stateFile:
+            # Only sync the assignments that were edited since the last sync
+            totals = sync_assignments(assignment_fl, target_fl, field_mappings, args.stateFile, where=args.where,
+                                      map_page=map_page, batch_size=args.batchSize, threads=args.threads,
+                                      projection_cache=args.projectionCache)
+            logging.getLogger().info("{added} assignments added, {updated} updated, {unchanged} unchanged, {failed} "
+                                     "failed".format(**totals))
+        else:
+            # Copy the assignments
+            written = copy_assignments(assignment_fl, target_fl, field_mappings, where=args.where, map_page=map_page,
+                                       batch_size=args.batchSize, threads=args.threads,
+                                       projection_cache=args.projectionCache)
+            logging.getLogger().info("{} assignments added, {} failed".format(len(written["added"]),
+                                                                              len(written["failed"])))
         logging.getLogger().info("Completed")
     else:
         logging.getLogger().critical("Invalid field mappings detected")
@@ -180,6 +460,16 @@ if __name__ == "__main__":
                         required=True)
     parser.add_argument('-configFile', dest="configFile", help="The json configuration file to use", required=True)
     parser.add_argument('-logFile', dest='logFile', help="The log file to write to", required=True)
+    parser.add_argument('-stateFile', dest='stateFile', default=None,
+                        help="The SQLite database to keep the sync watermark in. When provided, only the assignments "
+                             "edited since the last run are added or updated")
+    parser.add_argument('-batchSize', dest='batchSize', type=int, default=500,
+                        help="The maximum number of assignments to add or update per request")
+    parser.add_argument('-threads', dest='threads', type=int, default=1,
+                        help="The maximum number of requests to send at the same time")
+    parser.add_argument('-projectionCache', dest='projectionCache', default=None,
+                        help="The SQLite database to cache projected geometries in. When provided, the assignments are "
+                             "projected locally (with pyproj, if installed) rather than by the server")
     args = parser.parse_args()
     workforcehelpers.initialize_logging(args.logFile)
     try:
@@ -26,17 +26,119 @@ import argparse
 import logging
 import logging.handlers
 import traceback
+from multiprocessing.pool import ThreadPool
 import workforcehelpers
 
 
+def get_existing_oids(assignment_fl, oids, chunk_size=500):
+    """
+    Gets which of the OBJECTIDs still exist in the assignments layer (a chunk at a time)
+    :param assignment_fl: (ArcREST Feature Layer Object) The assignments layer
+    :param oids: (list<int>) The OBJECTIDs to check
+    :param chunk_size: (int) The number of OBJECTIDs to query at a time
+    :return: (set<int>) The OBJECTIDs that exist
+    """
+    existing = set()
+    for chunk in workforcehelpers.chunk_list(oids, chunk_size):
+        where = "OBJECTID IN ({})".format(",".join(str(oid) for oid in chunk))
+        existing.update(assignment_fl.query(where=where, returnIDsOnly=True).get("objectIds") or [])
+    return existing
+
+
+def get_oids_to_delete(assignment_fl, objectIDs, where, journal_file=None):
+    """
+    Gets the OBJECTIDs of the assignments to delete. If the journal of an interrupted purge exists, the OBJECTIDs
+    planned by that purge (that were not already deleted) are used, so that the purge resumes where it stopped
+    :param assignment_fl: (ArcREST Feature Layer Object) The assignments layer
+    :param objectIDs: (list<string>) The OBJECTIDs to delete
+    :param where: (string) The where clause used to find the assignments to delete
+    :param journal_file: (string) The journal file used to record the progress of the purge
+    :return: (list<int>) The OBJECTIDs to delete
+    """
+    entries = workforcehelpers.read_journal(journal_file)
+    if entries:
+        logging.getLogger().info("Resuming purge from journal: {}".format(journal_file))
+        planned = entries[0]["planned"]
+        deleted = set()
+        for entry in entries[1:]:
+            deleted.update(entry["deleted"])
+        remaining = [oid for oid in planned if oid not in deleted]
+        # Chunks that were deleted just before the purge stopped may not have been journaled, so the remaining
+        # OBJECTIDs are checked, and the ones that no longer exist are treated as deleted
+        existing = get_existing_oids(assignment_fl, remaining)
+        if len(existing) < len(remaining):
+            logging.getLogger().info("{} planned assignments were already deleted".format(
+                len(remaining) - len(existing)))
+        return [oid for oid in remaining if oid in existing]
+    # If we have objectIds, then use them, otherwise resolve the query to OBJECTIDs
+    if objectIDs:
+        oids = sorted(int(oid) for oid in objectIDs)
+    elif where:
+        oids = sorted(assignment_fl.query(where=where, returnIDsOnly=True).get("objectIds") or [])
+    # if for some reason we have neither, let's just delete nothing
+    else:
+        oids = []
+    workforcehelpers.write_journal_entry(journal_file, {"planned": oids})
+    return oids
+
+
+def delete_assignments(assignment_fl, objectIDs, where, chunk_size=500, threads=4, journal_file=None):
+    """
+    Deletes the assignments in chunks of OBJECTIDs, submitting up to "threads" chunks at the same time. The
+    deleteResults of each chunk are verified and recorded in the journal (if provided)
+    :param assignment_fl: (ArcREST Feature Layer Object) The assignments layer
+    :param objectIDs: (list<string>) The OBJECTIDs to delete
+    :param where: (string) The where clause used to find the assignments to delete
+    :param chunk_size: (int) The number of assignments to delete per request
+    :param threads: (int) The maximum number of requests to submit at the same time
+    :param journal_file: (string) The journal file used to record the progress of the purge
+    :return: (tuple) The list of deleted OBJECTIDs and the list of OBJECTIDs that failed to be deleted
+    """
+    oids = get_oids_to_delete(assignment_fl, objectIDs, where, journal_file)
+    chunks = workforcehelpers.chunk_list(oids, chunk_size)
+    logging.getLogger().info("Deleting {} assignments in {} chunks...".format(len(oids), len(chunks)))
+    deleted = []
+    failed = []
+    pool = ThreadPool(threads)
+    try:
+        results = pool.imap_unordered(
+            lambda chunk: (chunk, assignment_fl.deleteFeatures(objectIds=",".join(str(oid) for oid in chunk),
+                                                               rollbackOnFailure=False)), chunks)
+        # The results are verified and journaled by this thread only, as each chunk completes
+        for chunk, response in results:
+            chunk_deleted = [r["objectId"] for r in response.get("deleteResults", []) if r["success"]]
+            deleted_oids = set(chunk_deleted)
+            chunk_failed = [oid for oid in chunk if oid not in deleted_oids]
+            if "error" in response:
+                logging.getLogger().error(response["error"])
+            for result in response.get("deleteResults", []):
+                if not result["success"]:
+                    logging.getLogger().error("Failed to delete {}: {}".format(result["objectId"],
+                                                                               result.get("error")))
+            workforcehelpers.write_journal_entry(journal_file, {"deleted": chunk_deleted, "failed": chunk_failed})
+            deleted.extend(chunk_deleted)
+            failed.extend(chunk_failed)
+            logging.getLogger().info("Deleted {} of {} assignments ({} failed)".format(len(deleted), len(oids),
+                                                                                      len(failed)))
+    finally:
+        pool.close()
+        pool.join()
+    return deleted, failed
+
+
 def main(args):
     logging.getLogger().info("Authenticating...")
     shh = workforcehelpers.get_security_handler(args)
     logging.getLogger().info("Getting assignment feature layer...")
     assignment_fl = workforcehelpers.get_assignments_feature_layer(shh, args.projectId)
     logging.getLogger().info("Deleting assignments...")
-    response = assignment_fl.deleteFeatures(objectIds=",".join(args.objectIDs), where=args.where)
-    logging.getLogger().info(response)
+    deleted, failed = delete_assignments(assignment_fl, args.objectIDs, args.where, args.chunkSize, args.threads,
+                                         args.journal)
+    if failed:
+        logging.getLogger().error("Failed to delete {} assignments: {}".format(len(failed), failed))
+        if args.journal:
+            logging.getLogger().error("Run the script again with the same journal to retry them")
+    logging.getLogger().info("Deleted {} assignments".format(len(deleted)))
     logging.getLogger().info("Completed")
 
 
@@ -63,6 +165,12 @@ if __name__ == "__main__":
     group.add_argument('-where', dest='where', help="The where clause to use", default=None)
     group.add_argument('-objectIDs', dest='objectIDs', help="The objectIds to delete", nargs="+", default=[])
     parser.add_argument('-logFile', dest="logFile", help="The file to log to", required=True)
+    parser.add_argument('-chunkSize', dest='chunkSize', type=int, default=500,
+                        help="The number of assignments to delete per request")
+    parser.add_argument('-threads', dest='threads', type=int, default=4,
+                        help="The maximum number of delete requests to submit at the same time")
+    parser.add_argument('-journal', dest='journal', default=None,
+                        help="The journal file used to record (and resume) the progress of the purge")
 
     args = parser.parse_args()
     workforcehelpers.initialize_logging(args.logFile)
@@ -0,0 +1,204 @@
+# -*- coding: UTF-8 -*-
+"""
+   Copyright 2017 Esri
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+
+   you may not use this file except in compliance with the License.
+
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+
+   distributed under the License is distributed on an "AS IS" BASIS,
+
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+
+   See the License for the specific language governing permissions and
+
+   limitations under the License.​
+
+    Writes a stream of edits (adds and updates) to a feature layer in batches that are bounded by the number of
+    features and by the size of the request, a few batches at a time. The result of each feature is collected, and the
+    features that failed are retried one at a time, so that a single bad feature does not fail its whole batch. The
+    same file is used by the standalone, ArcREST and ArcGIS API for Python scripts, each of which provides the function
+    that submits a batch (ex. an applyEdits request).
+
+    An edit is a tuple of a key (used to report the result, ex. the OBJECTID of the source feature), the kind of edit
+    ("add" or "update") and the feature (as a dictionary).
+
+    A request that raised (ex. a read timeout) may still have been applied by the server, so the adds of a batch that
+    raised are only retried once the target has been checked for them (with the find_added function of the script),
+    and are not retried when the script cannot check for them
+"""
+import itertools
+import json
+import logging
+from multiprocessing.pool import ThreadPool
+
+# The maximum number of features in a batch
+MAX_COUNT = 500
+# The maximum size (in bytes) of the features in a batch, below the default request size limit of ArcGIS Server
+MAX_BYTES = 2000000
+
+
+def get_size(feature):
+    """
+    Gets the size of a feature when it is sent as JSON
+    :param feature: (dict) The feature
+    :return: (int) The size (in bytes)
+    """
+    return len(json.dumps(feature, default=str))
+
+
+def get_batches(edits, max_count=MAX_COUNT, max_bytes=MAX_BYTES):
+    """
+    Splits a stream of edits into batches that are bounded by the number of features and by their size. A feature
+    that is larger than max_bytes is sent in a batch of its own
+    :param edits: (iterable<tuple>) The edits (key, kind and feature)
+    :param max_count: (int) The maximum number of features in a batch
+    :param max_bytes: (int) The maximum size (in bytes) of the features in a batch
+    :return: (generator<list<tuple>>) The batches of edits
+    """
+    batch = []
+    batch_size = 0
+    for edit in edits:
+        size = get_size(edit[2])
+        if batch and (len(batch) >= max_count or batch_size + size > max_bytes):
+            yield batch
+            batch = []
+            batch_size = 0
+        batch.append(edit)
+        batch_size += size
+    if batch:
+        yield batch
+
+
+def submit_batch(submit, batch):
+    """
+    Submits a batch of edits and matches the results to the edits. Edits without a result (ex. when the request
+    failed) are reported as failed, and are marked as "raised" when the request raised (it may have been applied)
+    :param submit: (function) Submits the adds and updates (lists of features), returning the response
+    :param batch: (list<tuple>) The edits (key, kind and feature)
+    :return: (list<tuple>) The edits and their results
+    """
+    adds = [edit for edit in batch if edit[1] == "add"]
+    updates = [edit for edit in batch if edit[1] == "update"]
+    raised = False
+    try:
+        response = submit([edit[2] for edit in adds], [edit[2] for edit in updates])
+    except Exception as e:
+        response = {"error": str(e)}
+        raised = True
+    if "error" in response:
+        logging.getLogger().error(response["error"])
+    results = []
+    # The results are in the same order as the submitted features
+    for edits, edit_results in [(adds, response.get("addResults") or []),
+                                (updates, response.get("updateResults") or [])]:
+        for i, edit in enumerate(edits):
+            result = edit_results[i] if i < len(edit_results) else {"success": False, "error": response.get("error"),
+                                                                    "raised": raised}
+            results.append((edit, result))
+    return results
+
+
+def record_results(written, batch_results):
+    """
+    Records the edits that succeeded
+    :param written: (dict) The keys that were added and updated, and the result of each key
+    :param batch_results: (list<tuple>) The edits and their results
+    :return: (list<tuple>) The edits that failed and their results
+    """
+    failed = []
+    for edit, result in batch_results:
+        if result.get("success"):
+            written["added" if edit[1] == "add" else "updated"].append(edit[0])
+            written["results"][edit[0]] = result
+        else:
+            failed.append((edit, result))
+    return failed
+
+
+def check_raised_adds(written, failed, find_added=None):
+    """
+    Checks the target for the adds of the requests that raised, as they may have been applied. The adds that are in
+    the target are recorded as added, and the ones that are not can be retried. Without find_added, they are not
+    retried (as that could add them twice)
+    :param written: (dict) The keys that were added and updated, and the result of each key
+    :param failed: (list<tuple>) The edits that failed and their results
+    :param find_added: (function) Gets which of a list of features are already in the target, returning their indexes
+    :return: (tuple<list<tuple>>) The edits that can be retried, and the edits that cannot (with their results)
+    """
+    raised = [(edit, result) for edit, result in failed if edit[1] == "add" and result.get("raised")]
+    retry = [(edit, result) for edit, result in failed if not (edit[1] == "add" and result.get("raised"))]
+    if not raised:
+        return retry, []
+    if not find_added:
+        logging.getLogger().warning("Not retrying {} adds of requests that raised, as they may have been "
+                                    "applied".format(len(raised)))
+        return retry, raised
+    try:
+        added = find_added([edit[2] for edit, _ in raised])
+    except Exception as e:
+        logging.getLogger().error("Unable to check the adds of requests that raised: {}".format(e))
+        return retry, raised
+    record_results(written, [(edit, {"success": True}) for i, (edit, _) in enumerate(raised) if i in added])
+    retry.extend((edit, result) for i, (edit, result) in enumerate(raised) if i not in added)
+    return retry, []
+
+
+def write_edits(submit, edits, max_count=MAX_COUNT, max_bytes=MAX_BYTES, threads=1, retries=1, find_added=None):
+    """
+    Writes a stream of edits, up to "threads" batches at the same time. Only a few batches are read ahead of the
+    requests, so the stream is not held in memory. The edits that fail are then retried one at a time. The adds of a
+    request that raised may have been applied, so they are only retried if find_added shows they are not in the target
+    :param submit: (function) Submits the adds and updates (lists of features), returning the response
+    :param edits: (iterable<tuple>) The edits (key, kind and feature)
+    :param max_count: (int) The maximum number of features in a batch
+    :param max_bytes: (int) The maximum size (in bytes) of the features in a batch
+    :param threads: (int) The maximum number of batches to submit at the same time
+    :param retries: (int) The number of times to retry each failed edit
+    :param find_added: (function) Gets which of a list of features are already in the target, returning their indexes
+                       (ex. by querying the field the GlobalID is copied to), None to not retry the adds of requests
+                       that raised
+    :return: (dict) The keys that were added, updated, or failed, and the result of each key
+    """
+    written = {"added": [], "updated": [], "failed": [], "results": {}}
+    failed = []
+    not_retried = []
+    batches = get_batches(edits, max_count, max_bytes)
+    pool = ThreadPool(threads)
+    try:
+        while True:
+            window = list(itertools.islice(batches, threads * 2))
+            if not window:
+                break
+            # The results are recorded by this thread only, as each batch completes
+            for batch_results in pool.imap_unordered(lambda batch: submit_batch(submit, batch), window):
+                failed.extend(record_results(written, batch_results))
+                logging.getLogger().info("Wrote a batch of {} features ({} added, {} updated, {} failed)".format(
+                    len(batch_results), len(written["added"]), len(written["updated"]), len(failed)))
+        for attempt in range(retries):
+            failed, unchecked = check_raised_adds(written, failed, find_added)
+            not_retried.extend(unchecked)
+            if not failed:
+                break
+            logging.getLogger().info("Retrying {} failed features one at a time...".format(len(failed)))
+            retry = [edit for edit, _ in failed]
+            failed = []
+            for batch_results in pool.imap_unordered(lambda edit: submit_batch(submit, [edit]), retry):
+                failed.extend(record_results(written, batch_results))
+    finally:
+        pool.close()
+        pool.join()
+    # The adds of the last requests that raised are checked too, so the ones that were applied are not reported failed
+    failed, unchecked = check_raised_adds(written, failed, find_added)
+    not_retried.extend(unchecked)
+    for edit, result in failed + not_retried:
+        logging.getLogger().error("Failed to write {}: {}".format(edit[0], result.get("error")))
+        written["failed"].append(edit[0])
+        written["results"][edit[0]] = result
+    return written
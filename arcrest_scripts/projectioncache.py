@@ -0,0 +1,280 @@
+# -*- coding: UTF-8 -*-
+"""
+   Copyright 2017 Esri
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+
+   you may not use this file except in compliance with the License.
+
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+
+   distributed under the License is distributed on an "AS IS" BASIS,
+
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+
+   See the License for the specific language governing permissions and
+
+   limitations under the License.​
+
+    Projects the geometries of features locally, rather than asking the server to project them (outSR), and caches the
+    projected geometries in a SQLite database so that repeated copies, and copies to several targets, only project each
+    feature once per spatial reference. The same file is used by the standalone, ArcREST and ArcGIS API for Python
+    scripts.
+
+    The geometries are projected with pyproj when it is installed. Without pyproj, only Web Mercator and WGS84 are
+    projected locally, and the features that cannot be projected locally are queried from the server with outSR.
+
+    A cached geometry is keyed by the GlobalID of the feature and the wkid it was projected to, and is only used if the
+    EditDate of the feature has not changed since it was cached
+"""
+import json
+import logging
+import math
+import sqlite3
+try:
+    import pyproj
+except ImportError:
+    pyproj = None
+
+WEB_MERCATOR_RADIUS = 6378137.0
+WEB_MERCATOR_WKIDS = (102100, 102113, 3857, 3785, 900913)
+WGS84_WKID = 4326
+# The latitude at which Web Mercator is cut off
+MAX_MERCATOR_LATITUDE = 85.0511287798
+# The transforms that were made (by wkids), as making a pyproj transformer is slow
+TRANSFORMS = {}
+
+
+def get_wkid(spatial_reference):
+    """
+    Gets the wkid of a spatial reference (preferring the latest wkid)
+    :param spatial_reference: (dict) The spatial reference (ex. {"wkid": 102100, "latestWkid": 3857})
+    :return: (int) The wkid, None if the spatial reference has none (ex. it only has a wkt)
+    """
+    if not spatial_reference:
+        return None
+    wkid = spatial_reference.get("latestWkid") or spatial_reference.get("wkid")
+    return 3857 if wkid in WEB_MERCATOR_WKIDS else wkid
+
+
+def to_web_mercator(xs, ys):
+    """
+    Projects WGS84 coordinates to Web Mercator
+    :param xs: (list<float>) The longitudes
+    :param ys: (list<float>) The latitudes
+    :return: (tuple<list<float>>) The x and y coordinates (meters)
+    """
+    return ([math.radians(x) * WEB_MERCATOR_RADIUS for x in xs],
+            [math.log(math.tan(math.pi / 4 + math.radians(max(-MAX_MERCATOR_LATITUDE,
+                                                              min(MAX_MERCATOR_LATITUDE, y))) / 2))
+             * WEB_MERCATOR_RADIUS for y in ys])
+
+
+def to_wgs84(xs, ys):
+    """
+    Projects Web Mercator coordinates to WGS84
+    :param xs: (list<float>) The x coordinates (meters)
+    :param ys: (list<float>) The y coordinates (meters)
+    :return: (tuple<list<float>>) The longitudes and latitudes
+    """
+    return ([math.degrees(x / WEB_MERCATOR_RADIUS) for x in xs],
+            [math.degrees(2 * math.atan(math.exp(y / WEB_MERCATOR_RADIUS)) - math.pi / 2) for y in ys])
+
+
+def get_crs(wkid):
+    """
+    Gets the name of a wkid for pyproj (wkids of 100000 and up are Esri codes)
+    :param wkid: (int) The wkid
+    :return: (string) The name (ex. "EPSG:4326")
+    """
+    return "{}:{}".format("ESRI" if wkid >= 100000 else "EPSG", wkid)
+
+
+def get_transform(in_wkid, out_wkid):
+    """
+    Gets the function that projects coordinates from one spatial reference to another (made once per pair of wkids)
+    :param in_wkid: (int) The wkid of the coordinates
+    :param out_wkid: (int) The wkid to project the coordinates to
+    :return: (function) Projects lists of x and y coordinates, None if they cannot be projected locally
+    """
+    if in_wkid is None or out_wkid is None:
+        return None
+    if (in_wkid, out_wkid) not in TRANSFORMS:
+        TRANSFORMS[(in_wkid, out_wkid)] = make_transform(in_wkid, out_wkid)
+    return TRANSFORMS[(in_wkid, out_wkid)]
+
+
+def make_transform(in_wkid, out_wkid):
+    """
+    Makes the function that projects coordinates from one spatial reference to another
+    :param in_wkid: (int) The wkid of the coordinates
+    :param out_wkid: (int) The wkid to project the coordinates to
+    :return: (function) Projects lists of x and y coordinates, None if they cannot be projected locally
+    """
+    if in_wkid == out_wkid:
+        return lambda xs, ys: (list(xs), list(ys))
+    if pyproj:
+        try:
+            transformer = pyproj.Transformer.from_crs(get_crs(in_wkid), get_crs(out_wkid), always_xy=True)
+        except Exception as e:
+            logging.getLogger().warning("Unable to project from {} to {} locally: {}".format(in_wkid, out_wkid, e))
+            return None
+        return lambda xs, ys: tuple(list(coordinates) for coordinates in transformer.transform(xs, ys))
+    if in_wkid == WGS84_WKID and out_wkid == 3857:
+        return to_web_mercator
+    if in_wkid == 3857 and out_wkid == WGS84_WKID:
+        return to_wgs84
+    return None
+
+
+def get_coordinates(geometry):
+    """
+    Gets the coordinates (points, vertices of paths and rings) of a geometry
+    :param geometry: (dict) The geometry
+    :return: (list<list<float>>) The coordinates, in order
+    """
+    if "x" in geometry:
+        return [[geometry["x"], geometry["y"]]]
+    if "points" in geometry:
+        return geometry["points"]
+    return [coordinates for part in geometry.get("paths") or geometry.get("rings") or [] for coordinates in part]
+
+
+def set_coordinates(geometry, xs, ys):
+    """
+    Makes a copy of a geometry with new coordinates (the spatial reference is removed, so the geometry is in the
+    spatial reference of the layer it is added to)
+    :param geometry: (dict) The geometry
+    :param xs: (iterator<float>) The x coordinates, in the order of get_coordinates
+    :param ys: (iterator<float>) The y coordinates, in the order of get_coordinates
+    :return: (dict) The projected geometry
+    """
+    if "x" in geometry:
+        projected = {"x": next(xs), "y": next(ys)}
+    elif "points" in geometry:
+        projected = {"points": [[next(xs), next(ys)] + point[2:] for point in geometry["points"]]}
+    else:
+        key = "paths" if "paths" in geometry else "rings"
+        projected = {key: [[[next(xs), next(ys)] + vertex[2:] for vertex in part] for part in geometry[key]]}
+    for key in ("z", "m", "hasZ", "hasM"):
+        if key in geometry:
+            projected[key] = geometry[key]
+    return projected
+
+
+def project_geometries(geometries, transform):
+    """
+    Projects geometries, with a single call to the transform for all of their coordinates
+    :param geometries: (list<dict>) The geometries (points, multipoints, polylines or polygons)
+    :param transform: (function) Projects lists of x and y coordinates (from get_transform)
+    :return: (list<dict>) The projected geometries
+    """
+    coordinates = [c for geometry in geometries for c in get_coordinates(geometry)]
+    if not coordinates:
+        return [dict(geometry) for geometry in geometries]
+    xs, ys = transform([c[0] for c in coordinates], [c[1] for c in coordinates])
+    xs = iter(xs)
+    ys = iter(ys)
+    return [set_coordinates(geometry, xs, ys) for geometry in geometries]
+
+
+def initialize_cache(db):
+    """
+    Initializes the cache database and creates the table if necessary
+    :param db: (string) The database to use
+    :return:
+    """
+    conn = sqlite3.connect(db)
+    c = conn.cursor()
+    c.execute("CREATE TABLE IF NOT EXISTS `Geometries` ( "
+              "`GlobalID` TEXT, "
+              "`wkid` INTEGER, "
+              "`EditDate` INTEGER, "
+              "`geometry` TEXT, "
+              "PRIMARY KEY(`GlobalID`, `wkid`) )")
+    conn.commit()
+    conn.close()
+
+
+def get_cached_geometries(db, wkid, edit_dates):
+    """
+    Gets the cached geometries of features that have not been edited since they were cached
+    :param db: (string) The database to use
+    :param wkid: (int) The wkid the geometries were projected to
+    :param edit_dates: (dict) The EditDate of each feature (GlobalID)
+    :return: (dict) The projected geometry of each feature (GlobalID) that is cached
+    """
+    if not db or not edit_dates:
+        return {}
+    global_ids = list(edit_dates)
+    conn = sqlite3.connect(db)
+    c = conn.cursor()
+    geometries = {}
+    # SQLite limits the number of parameters of a statement
+    for i in range(0, len(global_ids), 500):
+        chunk = global_ids[i:i + 500]
+        c.execute("SELECT GlobalID, EditDate, geometry FROM Geometries WHERE wkid = ? AND GlobalID IN ({})".format(
+            ",".join("?" * len(chunk))), [wkid] + chunk)
+        for global_id, edit_date, geometry in c.fetchall():
+            if edit_date == edit_dates[global_id]:
+                geometries[global_id] = json.loads(geometry)
+    conn.close()
+    return geometries
+
+
+def save_geometries(db, wkid, features):
+    """
+    Caches projected geometries
+    :param db: (string) The database to use
+    :param wkid: (int) The wkid the geometries were projected to
+    :param features: (list<tuple>) The GlobalID, EditDate and projected geometry of each feature
+    :return:
+    """
+    if not db or not features:
+        return
+    conn = sqlite3.connect(db)
+    c = conn.cursor()
+    c.executemany("INSERT OR REPLACE INTO Geometries (GlobalID, wkid, EditDate, geometry) VALUES (?, ?, ?, ?)",
+                  [(global_id, wkid, edit_date, json.dumps(geometry)) for global_id, edit_date, geometry in features])
+    conn.commit()
+    conn.close()
+
+
+def project_features(features, in_wkid, out_wkid, db=None, query_projected=None):
+    """
+    Projects the geometries of a page of features, using the cached geometries of the features that have not been
+    edited, projecting the others locally (or with query_projected when they cannot be projected locally), and caching
+    the geometries that were projected
+    :param features: (list<dict>) The features (with GlobalID, EditDate and OBJECTID attributes) in in_wkid
+    :param in_wkid: (int) The wkid of the features
+    :param out_wkid: (int) The wkid to project the features to
+    :param db: (string) The database to cache the projected geometries in, None to not cache them
+    :param query_projected: (function) Queries the geometries of a list of OBJECTIDs in out_wkid from the server,
+                            returning the geometry of each OBJECTID
+    :return: (list<dict>) The features with projected geometries (in the same order)
+    """
+    edit_dates = dict((f["attributes"]["GlobalID"], f["attributes"]["EditDate"]) for f in features)
+    cached = get_cached_geometries(db, out_wkid, edit_dates)
+    missing = [f for f in features if f["attributes"]["GlobalID"] not in cached and f.get("geometry")]
+    if missing:
+        transform = get_transform(in_wkid, out_wkid)
+        if transform:
+            geometries = project_geometries([f["geometry"] for f in missing], transform)
+        elif query_projected:
+            projected = query_projected([f["attributes"]["OBJECTID"] for f in missing])
+            geometries = [projected.get(f["attributes"]["OBJECTID"]) for f in missing]
+        else:
+            raise ValueError("Unable to project from {} to {}".format(in_wkid, out_wkid))
+        projected = [(f["attributes"]["GlobalID"], f["attributes"]["EditDate"], geometry)
+                     for f, geometry in zip(missing, geometries) if geometry is not None]
+        if len(projected) < len(missing):
+            logging.getLogger().warning("{} features were not projected".format(len(missing) - len(projected)))
+        save_geometries(db, out_wkid, projected)
+        cached.update((global_id, geometry) for global_id, _, geometry in projected)
+    logging.getLogger().debug("Projected {} features ({} cached, {} projected)".format(
+        len(features), len(features) - len(missing), len(missing)))
+    return [{"attributes": f["attributes"], "geometry": cached.get(f["attributes"]["GlobalID"])} for f in features]
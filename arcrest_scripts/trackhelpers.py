@@ -0,0 +1,941 @@
+# -*- coding: UTF-8 -*-
+"""
+   Copyright 2017 Esri
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+
+   you may not use this file except in compliance with the License.
+
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+
+   distributed under the License is distributed on an "AS IS" BASIS,
+
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+
+   See the License for the specific language governing permissions and
+
+   limitations under the License.​
+
+    Functionality for checking worker locations (tracks) against assignments. This does not depend on how the tracks
+    are queried, so the same file is used by the standalone, ArcREST and ArcGIS API for Python scripts.
+
+    A track is a tuple of (CreationDate, x, y, Accuracy), where CreationDate is in milliseconds since the epoch. When
+    NumPy is installed, the sorted tracks are held as arrays so that the distances are checked as array expressions.
+
+    The tracks of a worker are indexed by time (hour) and location, using a KD-tree when SciPy is installed and a grid
+    otherwise, so that only the tracks near an assignment (in time and space) are checked. The indexes can be cached on
+    disk (by day) so that they are reused by later runs.
+
+    Optionally, the tracks of a worker can be treated as a trajectory: the position between two consecutive tracks is
+    interpolated (when they are close enough in time), and places where the worker stayed (dwells) are detected, so
+    that an assignment can be valid even if no track was created during its time window (see build_trajectory).
+
+    Distances are measured in meters when the layers use Web Mercator or a geographic coordinate system, and in the
+    units of the layers otherwise (see get_distance_mode).
+
+    The results of earlier runs can be kept in a SQLite database (the state), so that only the assignments that were
+    completed (or edited) since the last run are checked.
+
+    The result of each assignment (its verdict, nearest distance and number of candidate tracks) and the time spent in
+    each phase of the check can be written to a report (JSON, or Parquet when PyArrow is installed)
+"""
+import bisect
+import datetime
+import hashlib
+import json
+import logging
+import math
+import os
+import pickle
+import sqlite3
+import time
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+try:
+    import pyproj
+except ImportError:
+    pyproj = None
+
+# The length of a day (in milliseconds), the tracks are cached by day
+DAY = 86400000
+# The radius (in meters) of the sphere used by Web Mercator, and the mean radius of the earth (for the haversine)
+WEB_MERCATOR_RADIUS = 6378137.0
+EARTH_RADIUS = 6371008.8
+# The wkids of Web Mercator
+WEB_MERCATOR_WKIDS = (102100, 102113, 3857, 3785, 900913)
+# The EPSG projected coordinate systems within the 4000 range (the rest of the range is geographic), used when pyproj
+# is not installed
+PROJECTED_4000_WKIDS = ((4026, 4026), (4037, 4038), (4048, 4051), (4056, 4063), (4071, 4071), (4082, 4083),
+                        (4087, 4088), (4093, 4096), (4217, 4217), (4390, 4415), (4417, 4434), (4437, 4439),
+                        (4455, 4457), (4462, 4462), (4467, 4467), (4471, 4471), (4474, 4474), (4484, 4489),
+                        (4491, 4554), (4559, 4559), (4568, 4589), (4647, 4647), (4652, 4656), (4766, 4800),
+                        (4812, 4812), (4822, 4822), (4826, 4826), (4839, 4839), (4855, 4880))
+
+
+def get_time_span(completion_dates, time_tolerance):
+    """
+    Gets the time span that covers all of the completion dates (+- the time tolerance)
+    :param completion_dates: (list<int>) The completion dates (milliseconds since the epoch)
+    :param time_tolerance: (int) The tolerance (in minutes)
+    :return: (tuple) The start and end of the time span (milliseconds since the epoch)
+    """
+    tolerance = time_tolerance * 60000
+    return min(completion_dates) - tolerance, max(completion_dates) + tolerance
+
+
+def format_query_date(timestamp, round_up=False):
+    """
+    Formats a timestamp so that it can be used in a where clause
+    :param timestamp: (int) The timestamp (milliseconds since the epoch)
+    :param round_up: (bool) Round up to the next second rather than down (so that an end date is inclusive)
+    :return: (string) The date formatted as 'YYYY-MM-DD HH:MM:SS' (UTC)
+    """
+    seconds = int(math.ceil(timestamp / 1000.0)) if round_up else int(math.floor(timestamp / 1000.0))
+    return datetime.datetime.utcfromtimestamp(seconds).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def get_tracks_query(editor, start, end, min_accuracy):
+    """
+    Makes the where clause that selects the tracks of a worker during a time span
+    :param editor: (string) The user that created the tracks (the worker)
+    :param start: (int) The start of the time span (milliseconds since the epoch)
+    :param end: (int) The end of the time span (milliseconds since the epoch)
+    :param min_accuracy: (int or float) The minimum accuracy to require
+    :return: (string) The where clause
+    """
+    return "Editor = '{}' AND CreationDate >= '{}' AND CreationDate <= '{}' AND Accuracy <= {}".format(
+        editor, format_query_date(start), format_query_date(end, round_up=True), min_accuracy)
+
+
+def sort_tracks(tracks):
+    """
+    Sorts the tracks by time so that the tracks near a time can be found with a binary search
+    :param tracks: (list<tuple>) The tracks
+    :return: (tuple) The sorted CreationDates and the sorted tracks (as arrays if NumPy is installed)
+    """
+    tracks = sorted(tracks, key=lambda track: track[0])
+    times = [track[0] for track in tracks]
+    if numpy is not None:
+        return numpy.array(times, dtype=numpy.int64), numpy.array(tracks, dtype=numpy.float64).reshape(-1, 4)
+    return times, tracks
+
+
+def get_tracks_in_window(times, tracks, start, end):
+    """
+    Gets the tracks that were created during a time window
+    :param times: (list<int>) The sorted CreationDates (from sort_tracks)
+    :param tracks: (list<tuple>) The sorted tracks (from sort_tracks)
+    :param start: (int) The start of the window (milliseconds since the epoch)
+    :param end: (int) The end of the window (milliseconds since the epoch)
+    :return: (list<tuple>) The tracks created between start and end (inclusive)
+    """
+    if numpy is not None and isinstance(times, numpy.ndarray):
+        return tracks[numpy.searchsorted(times, start, "left"):numpy.searchsorted(times, end, "right")]
+    return tracks[bisect.bisect_left(times, start):bisect.bisect_right(times, end)]
+
+
+def get_simple_distance(coords1, coords2):
+    """
+    Calculates the simple distance between two x,y points
+    :param coords1: (Tuple) of x and y coordinates
+    :param coords2: (Tuple) of x and y coordinates
+    :return: (float) The distance between the two points
+    """
+    return math.sqrt((coords1[0]-coords2[0])**2 + (coords1[1]-coords2[1])**2)
+
+
+def get_distance_mode(spatial_reference):
+    """
+    Picks how distances are measured from the spatial reference of the layers:
+        planar - the units of the (projected) coordinate system
+        mercator - meters, Web Mercator distances are scaled by the cosine of the latitude
+        geographic - meters, for longitudes and latitudes (in degrees)
+    :param spatial_reference: (dict) The spatial reference of the layers (ex. the spatialReference of the extent)
+    :return: (string) The distance mode
+    """
+    spatial_reference = spatial_reference or {}
+    wkid = spatial_reference.get("latestWkid") or spatial_reference.get("wkid")
+    if wkid in WEB_MERCATOR_WKIDS:
+        return "mercator"
+    return "geographic" if is_geographic(wkid, spatial_reference.get("wkt")) else "planar"
+
+
+def is_geographic(wkid, wkt=None):
+    """
+    Checks if a spatial reference is a geographic coordinate system, with pyproj when it is installed. Otherwise, the
+    wkt is checked, or the wkid is looked up in the EPSG (4000) and Esri (104000) ranges of geographic coordinate
+    systems (which also contain some projected coordinate systems, see PROJECTED_4000_WKIDS)
+    :param wkid: (int) The wkid, None if the spatial reference only has a wkt
+    :param wkt: (string) The wkt
+    :return: (bool) True if the coordinates are longitudes and latitudes
+    """
+    if wkt:
+        return wkt.strip().upper().startswith("GEOGCS")
+    if not wkid:
+        return False
+    if pyproj:
+        try:
+            return pyproj.CRS.from_user_input("{}:{}".format("ESRI" if wkid >= 100000 else "EPSG", wkid)).is_geographic
+        except Exception as e:
+            logging.getLogger().debug("Unable to look up wkid {} with pyproj: {}".format(wkid, e))
+    if 104000 <= wkid < 105000:
+        return True
+    return 4000 <= wkid < 5000 and not any(start <= wkid <= end for start, end in PROJECTED_4000_WKIDS)
+
+
+def get_search_radius(distance, y, mode="planar"):
+    """
+    Converts a distance (around a point) to the units of the coordinates, so that it can be used to search an index
+    :param distance: (float) The distance (in meters unless the mode is planar)
+    :param y: (float) The y coordinate (or latitude) of the point
+    :param mode: (string) The distance mode (from get_distance_mode)
+    :return: (tuple) The distance along the x and y axes in the units of the coordinates (at least the distance)
+    """
+    if mode == "mercator":
+        # The scale of Web Mercator hardly changes over a distance tolerance, 1% is added to be safe
+        radius = distance * 1.01 / math.cos(get_mercator_latitude(y))
+        return radius, radius
+    if mode == "geographic":
+        # A degree of longitude is the shortest (in meters) at the latitude furthest from the equator
+        latitude = min(abs(y) + math.degrees(distance / EARTH_RADIUS), 89.9)
+        return (math.degrees(distance / (EARTH_RADIUS * math.cos(math.radians(latitude)))),
+                math.degrees(distance / EARTH_RADIUS))
+    return distance, distance
+
+
+def get_cell_size(distance, mode="planar"):
+    """
+    Converts a distance to the units of the coordinates, so that it can be used as the size of the grid cells
+    :param distance: (float) The distance (in meters unless the mode is planar)
+    :param mode: (string) The distance mode (from get_distance_mode)
+    :return: (float) The cell size
+    """
+    if mode == "geographic":
+        return math.degrees(distance / EARTH_RADIUS)
+    return distance
+
+
+def get_mercator_latitude(y):
+    """
+    Gets the latitude of a Web Mercator y coordinate
+    :param y: (float or array) The y coordinate (or an array of them)
+    :return: (float or array) The latitude (in radians)
+    """
+    if numpy is not None and isinstance(y, numpy.ndarray):
+        return 2 * numpy.arctan(numpy.exp(y / WEB_MERCATOR_RADIUS)) - math.pi / 2
+    return 2 * math.atan(math.exp(y / WEB_MERCATOR_RADIUS)) - math.pi / 2
+
+
+def get_haversine_distance(coords1, coords2):
+    """
+    Calculates the great circle distance between two longitude, latitude points
+    :param coords1: (Tuple) of longitude and latitude (in degrees)
+    :param coords2: (Tuple) of longitude and latitude (in degrees)
+    :return: (float) The distance between the two points (in meters)
+    """
+    delta_x = math.radians(coords1[0] - coords2[0])
+    delta_y = math.radians(coords1[1] - coords2[1])
+    a = math.sin(delta_y / 2) ** 2 + \
+        math.cos(math.radians(coords1[1])) * math.cos(math.radians(coords2[1])) * math.sin(delta_x / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(a, 1)))
+
+
+def get_scale(y, mode="planar"):
+    """
+    Gets how much the x and y offsets between two points are scaled to get meters (1 if the mode is planar). The tracks
+    being checked are within a distance tolerance of the point, so Web Mercator and geographic coordinates are scaled
+    as a local (equirectangular) projection at the y coordinate halfway between the two points, which is within a few
+    millimeters of the haversine distance (see get_haversine_distance) over those distances, and is nearly as fast as
+    the planar distance
+    :param y: (float or array) The y coordinate (or latitude) halfway between the points (or an array of them)
+    :param mode: (string) The distance mode (from get_distance_mode)
+    :return: (tuple) The x and y scales
+    """
+    if mode == "mercator":
+        # Web Mercator is scaled by 1 / cos(latitude) in every direction, on a sphere that is larger than the one of the
+        # haversine distance
+        latitude = get_mercator_latitude(y)
+        scale = numpy.cos(latitude) if numpy is not None and isinstance(latitude, numpy.ndarray) else math.cos(latitude)
+        scale = scale * (EARTH_RADIUS / WEB_MERCATOR_RADIUS)
+        return scale, scale
+    if mode == "geographic":
+        scale = EARTH_RADIUS * math.pi / 180
+        if numpy is not None and isinstance(y, numpy.ndarray):
+            return scale * numpy.cos(numpy.radians(y)), scale
+        return scale * math.cos(math.radians(y)), scale
+    return 1, 1
+
+
+def get_min_distance(tracks, x, y, include_center=True, mode="planar"):
+    """
+    Gets the smallest distance between a point and the tracks, where each track is checked at the four corners of its
+    accuracy (x +- accuracy, y +- accuracy). The nearest corner is the one that is offset towards the point, so its
+    distance is sqrt((|dx| - accuracy)^2 + (|dy| - accuracy)^2)
+    :param tracks: (list<tuple>) The tracks to check (from get_tracks_in_window)
+    :param x: (float) The x coordinate of the point
+    :param y: (float) The y coordinate of the point
+    :param include_center: (bool) Check the track itself as well as the four corners of its accuracy
+    :param mode: (string) The distance mode (from get_distance_mode)
+    :return: (float) The smallest distance, None if there are no tracks
+    """
+    if not len(tracks):
+        return None
+    if numpy is not None and isinstance(tracks, numpy.ndarray):
+        # Each track is scaled halfway between it and the point
+        scale_x, scale_y = get_scale((tracks[:, 2] + y) / 2, mode) if mode != "planar" else (1, 1)
+        dx = numpy.abs(tracks[:, 1] - x)
+        if mode == "geographic":
+            # Longitudes that are more than 180 degrees apart are closer going the other way
+            dx = 180 - numpy.abs(180 - dx)
+        dx = dx * scale_x
+        dy = numpy.abs(tracks[:, 2] - y) * scale_y
+        squared = (dx - tracks[:, 3]) ** 2 + (dy - tracks[:, 3]) ** 2
+        if include_center:
+            squared = numpy.minimum(squared, dx ** 2 + dy ** 2)
+        return math.sqrt(squared.min())
+    min_squared = None
+    scale_x, scale_y = 1, 1
+    for _, track_x, track_y, accuracy in tracks:
+        if mode != "planar":
+            scale_x, scale_y = get_scale((track_y + y) / 2, mode)
+        dx = abs(track_x - x)
+        if mode == "geographic":
+            dx = 180 - abs(180 - dx)
+        dx *= scale_x
+        dy = abs(track_y - y) * scale_y
+        squared = (dx - accuracy) ** 2 + (dy - accuracy) ** 2
+        if include_center:
+            squared = min(squared, dx ** 2 + dy ** 2)
+        if min_squared is None or squared < min_squared:
+            min_squared = squared
+    return math.sqrt(min_squared)
+
+
+def build_track_index(tracks, cell_size, bucket_size=3600000):
+    """
+    Indexes tracks by time and location. The tracks are split into time buckets, and the tracks of each bucket are
+    indexed by location (a KD-tree if SciPy is installed, otherwise a grid)
+    :param tracks: (list<tuple>) The tracks
+    :param cell_size: (float) The size of the grid cells (ex. the distance tolerance)
+    :param bucket_size: (int) The length (in milliseconds) of the time buckets
+    :return: (dict) The index
+    """
+    times, tracks = sort_tracks(tracks)
+    track_index = {
+        "times": times,
+        "tracks": tracks,
+        "max_accuracy": max(float(track[3]) for track in tracks) if len(tracks) else 0,
+        "cell_size": float(cell_size) if cell_size > 0 else 1.0,
+        "bucket_size": bucket_size
+    }
+    if cKDTree is not None and numpy is not None and isinstance(tracks, numpy.ndarray):
+        # The tracks are sorted by time, so each bucket is a contiguous range of the tracks
+        track_index["trees"] = {}
+        buckets = times // bucket_size
+        for bucket in numpy.unique(buckets):
+            lo = numpy.searchsorted(buckets, bucket, "left")
+            hi = numpy.searchsorted(buckets, bucket, "right")
+            track_index["trees"][int(bucket)] = (int(lo), cKDTree(tracks[lo:hi, 1:3]))
+    else:
+        cells = track_index["cells"] = {}
+        cell_size = track_index["cell_size"]
+        for i, track in enumerate(tracks):
+            key = (int(track[0] // bucket_size), int(track[1] // cell_size), int(track[2] // cell_size))
+            if key in cells:
+                cells[key].append(i)
+            else:
+                cells[key] = [i]
+    return track_index
+
+
+def get_candidate_tracks(track_index, x, y, start, end, radius, radius_y=None):
+    """
+    Gets the tracks that were created during a time window and that are (about) within a radius of a point
+    :param track_index: (dict) The index (from build_track_index)
+    :param x: (float) The x coordinate of the point
+    :param y: (float) The y coordinate of the point
+    :param start: (int) The start of the window (milliseconds since the epoch)
+    :param end: (int) The end of the window (milliseconds since the epoch)
+    :param radius: (float) The search radius
+    :param radius_y: (float) The search radius along the y axis, if it is smaller than the radius (ex. the latitude)
+    :return: (list<tuple>) The tracks
+    """
+    times = track_index["times"]
+    tracks = track_index["tracks"]
+    buckets = range(int(start // track_index["bucket_size"]), int(end // track_index["bucket_size"]) + 1)
+    indexes = []
+    if "trees" in track_index:
+        for bucket in buckets:
+            if bucket in track_index["trees"]:
+                lo, tree = track_index["trees"][bucket]
+                indexes.extend(lo + i for i in tree.query_ball_point((x, y), radius))
+    else:
+        # Check every cell that is (partially) within the radius
+        cell_size = track_index["cell_size"]
+        cells_x = int(math.ceil(radius / cell_size))
+        cells_y = int(math.ceil((radius_y or radius) / cell_size))
+        cell_x = int(x // cell_size)
+        cell_y = int(y // cell_size)
+        for bucket in buckets:
+            for i in range(cell_x - cells_x, cell_x + cells_x + 1):
+                for j in range(cell_y - cells_y, cell_y + cells_y + 1):
+                    indexes.extend(track_index["cells"].get((bucket, i, j), []))
+    indexes = [i for i in indexes if start <= times[i] <= end]
+    if numpy is not None and isinstance(tracks, numpy.ndarray):
+        return tracks[numpy.array(indexes, dtype=numpy.int64)]
+    return [tracks[i] for i in indexes]
+
+
+def get_cache_file(cache_dir, *key):
+    """
+    Gets the file that an index is cached in
+    :param cache_dir: (string) The folder of the cache, None if the cache is not used
+    :param key: The values that identify the index (ex. the tracks url, the worker and the day)
+    :return: (string) The cache file, None if the cache is not used
+    """
+    if not cache_dir:
+        return None
+    return os.path.join(cache_dir, "{}.pickle".format(hashlib.sha1(repr(key).encode("utf-8")).hexdigest()))
+
+
+def read_cache(cache_file):
+    """
+    Reads a cached index
+    :param cache_file: (string) The cache file (from get_cache_file)
+    :return: (dict) The index, None if it is not cached
+    """
+    if not cache_file or not os.path.exists(cache_file):
+        return None
+    with open(cache_file, 'rb') as f:
+        return pickle.load(f)
+
+
+def write_cache(cache_file, track_index, end, settle_time=86400000):
+    """
+    Caches an index. Tracks can be uploaded some time after they are created (ex. when the worker was offline), so
+    the index is only cached once the end of its time span is older than the settle time
+    :param cache_file: (string) The cache file (from get_cache_file)
+    :param track_index: (dict) The index to cache (from build_track_index)
+    :param end: (int) The end of the time span of the tracks (milliseconds since the epoch)
+    :param settle_time: (int) How long (in milliseconds) to wait for tracks to be uploaded
+    :return:
+    """
+    if not cache_file or end > time.time() * 1000 - settle_time:
+        return
+    if not os.path.exists(os.path.dirname(cache_file)):
+        os.makedirs(os.path.dirname(cache_file))
+    # Write to a temporary file first, so that an interrupted write does not leave a partial index behind
+    with open(cache_file + ".tmp", 'wb') as f:
+        pickle.dump(track_index, f, pickle.HIGHEST_PROTOCOL)
+    if os.path.exists(cache_file):
+        os.remove(cache_file)
+    os.rename(cache_file + ".tmp", cache_file)
+
+
+def get_track_indexes(fetch, start, end, cell_size, cache_dir=None, cache_key=()):
+    """
+    Gets the indexed tracks for a time span. Without a cache, the tracks are fetched once for the whole time span.
+    With a cache, the tracks are indexed (and cached) by day, and only the days that are not cached are fetched (one
+    request for each run of consecutive days)
+    :param fetch: (function) Gets the tracks created between two times (milliseconds since the epoch)
+    :param start: (int) The start of the time span (milliseconds since the epoch)
+    :param end: (int) The end of the time span (milliseconds since the epoch)
+    :param cell_size: (float) The size of the grid cells (ex. the distance tolerance)
+    :param cache_dir: (string) The folder to cache the indexes in
+    :param cache_key: (tuple) The values that identify the tracks (ex. the tracks url and the worker)
+    :return: (list<dict>) The indexes
+    """
+    if not cache_dir:
+        return [build_track_index(fetch(start, end), cell_size)]
+    days = list(range(int(start // DAY), int(end // DAY) + 1))
+    track_indexes = {}
+    for day in days:
+        track_index = read_cache(get_cache_file(cache_dir, cache_key, day))
+        if track_index is not None:
+            track_indexes[day] = track_index
+    missing_days = [day for day in days if day not in track_indexes]
+    while missing_days:
+        run = [missing_days.pop(0)]
+        while missing_days and missing_days[0] == run[-1] + 1:
+            run.append(missing_days.pop(0))
+        tracks_by_day = {}
+        for track in fetch(run[0] * DAY, (run[-1] + 1) * DAY - 1):
+            tracks_by_day.setdefault(int(track[0] // DAY), []).append(track)
+        for day in run:
+            track_indexes[day] = build_track_index(tracks_by_day.get(day, []), cell_size)
+            write_cache(get_cache_file(cache_dir, cache_key, day), track_indexes[day], (day + 1) * DAY)
+    return [track_indexes[day] for day in days]
+
+
+def get_nearest_distance(track_indexes, x, y, start, end, distance_tolerance, include_center=True, mode="planar",
+                         stats=None):
+    """
+    Gets the smallest distance between a point and the tracks created during a time window. Only the tracks that
+    could be within the distance tolerance are checked (a track can only be within the distance tolerance if the
+    track itself is within the distance tolerance plus the distance to the corners of its accuracy)
+    :param track_indexes: (list<dict>) The indexes (from get_track_indexes)
+    :param x: (float) The x coordinate of the point
+    :param y: (float) The y coordinate of the point
+    :param start: (int) The start of the window (milliseconds since the epoch)
+    :param end: (int) The end of the window (milliseconds since the epoch)
+    :param distance_tolerance: (int or float) The distance tolerance to use
+    :param include_center: (bool) Check the track itself as well as the four corners of its accuracy
+    :param mode: (string) The distance mode (from get_distance_mode)
+    :param stats: (dict) If provided, the number of tracks that were checked is added to its "candidates"
+    :return: (float) The smallest distance, None if there are no tracks near the point
+    """
+    nearest = None
+    for track_index in track_indexes:
+        if not len(track_index["times"]) or track_index["times"][0] > end or track_index["times"][-1] < start:
+            continue
+        radius, radius_y = get_search_radius(distance_tolerance + track_index["max_accuracy"] * math.sqrt(2), y, mode)
+        candidates = get_candidate_tracks(track_index, x, y, start, end, radius, radius_y)
+        if stats is not None:
+            stats["candidates"] = stats.get("candidates", 0) + len(candidates)
+        distance = get_min_distance(candidates, x, y, include_center, mode)
+        if distance is not None and (nearest is None or distance < nearest):
+            nearest = distance
+    return nearest
+
+
+def check_completion(track_indexes, x, y, completion_date, time_tolerance, distance_tolerance, include_center=True,
+                     mode="planar", trajectory=None):
+    """
+    Checks if the worker was near the assignment when it was completed, and reports how the verdict was reached
+    :param track_indexes: (list<dict>) The indexes of the worker's tracks (from get_track_indexes)
+    :param x: (float) The x coordinate of the assignment
+    :param y: (float) The y coordinate of the assignment
+    :param completion_date: (int) When the assignment was completed (milliseconds since the epoch)
+    :param time_tolerance: (int) The tolerance (in minutes) around the completion date
+    :param distance_tolerance: (int or float) The distance tolerance to use
+    :param include_center: (bool) Check the track itself as well as the four corners of its accuracy
+    :param mode: (string) The distance mode (from get_distance_mode)
+    :param trajectory: (dict) The trajectory of the worker (from build_trajectory), also check the interpolated
+    positions and the dwells of the worker if none of the tracks are within the distance tolerance
+    :return: (dict) The verdict (valid), the smallest distance that was found (distance, None if there are no tracks
+    near the assignment), the number of tracks that were checked (candidates) and the time spent (seconds)
+    """
+    start_time = time.time()
+    tolerance = time_tolerance * 60000
+    stats = {"candidates": 0}
+    distance = get_nearest_distance(track_indexes, x, y, completion_date - tolerance, completion_date + tolerance,
+                                    distance_tolerance, include_center, mode, stats)
+    if trajectory is not None and (distance is None or distance >= distance_tolerance):
+        trajectory_distance = get_trajectory_distance(trajectory, x, y, completion_date - tolerance,
+                                                      completion_date + tolerance, mode)
+        if trajectory_distance is not None and (distance is None or trajectory_distance < distance):
+            distance = trajectory_distance
+    return {
+        "valid": distance is not None and distance < distance_tolerance,
+        "distance": distance,
+        "candidates": stats["candidates"],
+        "seconds": time.time() - start_time
+    }
+
+
+def is_valid_completion(track_indexes, x, y, completion_date, time_tolerance, distance_tolerance,
+                        include_center=True, mode="planar", trajectory=None):
+    """
+    Checks if the worker was near the assignment when it was completed
+    :param track_indexes: (list<dict>) The indexes of the worker's tracks (from get_track_indexes)
+    :param x: (float) The x coordinate of the assignment
+    :param y: (float) The y coordinate of the assignment
+    :param completion_date: (int) When the assignment was completed (milliseconds since the epoch)
+    :param time_tolerance: (int) The tolerance (in minutes) around the completion date
+    :param distance_tolerance: (int or float) The distance tolerance to use
+    :param include_center: (bool) Check the track itself as well as the four corners of its accuracy
+    :param mode: (string) The distance mode (from get_distance_mode)
+    :param trajectory: (dict) The trajectory of the worker (from build_trajectory), also check the interpolated
+    positions and the dwells of the worker if none of the tracks are within the distance tolerance
+    :return: (bool) True if any of the tracks in the time window are within the distance tolerance
+    """
+    return check_completion(track_indexes, x, y, completion_date, time_tolerance, distance_tolerance, include_center,
+                            mode, trajectory)["valid"]
+
+
+def get_max_gap(update_interval, intervals=3):
+    """
+    Gets the largest time between two tracks to interpolate between them, from the tracking interval of the project
+    :param update_interval: (int) The tracking interval of the project (in seconds, tracks.updateInterval)
+    :param intervals: (int) The number of tracking intervals that can be missed
+    :return: (int) The largest time (in milliseconds) to interpolate over
+    """
+    return int((update_interval or 30) * 1000 * intervals)
+
+
+def get_segment_distance(ax, ay, bx, by):
+    """
+    Gets the distance between the origin and a line segment
+    :param ax: (float) The x offset of the start of the segment
+    :param ay: (float) The y offset of the start of the segment
+    :param bx: (float) The x offset of the end of the segment
+    :param by: (float) The y offset of the end of the segment
+    :return: (float) The distance
+    """
+    vx = bx - ax
+    vy = by - ay
+    length = vx ** 2 + vy ** 2
+    fraction = min(max(-(ax * vx + ay * vy) / length, 0), 1) if length > 0 else 0
+    return math.sqrt((ax + fraction * vx) ** 2 + (ay + fraction * vy) ** 2)
+
+
+def get_dwells(times, tracks, dwell_radius, min_duration, mode="planar"):
+    """
+    Finds where the worker stayed: runs of consecutive tracks that are within a radius of the first track of the run
+    and that last at least a minimum duration. Devices can report less often when they are not moving, so a dwell
+    covers the time between its first and last track, however long the gaps between its tracks are
+    :param times: (list<int>) The sorted CreationDates
+    :param tracks: (list<tuple>) The sorted tracks
+    :param dwell_radius: (float) The radius of a dwell (in meters unless the mode is planar)
+    :param min_duration: (int) The minimum duration (in milliseconds) of a dwell
+    :param mode: (string) The distance mode (from get_distance_mode)
+    :return: (list<tuple>) The start, end, x and y (the mean of its tracks) of each dwell, sorted by time
+    """
+    if numpy is not None and isinstance(tracks, numpy.ndarray):
+        tracks = tracks.tolist()
+    dwells = []
+    first = 0
+    for i in range(1, len(tracks) + 1):
+        if i < len(tracks):
+            scale_x, scale_y = get_scale((tracks[i][2] + tracks[first][2]) / 2, mode)
+            if math.sqrt(((tracks[i][1] - tracks[first][1]) * scale_x) ** 2 +
+                         ((tracks[i][2] - tracks[first][2]) * scale_y) ** 2) <= dwell_radius:
+                continue
+        # The run has ended
+        if i - first > 1 and times[i - 1] - times[first] >= min_duration:
+            run = tracks[first:i]
+            dwells.append((int(times[first]), int(times[i - 1]), sum(t[1] for t in run) / len(run),
+                           sum(t[2] for t in run) / len(run)))
+        first = i
+    return dwells
+
+
+def build_trajectory(track_indexes, max_gap, dwell_radius, mode="planar"):
+    """
+    Joins the indexed tracks of a worker into a trajectory, in one pass over the time sorted tracks. The position
+    between two consecutive tracks is interpolated if they are at most max_gap apart (ex. a few times the tracking
+    interval of the project), and the dwells are found (see get_dwells, the minimum duration is max_gap)
+    :param track_indexes: (list<dict>) The indexes (from get_track_indexes, in time order)
+    :param max_gap: (int) The largest time (in milliseconds) between two tracks to interpolate between them
+    :param dwell_radius: (float) The radius of a dwell (ex. the distance tolerance)
+    :param mode: (string) The distance mode (from get_distance_mode)
+    :return: (dict) The trajectory
+    """
+    track_indexes = [track_index for track_index in track_indexes if len(track_index["times"])]
+    if numpy is not None and track_indexes and isinstance(track_indexes[0]["tracks"], numpy.ndarray):
+        times = numpy.concatenate([track_index["times"] for track_index in track_indexes])
+        tracks = numpy.concatenate([track_index["tracks"] for track_index in track_indexes])
+    else:
+        times = [t for track_index in track_indexes for t in track_index["times"]]
+        tracks = [track for track_index in track_indexes for track in track_index["tracks"]]
+    dwells = get_dwells(times, tracks, dwell_radius, max_gap, mode)
+    return {
+        "times": times,
+        "tracks": tracks,
+        "max_gap": max_gap,
+        "dwells": dwells,
+        "dwell_ends": [dwell[1] for dwell in dwells]
+    }
+
+
+def get_segment_distances(tracks, x, y, start, end, max_gap, scale_x=1, scale_y=1):
+    """
+    Gets the smallest distance between a point and the segments between consecutive tracks, where the segments are cut
+    to a time window and the smaller accuracy of their tracks is subtracted. Segments that are longer than max_gap
+    (in time) are skipped
+    :param tracks: (list<tuple>) The consecutive tracks (sorted by time)
+    :param x: (float) The x coordinate of the point
+    :param y: (float) The y coordinate of the point
+    :param start: (int) The start of the window (milliseconds since the epoch)
+    :param end: (int) The end of the window (milliseconds since the epoch)
+    :param max_gap: (int) The largest time (in milliseconds) between two tracks to interpolate between them
+    :param scale_x: (float) The scale of the x offsets (from get_scale)
+    :param scale_y: (float) The scale of the y offsets (from get_scale)
+    :return: (float) The smallest distance, None if there are no segments
+    """
+    if numpy is not None and isinstance(tracks, numpy.ndarray):
+        a = tracks[:-1]
+        b = tracks[1:]
+        duration = b[:, 0] - a[:, 0]
+        keep = (duration <= max_gap) & (b[:, 0] >= start) & (a[:, 0] <= end)
+        if not keep.any():
+            return None
+        a, b, duration = a[keep], b[keep], numpy.maximum(duration[keep], 1)
+        # Cut the segments to the window
+        cut_a = numpy.clip((start - a[:, 0]) / duration, 0, 1)
+        cut_b = numpy.clip((end - a[:, 0]) / duration, 0, 1)
+        ax = (a[:, 1] + cut_a * (b[:, 1] - a[:, 1]) - x) * scale_x
+        ay = (a[:, 2] + cut_a * (b[:, 2] - a[:, 2]) - y) * scale_y
+        vx = (a[:, 1] + cut_b * (b[:, 1] - a[:, 1]) - x) * scale_x - ax
+        vy = (a[:, 2] + cut_b * (b[:, 2] - a[:, 2]) - y) * scale_y - ay
+        length = vx ** 2 + vy ** 2
+        fraction = numpy.clip(-(ax * vx + ay * vy) / numpy.maximum(length, 1e-12), 0, 1)
+        distances = numpy.sqrt((ax + fraction * vx) ** 2 + (ay + fraction * vy) ** 2)
+        return float(numpy.maximum(distances - numpy.minimum(a[:, 3], b[:, 3]), 0).min())
+    nearest = None
+    for (time_a, ax, ay, accuracy_a), (time_b, bx, by, accuracy_b) in zip(tracks[:-1], tracks[1:]):
+        duration = time_b - time_a
+        if duration > max_gap or time_b < start or time_a > end:
+            continue
+        # Cut the segment to the window
+        cut_a = max(start - time_a, 0) / float(duration) if duration else 0
+        cut_b = min(end - time_a, duration) / float(duration) if duration else 1
+        distance = get_segment_distance((ax + cut_a * (bx - ax) - x) * scale_x, (ay + cut_a * (by - ay) - y) * scale_y,
+                                        (ax + cut_b * (bx - ax) - x) * scale_x, (ay + cut_b * (by - ay) - y) * scale_y)
+        distance = max(distance - min(accuracy_a, accuracy_b), 0)
+        if nearest is None or distance < nearest:
+            nearest = distance
+    return nearest
+
+
+def get_trajectory_distance(trajectory, x, y, start, end, mode="planar"):
+    """
+    Gets the smallest distance between a point and the trajectory of a worker during a time window: the segments
+    between consecutive tracks (see get_segment_distances) and the dwells that overlap the time window
+    :param trajectory: (dict) The trajectory (from build_trajectory)
+    :param x: (float) The x coordinate of the point
+    :param y: (float) The y coordinate of the point
+    :param start: (int) The start of the window (milliseconds since the epoch)
+    :param end: (int) The end of the window (milliseconds since the epoch)
+    :param mode: (string) The distance mode (from get_distance_mode)
+    :return: (float) The smallest distance, None if the worker's position during the window is not known
+    """
+    times = trajectory["times"]
+    # The segments are scaled at the point (they are within the distance tolerance of it when they are near enough)
+    scale_x, scale_y = get_scale(y, mode)
+    # The segments that overlap the window start at the last track before the window, and end at the first track
+    # after the window
+    if numpy is not None and isinstance(times, numpy.ndarray):
+        first = max(int(numpy.searchsorted(times, start, "left")) - 1, 0)
+        last = int(numpy.searchsorted(times, end, "right"))
+    else:
+        first = max(bisect.bisect_left(times, start) - 1, 0)
+        last = bisect.bisect_right(times, end)
+    nearest = get_segment_distances(trajectory["tracks"][first:last + 1], x, y, start, end, trajectory["max_gap"],
+                                    scale_x, scale_y)
+    # Dwells do not overlap, so the dwells that overlap the window are a contiguous range
+    dwells = trajectory["dwells"]
+    for i in range(bisect.bisect_left(trajectory["dwell_ends"], start), len(dwells)):
+        dwell_start, _, dwell_x, dwell_y = dwells[i]
+        if dwell_start > end:
+            break
+        dwell_scale_x, dwell_scale_y = get_scale((dwell_y + y) / 2, mode)
+        distance = math.sqrt(((dwell_x - x) * dwell_scale_x) ** 2 + ((dwell_y - y) * dwell_scale_y) ** 2)
+        if nearest is None or distance < nearest:
+            nearest = distance
+    return nearest
+
+
+def get_settings(time_tolerance, distance_tolerance, min_accuracy, mode="planar", max_gap=None):
+    """
+    Describes the settings of a check, results from a check with different settings are not reused
+    :param time_tolerance: (int) The tolerance (in minutes) around the completion date
+    :param distance_tolerance: (int or float) The distance tolerance to use
+    :param min_accuracy: (int or float) The minimum accuracy to require
+    :param mode: (string) The distance mode (from get_distance_mode)
+    :param max_gap: (int) The largest time (in milliseconds) to interpolate over, None if the tracks are not
+    interpolated
+    :return: (string) The settings
+    """
+    settings = "timeTol={};distTol={};minAccuracy={};distanceMode={}".format(time_tolerance, distance_tolerance,
+                                                                             min_accuracy, mode)
+    if max_gap is not None:
+        settings += ";maxGap={}".format(max_gap)
+    return settings
+
+
+def initialize_state(db):
+    """
+    Initializes the state database and creates the tables if necessary
+    :param db: (string) The database to use
+    :return:
+    """
+    conn = sqlite3.connect(db)
+    c = conn.cursor()
+    c.execute("CREATE TABLE IF NOT EXISTS `Verdicts` ( "
+              "`GlobalID` TEXT, "
+              "`OBJECTID` INTEGER, "
+              "`completedDate` INTEGER, "
+              "`EditDate` INTEGER, "
+              "`valid` INTEGER, "
+              "`settings` TEXT, "
+              "PRIMARY KEY(`GlobalID`) )")
+    c.execute("CREATE TABLE IF NOT EXISTS `Watermarks` ( "
+              "`project` TEXT, "
+              "`worker` TEXT, "
+              "`completedDate` INTEGER, "
+              "`EditDate` INTEGER, "
+              "`settings` TEXT, "
+              "PRIMARY KEY(`project`, `worker`) )")
+    conn.commit()
+    conn.close()
+
+
+def get_watermarks(db, project_id, worker, settings):
+    """
+    Gets the latest completedDate and EditDate of the assignments of a worker that were checked by earlier runs
+    :param db: (string) The database to use, None if the state is not used
+    :param project_id: (string) The project
+    :param worker: (string) The worker
+    :param settings: (string) The settings of the check (from get_settings)
+    :return: (tuple) The completedDate and EditDate (milliseconds since the epoch), (None, None) if there are none
+    """
+    if not db:
+        return None, None
+    conn = sqlite3.connect(db)
+    c = conn.cursor()
+    c.execute("SELECT completedDate, EditDate FROM Watermarks WHERE project = ? AND worker = ? AND settings = ?",
+              (project_id, worker, settings))
+    row = c.fetchone()
+    conn.close()
+    return tuple(row) if row else (None, None)
+
+
+def get_watermark_query(completed_watermark, edited_watermark):
+    """
+    Makes the where clause that selects the assignments that were completed or edited after the watermarks
+    :param completed_watermark: (int) The latest completedDate that was checked (milliseconds since the epoch)
+    :param edited_watermark: (int) The latest EditDate that was checked (milliseconds since the epoch)
+    :return: (string) The where clause, None if there are no watermarks
+    """
+    if completed_watermark is None or edited_watermark is None:
+        return None
+    # The dates are rounded down to the second, so some assignments may be selected again (see get_verdicts)
+    return "(completedDate > '{}' OR EditDate > '{}')".format(format_query_date(completed_watermark),
+                                                              format_query_date(edited_watermark))
+
+
+def get_verdicts(db, global_ids, settings):
+    """
+    Gets the EditDate of the assignments when they were checked by earlier runs. An assignment only needs to be checked
+    again if its EditDate has changed
+    :param db: (string) The database to use, None if the state is not used
+    :param global_ids: (list<string>) The GlobalIDs of the assignments
+    :param settings: (string) The settings of the check (from get_settings)
+    :return: (dict) The EditDate of each assignment (GlobalID) that was checked
+    """
+    if not db or not global_ids:
+        return {}
+    conn = sqlite3.connect(db)
+    c = conn.cursor()
+    verdicts = {}
+    # SQLite limits the number of parameters of a statement
+    for i in range(0, len(global_ids), 500):
+        chunk = global_ids[i:i + 500]
+        c.execute("SELECT GlobalID, EditDate FROM Verdicts WHERE settings = ? AND GlobalID IN ({})".format(
+            ",".join("?" * len(chunk))), [settings] + list(chunk))
+        verdicts.update(c.fetchall())
+    conn.close()
+    return verdicts
+
+
+def save_state(db, project_id, results, settings):
+    """
+    Saves the verdicts of the checked assignments and moves the watermarks of their workers forward
+    :param db: (string) The database to use, None if the state is not used
+    :param project_id: (string) The project
+    :param results: (list<dict>) The results of the checked assignments (GlobalID, OBJECTID, worker, completedDate,
+    EditDate and valid)
+    :param settings: (string) The settings of the check (from get_settings)
+    :return:
+    """
+    if not db:
+        return
+    conn = sqlite3.connect(db)
+    c = conn.cursor()
+    c.executemany("INSERT OR REPLACE INTO Verdicts VALUES (?, ?, ?, ?, ?, ?)",
+                  [(result["GlobalID"], result["OBJECTID"], result["completedDate"], result["EditDate"],
+                    1 if result["valid"] else 0, settings) for result in results])
+    watermarks = {}
+    for result in results:
+        # The dates are None when editor tracking is disabled, which does not move the watermarks
+        completed, edited = watermarks.get(result["worker"], (0, 0))
+        watermarks[result["worker"]] = (max(completed, result["completedDate"] or 0),
+                                        max(edited, result["EditDate"] or 0))
+    for worker, (completed, edited) in watermarks.items():
+        c.execute("SELECT completedDate, EditDate FROM Watermarks WHERE project = ? AND worker = ? AND settings = ?",
+                  (project_id, worker, settings))
+        row = c.fetchone()
+        if row:
+            completed = max(completed, row[0] or 0)
+            edited = max(edited, row[1] or 0)
+        c.execute("INSERT OR REPLACE INTO Watermarks VALUES (?, ?, ?, ?, ?)",
+                  (project_id, worker, completed, edited, settings))
+    conn.commit()
+    conn.close()
+
+
+def add_timing(timings, phase, start_time):
+    """
+    Adds the time since start_time to a phase of the check
+    :param timings: (dict) The seconds spent in each phase, None if the timings are not kept
+    :param phase: (string) The phase (fetch, index, evaluate or write)
+    :param start_time: (float) When the phase started (from time.time())
+    :return:
+    """
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0) + time.time() - start_time
+
+
+def get_timings(worker_timings, write_timings=None):
+    """
+    Gets the timings of the check: the seconds spent in each phase (fetch, index, evaluate and write), overall and by
+    worker. The overall timings are the sums of the workers (that can be checked at the same time)
+    :param worker_timings: (dict) The timings of each worker (of check_completion_location.py)
+    :param write_timings: (dict) The time spent copying the invalid assignments and saving the state
+    :return: (dict) The overall (phases) and worker (workers) timings
+    """
+    phases = dict((phase, 0) for phase in ("fetch", "index", "evaluate", "write"))
+    for timings in worker_timings.values():
+        for phase, seconds in timings.items():
+            phases[phase] += seconds
+    for phase, seconds in (write_timings or {}).items():
+        phases[phase] += seconds
+    return {"phases": phases, "workers": worker_timings}
+
+
+def write_report(report_file, results, timings, settings):
+    """
+    Writes the results of the checked assignments and the timings of the check to a report. Parquet files (.parquet)
+    hold one row per assignment, with the settings and timings stored as json in the metadata of the file. Other files
+    are written as json
+    :param report_file: (string) The file to write the report to, None if the report is not used
+    :param results: (list<dict>) The results of the checked assignments (GlobalID, OBJECTID, worker, completedDate,
+    EditDate, valid, distance, candidates and seconds)
+    :param timings: (dict) The seconds spent in each phase of the check, overall and by worker
+    :param settings: (string) The settings of the check (from get_settings)
+    :return:
+    """
+    if not report_file:
+        return
+    columns = [("GlobalID", "string"), ("OBJECTID", "int64"), ("worker", "string"), ("completedDate", "int64"),
+               ("EditDate", "int64"), ("valid", "bool_"), ("distance", "float64"), ("candidates", "int64"),
+               ("seconds", "float64")]
+    rows = [dict((column, result.get(column)) for column, _ in columns) for result in results]
+    if os.path.splitext(report_file)[1].lower() == ".parquet":
+        if pyarrow is not None:
+            # The types are explicit, so that a column without values (ex. no distances) keeps its type
+            table = pyarrow.Table.from_arrays([pyarrow.array([row[column] for row in rows], getattr(pyarrow, type_)())
+                                               for column, type_ in columns], names=[column for column, _ in columns])
+            table = table.replace_schema_metadata({"settings": settings, "timings": json.dumps(timings)})
+            pyarrow.parquet.write_table(table, report_file)
+            return
+        report_file = "{}.json".format(os.path.splitext(report_file)[0])
+        logging.getLogger().warning("PyArrow is not installed, writing the report as json to {}".format(report_file))
+    with open(report_file, 'w') as f:
+        json.dump({"settings": settings, "timings": timings, "assignments": rows}, f, indent=2)
@@ -24,8 +24,11 @@
 """
 import arcrest
 from arcresthelper import securityhandlerhelper
+import json
 import logging
+import os
 import sys
+import uuid
 
 
 def get_security_handler(args):
@@ -115,6 +118,104 @@ def get_workers_feature_layer(shh, projectId):
     return arcrest.agol.FeatureLayer(project_data["workers"]["url"], securityHandler=shh.securityhandler)
 
 
+def query_feature_layer_pages(feature_layer, where="1=1", out_fields="*", page_size=1000, out_sr=None):
+    """
+    Queries the feature layer one page at a time (by OBJECTID), so that layers larger than maxRecordCount can be read
+    :param feature_layer: (ArcREST Feature Layer Object) The feature layer to query
+    :param where: (string) The where clause to use
+    :param out_fields: (CSV string) The fields to return
+    :param page_size: (int) The number of features to request at a time (should not exceed maxRecordCount)
+    :param out_sr: (int) The wkid of the spatial reference to return the geometries in
+    :return: (generator<list<dict>>) The pages of features (as dictionaries)
+    """
+    oids = sorted(feature_layer.query(where=where, returnIDsOnly=True).get("objectIds") or [])
+    for i in range(0, len(oids), page_size):
+        kwargs = {"outSR": out_sr} if out_sr else {}
+        features = feature_layer.query(objectIds=",".join(str(oid) for oid in oids[i:i + page_size]),
+                                       out_fields=out_fields, **kwargs).features
+        yield [feature.asDictionary for feature in features]
+
+
+def chunk_list(items, chunk_size):
+    """
+    Splits a list into smaller lists
+    :param items: (list) The list to split
+    :param chunk_size: (int) The maximum size of each smaller list
+    :return: (list<list>) The smaller lists
+    """
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+
+def get_global_id_key(global_id):
+    """
+    Converts a GlobalID to a compact key for lookups (the 16 bytes of the UUID, rather than its 38 character string).
+    Braces and case are ignored, so "{0A1B...}" and "0a1b..." have the same key
+    :param global_id: (string) The GlobalID
+    :return: (bytes) The key, or the GlobalID itself if it is not a UUID
+    """
+    try:
+        return uuid.UUID(global_id).bytes
+    except (AttributeError, TypeError, ValueError):
+        return global_id
+
+
+def index_global_ids(pages, global_id_field):
+    """
+    Builds a set of the GlobalID keys of the features as the pages are read, so that only the keys (and not every
+    feature) are held in memory
+    :param pages: (iterable<list<dict>>) The pages of features (as dictionaries)
+    :param global_id_field: (string) The field that stores the GlobalID
+    :return: (set<bytes>) The GlobalID keys
+    """
+    keys = set()
+    for page in pages:
+        keys.update(get_global_id_key(feature["attributes"][global_id_field]) for feature in page)
+    return keys
+
+
+def read_journal(journal_file):
+    """
+    Reads the entries of a journal (a file with one json entry per line)
+    :param journal_file: (string) The journal file to read
+    :return: (list<dict>) The entries, an empty list if the file does not exist
+    """
+    if not journal_file or not os.path.exists(journal_file):
+        return []
+    entries = []
+    with open(journal_file, 'r') as f:
+        for line in f:
+            # A partially written last line (the process was killed) is ignored
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                logging.getLogger().warning("Ignoring invalid journal entry: {}".format(line.strip()))
+    return entries
+
+
+def write_journal_entry(journal_file, entry):
+    """
+    Appends an entry to a journal (a file with one json entry per line)
+    :param journal_file: (string) The journal file to write to
+    :param entry: (dict) The entry to append
+    :return:
+    """
+    if not journal_file:
+        return
+    # If the last entry was only partially written (the process was killed), it is ended first, so that the new entry
+    # is not joined to it
+    terminated = True
+    if os.path.exists(journal_file) and os.path.getsize(journal_file):
+        with open(journal_file, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            terminated = f.read(1) == b"\n"
+    with open(journal_file, 'a') as f:
+        if not terminated:
+            f.write("\n")
+        f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
 def initialize_logging(logFile):
     """
     Setup the root logger to print to the console and log to file
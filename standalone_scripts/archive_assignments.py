@@ -0,0 +1,177 @@
+# -*- coding: UTF-8 -*-
+"""
+   Copyright 2016 Esri
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+
+   you may not use this file except in compliance with the License.
+
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+
+   distributed under the License is distributed on an "AS IS" BASIS,
+
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+
+   See the License for the specific language governing permissions and
+
+   limitations under the License.​
+
+    This sample archives assignments to another feature service and then deletes them from the project, one page
+    at a time
+"""
+import argparse
+import json
+import logging
+import logging.handlers
+import traceback
+import fieldmapper
+import workforcehelpers
+import copy_assignments_fs
+
+
+def get_archived_global_ids(target_fl_url, token, global_id_field, global_ids):
+    """
+    Gets which of the provided GlobalIDs are already in the archive. The archive can store them in another format
+    (ex. lowercase or without braces), which the IN query matches, so they are compared by their keys
+    :param target_fl_url: (string) The archive feature layer url
+    :param token: (string) The token to authenticate with
+    :param global_id_field: (string) The field of the archive that stores the original GlobalID
+    :param global_ids: (list<string>) The GlobalIDs to look for
+    :return: (set<bytes>) The keys (from workforcehelpers.get_global_id_key) of the GlobalIDs that are already archived
+    """
+    if not global_ids:
+        return set()
+    where = "{} IN ({})".format(global_id_field, ",".join("'{}'".format(global_id) for global_id in global_ids))
+    return workforcehelpers.index_global_ids(
+        workforcehelpers.query_feature_layer_pages(target_fl_url, token, where=where, outFields=global_id_field),
+        global_id_field)
+
+
+def archive_page(assignments, target_fl_url, token, field_mappings, map_page):
+    """
+    Archives a page of assignments. Assignments that are already archived (ex. by an interrupted run) are not added
+    again
+    :param assignments: (list<dict>) The page of assignments to archive
+    :param target_fl_url: (string) The archive feature layer url
+    :param token: (string) The token to authenticate with
+    :param field_mappings: (dict) The mapping of the assignment fields to the archive fields
+    :param map_page: (function) The compiled field mappings
+    :return: (list<int>) The OBJECTIDs of the assignments that are confirmed to be in the archive
+    """
+    global_ids = [assignment["attributes"]["GlobalID"] for assignment in assignments]
+    archived = get_archived_global_ids(target_fl_url, token, field_mappings["GlobalID"], global_ids)
+    confirmed_oids = [a["attributes"]["OBJECTID"] for a in assignments
+                      if workforcehelpers.get_global_id_key(a["attributes"]["GlobalID"]) in archived]
+    assignments_to_add = [a for a in assignments
+                          if workforcehelpers.get_global_id_key(a["attributes"]["GlobalID"]) not in archived]
+    if assignments_to_add:
+        features = [{'geometry': assignment["geometry"], 'attributes': attributes} for assignment, attributes in
+                    zip(assignments_to_add, map_page([assignment["attributes"] for assignment in assignments_to_add]))]
+        response = workforcehelpers.add_features(target_fl_url, token, features)
+        if "error" in response:
+            logging.getLogger().error(response["error"])
+        # The addResults are in the same order as the submitted features
+        for assignment, result in zip(assignments_to_add, response.get("addResults", [])):
+            if result["success"]:
+                confirmed_oids.append(assignment["attributes"]["OBJECTID"])
+            else:
+                logging.getLogger().error("Failed to archive {}: {}".format(assignment["attributes"]["OBJECTID"],
+                                                                            result.get("error")))
+    return confirmed_oids
+
+
+def archive_assignments(assignment_fl_url, target_fl_url, field_mappings, token, where, page_size=500,
+                        map_page=None):
+    """
+    Archives the assignments that match the where clause, and deletes them from the project, one page at a time.
+    Only assignments that are confirmed to be in the archive are deleted, and only a single page of assignments is
+    held in memory
+    :param assignment_fl_url: (string) The assignments feature layer url
+    :param target_fl_url: (string) The archive feature layer url
+    :param field_mappings: (dict) The mapping of the assignment fields to the archive fields
+    :param token: (string) The token to authenticate with
+    :param where: (string) The where clause used to select the assignments to archive
+    :param page_size: (int) The number of assignments to archive and delete at a time
+    :param map_page: (function) The compiled field mappings (compiled from field_mappings if not provided)
+    :return: (tuple) The number of archived and deleted assignments, the OBJECTIDs that were not archived or deleted
+    """
+    map_page = map_page or fieldmapper.compile_field_mappings(field_mappings)
+    target_fl_data = workforcehelpers.get_feature_layer(target_fl_url, token)
+    out_sr = target_fl_data["extent"]["spatialReference"]["wkid"]
+    deleted_count = 0
+    skipped_oids = []
+    for page in workforcehelpers.query_feature_layer_pages(assignment_fl_url, token, where=where, outSR=out_sr,
+                                                           page_size=page_size):
+        page_oids = [assignment["attributes"]["OBJECTID"] for assignment in page]
+        # Archive the page first, then delete only what the archive confirmed
+        confirmed_oids = archive_page(page, target_fl_url, token, field_mappings, map_page)
+        deleted_oids = set()
+        if confirmed_oids:
+            response = workforcehelpers.delete_features(assignment_fl_url, token, confirmed_oids)
+            if "error" in response:
+                logging.getLogger().error(response["error"])
+            deleted_oids = set(r["objectId"] for r in response.get("deleteResults", []) if r["success"])
+        deleted_count += len(deleted_oids)
+        skipped_oids.extend(oid for oid in page_oids if oid not in deleted_oids)
+        logging.getLogger().info("Archived and deleted {} assignments ({} skipped)".format(deleted_count,
+                                                                                           len(skipped_oids)))
+    return deleted_count, skipped_oids
+
+
+def main(args):
+    # Authenticate
+    logging.getLogger().info("Authenticating...")
+    token = workforcehelpers.get_token(args.org_url, args.username, args.password)
+    # Get the assignments feature layer
+    logging.getLogger().info("Getting assignments feature layer...")
+    assignment_fl_url = workforcehelpers.get_assignments_feature_layer_url(args.org_url, token, args.projectId)
+    # Open the field mappings config file
+    logging.getLogger().info("Reading field mappings...")
+    with open(args.configFile, 'r') as f:
+        field_mappings = json.load(f)
+    # Compile the field mappings once (the rest of the script only needs the names of the target fields)
+    map_page = fieldmapper.compile_field_mappings(field_mappings)
+    field_mappings = fieldmapper.get_target_fields(field_mappings)
+    logging.getLogger().info("Validating field mappings...")
+    if not copy_assignments_fs.validate_config(field_mappings, args.targetFL, token):
+        logging.getLogger().critical("Invalid field mappings detected")
+        return
+    logging.getLogger().info("Archiving assignments...")
+    deleted_count, skipped_oids = archive_assignments(assignment_fl_url, args.targetFL, field_mappings, token,
+                                                      args.where, args.pageSize, map_page)
+    if skipped_oids:
+        logging.getLogger().error("{} assignments were not archived and deleted: {}".format(len(skipped_oids),
+                                                                                             skipped_oids))
+    logging.getLogger().info("Archived and deleted {} assignments".format(deleted_count))
+    logging.getLogger().info("Completed")
+
+
+if __name__ == "__main__":
+    # Get all of the commandline arguments
+    parser = argparse.ArgumentParser("Archive and delete assignments from Workforce Project")
+    parser.add_argument('-u', dest='username', help="The username to authenticate with", required=True)
+    parser.add_argument('-p', dest='password', help="The password to authenticate with", required=True)
+    parser.add_argument('-url', dest='org_url', help="The url of the org/portal to use", required=True)
+    # Parameters for workforce
+    parser.add_argument('-pid', dest='projectId', help="The id of the project to archive assignments from",
+                        required=True)
+    parser.add_argument('-where', dest='where', help="The where clause used to select the assignments to archive",
+                        required=True)
+    parser.add_argument('-targetFL', dest='targetFL', help="The feature layer to archive the assignments to",
+                        required=True)
+    parser.add_argument('-configFile', dest="configFile", help="The json configuration file to use", required=True)
+    parser.add_argument('-logFile', dest='logFile', help="The log file to write to", required=True)
+    parser.add_argument('-pageSize', dest='pageSize', type=int, default=500,
+                        help="The number of assignments to archive and delete at a time")
+    args = parser.parse_args()
+    workforcehelpers.initialize_logging(args.logFile)
+    try:
+        main(args)
+    except Exception as e:
+        logging.getLogger().critical("Exception detected, script exiting")
+        logging.getLogger().critical(e)
+        logging.getLogger().critical(traceback.format_exc().replace("\n", " | "))
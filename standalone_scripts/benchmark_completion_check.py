@@ -0,0 +1,186 @@
+# -*- coding: UTF-8 -*-
+"""
+   Copyright 2017 Esri
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+
+   you may not use this file except in compliance with the License.
+
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+
+   distributed under the License is distributed on an "AS IS" BASIS,
+
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+
+   See the License for the specific language governing permissions and
+
+   limitations under the License.​
+
+    This benchmarks the completion location checks of trackhelpers.py (the indexed tracks) against the original loop
+    (five coordinate tuples per track) using randomly generated tracks, and compares the distance modes (planar, Web
+    Mercator and geographic) on the same tracks. No requests are made
+"""
+import argparse
+import math
+import random
+import time
+import trackhelpers
+
+
+def loop_is_valid_completion(times, tracks, x, y, completion_date, time_tolerance, distance_tolerance):
+    """
+    The original check, which builds the track and the four corners of its accuracy and compares each distance
+    :param times: (list<int>) The sorted CreationDates of the tracks
+    :param tracks: (list<tuple>) The sorted tracks
+    :param x: (float) The x coordinate of the assignment
+    :param y: (float) The y coordinate of the assignment
+    :param completion_date: (int) When the assignment was completed (milliseconds since the epoch)
+    :param time_tolerance: (int) The tolerance (in minutes) around the completion date
+    :param distance_tolerance: (int or float) The distance tolerance to use
+    :return: (bool) True if any of the tracks in the time window are within the distance tolerance
+    """
+    tolerance = time_tolerance * 60000
+    for _, track_x, track_y, accuracy in trackhelpers.get_tracks_in_window(times, tracks, completion_date - tolerance,
+                                                                           completion_date + tolerance):
+        coords = [(track_x, track_y),
+                  (track_x + accuracy, track_y + accuracy),
+                  (track_x + accuracy, track_y - accuracy),
+                  (track_x - accuracy, track_y + accuracy),
+                  (track_x - accuracy, track_y - accuracy)]
+        distances = [trackhelpers.get_simple_distance((x, y), coordinates) for coordinates in coords]
+        if any(distance < distance_tolerance for distance in distances):
+            return True
+    return False
+
+
+def generate_tracks(count, start, span, extent):
+    """
+    Generates random tracks
+    :param count: (int) The number of tracks
+    :param start: (int) The earliest CreationDate (milliseconds since the epoch)
+    :param span: (int) The length of time (in milliseconds) that the tracks cover
+    :param extent: (float) The width and height of the area that the tracks cover
+    :return: (list<tuple>) The tracks
+    """
+    return [(start + random.randint(0, span), random.uniform(0, extent), random.uniform(0, extent),
+             random.uniform(0, 50)) for _ in range(count)]
+
+
+def to_mode(x, y, mode, latitude=45.0):
+    """
+    Converts a location (in meters from the origin) to the coordinates of a distance mode, placing the origin at a
+    latitude so that the distances are (about) the same in every mode
+    :param x: (float) The x coordinate (in meters)
+    :param y: (float) The y coordinate (in meters)
+    :param mode: (string) The distance mode (planar, mercator or geographic)
+    :param latitude: (float) The latitude of the origin (in degrees)
+    :return: (tuple) The coordinates
+    """
+    if mode == "mercator":
+        scale = 1 / math.cos(math.radians(latitude))
+        origin = trackhelpers.WEB_MERCATOR_RADIUS * math.log(math.tan(math.pi / 4 + math.radians(latitude) / 2))
+        return x * scale, origin + y * scale
+    if mode == "geographic":
+        return (math.degrees(x / (trackhelpers.EARTH_RADIUS * math.cos(math.radians(latitude)))),
+                latitude + math.degrees(y / trackhelpers.EARTH_RADIUS))
+    return x, y
+
+
+def compare_modes(tracks, assignments, time_tolerance, distance_tolerance):
+    """
+    Checks the same tracks and assignments in each distance mode. The locations are converted using the scale at the
+    origin, so a few verdicts can differ where a distance is within the change of scale across the extent
+    :param tracks: (list<tuple>) The tracks (in meters)
+    :param assignments: (list<tuple>) The x, y (in meters) and completion date of the assignments
+    :param time_tolerance: (int) The tolerance (in minutes) around the completion date
+    :param distance_tolerance: (int or float) The distance tolerance (in meters)
+    :return:
+    """
+    verdicts = {}
+    for mode in ("planar", "mercator", "geographic"):
+        mode_tracks = [(t[0],) + to_mode(t[1], t[2], mode) + (t[3],) for t in tracks]
+        mode_assignments = [to_mode(x, y, mode) + (completed,) for x, y, completed in assignments]
+        track_indexes = [trackhelpers.build_track_index(mode_tracks,
+                                                        trackhelpers.get_cell_size(distance_tolerance, mode))]
+        start_time = time.time()
+        verdicts[mode] = [trackhelpers.is_valid_completion(track_indexes, x, y, completed, time_tolerance,
+                                                           distance_tolerance, mode=mode)
+                          for x, y, completed in mode_assignments]
+        seconds = time.time() - start_time
+        if mode == "planar":
+            planar_seconds = seconds
+        print("{} mode: {:.3f} seconds ({:.2f}x planar), {} verdicts differ from planar".format(
+            mode, seconds, seconds / max(planar_seconds, 1e-9),
+            len([1 for p, m in zip(verdicts["planar"], verdicts[mode]) if p != m])))
+
+
+def main(args):
+    random.seed(args.seed)
+    start = 1500000000000
+    span = args.days * 86400000
+    tracks = generate_tracks(args.points, start, span, args.extent)
+    assignments = [(random.uniform(0, args.extent), random.uniform(0, args.extent), start + random.randint(0, span))
+                   for _ in range(args.assignments)]
+    print("{} tracks, {} assignments, NumPy {}, SciPy {}".format(
+        args.points, args.assignments, "installed" if trackhelpers.numpy is not None else "not installed",
+        "installed" if trackhelpers.cKDTree is not None else "not installed"))
+
+    # The original loop always works on lists of tuples
+    times, sorted_tracks = sorted(t[0] for t in tracks), sorted(tracks)
+    start_time = time.time()
+    expected = [loop_is_valid_completion(times, sorted_tracks, x, y, completed, args.timeTol, args.distTol)
+                for x, y, completed in assignments]
+    loop_seconds = time.time() - start_time
+    print("Original loop: {:.3f} seconds".format(loop_seconds))
+
+    start_time = time.time()
+    track_indexes = [trackhelpers.build_track_index(tracks, args.distTol)]
+    index_seconds = time.time() - start_time
+    start_time = time.time()
+    actual = [trackhelpers.is_valid_completion(track_indexes, x, y, completed, args.timeTol, args.distTol)
+              for x, y, completed in assignments]
+    check_seconds = time.time() - start_time
+    print("trackhelpers ({}): {:.3f} seconds (+ {:.3f} seconds to index the tracks), {:.1f}x faster".format(
+        "KD-tree" if "trees" in track_indexes[0] else "grid", check_seconds, index_seconds,
+        loop_seconds / max(check_seconds, 1e-9)))
+    mismatches = len([1 for e, a in zip(expected, actual) if e != a])
+    print("{} invalid completions, {} mismatches".format(len([1 for a in actual if not a]), mismatches))
+    if args.interpolate:
+        start_time = time.time()
+        trajectory = trackhelpers.build_trajectory(track_indexes, trackhelpers.get_max_gap(args.interval),
+                                                   args.distTol)
+        trajectory_seconds = time.time() - start_time
+        start_time = time.time()
+        interpolated = [trackhelpers.is_valid_completion(track_indexes, x, y, completed, args.timeTol, args.distTol,
+                                                         trajectory=trajectory)
+                        for x, y, completed in assignments]
+        print("Interpolated: {:.3f} seconds (+ {:.3f} seconds to build the trajectory, {} dwells), "
+              "{} more valid completions".format(time.time() - start_time, trajectory_seconds,
+                                                 len(trajectory["dwells"]),
+                                                 len([1 for a, i in zip(actual, interpolated) if i and not a])))
+    if args.compareModes:
+        compare_modes(tracks, assignments, args.timeTol, args.distTol)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Benchmark the completion location checks")
+    parser.add_argument('-points', dest='points', type=int, default=1000000, help="The number of tracks to generate")
+    parser.add_argument('-assignments', dest='assignments', type=int, default=2000,
+                        help="The number of completed assignments to check")
+    parser.add_argument('-days', dest='days', type=int, default=7, help="The number of days the tracks cover")
+    parser.add_argument('-extent', dest='extent', type=float, default=5000.0,
+                        help="The width and height of the area the tracks cover")
+    parser.add_argument('-timeTol', dest='timeTol', type=int, default=5, help="The time tolerance (in minutes)")
+    parser.add_argument('-distTol', dest='distTol', type=int, default=100, help="The distance tolerance")
+    parser.add_argument('-seed', dest='seed', type=int, default=0, help="The seed for the random tracks")
+    parser.add_argument('-interpolate', dest='interpolate', action='store_true', default=False,
+                        help="Also check the interpolated tracks and dwells")
+    parser.add_argument('-interval', dest='interval', type=int, default=30,
+                        help="The tracking interval (in seconds) to interpolate with")
+    parser.add_argument('-compareModes', dest='compareModes', action='store_true', default=False,
+                        help="Also compare the planar, Web Mercator and geographic distance modes")
+    main(parser.parse_args())
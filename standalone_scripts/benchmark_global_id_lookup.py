@@ -0,0 +1,113 @@
+# -*- coding: UTF-8 -*-
+"""
+   Copyright 2017 Esri
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+
+   you may not use this file except in compliance with the License.
+
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+
+   distributed under the License is distributed on an "AS IS" BASIS,
+
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+
+   See the License for the specific language governing permissions and
+
+   limitations under the License.​
+
+    This benchmarks the GlobalID lookups of copy_assignments_fs.py (a set of 16 byte keys, built as the target pages
+    are read) against the original list of GlobalID strings and a set of strings, using randomly generated GlobalIDs.
+    The list is only searched for a sample of the source GlobalIDs (it takes hours at 100k x 100k), and its time is
+    extrapolated. No requests are made
+"""
+import argparse
+import random
+import sys
+import time
+import uuid
+import workforcehelpers
+
+
+def generate_global_ids(count):
+    """
+    Generates random GlobalIDs, formatted as the feature service returns them
+    :param count: (int) The number of GlobalIDs
+    :return: (list<string>) The GlobalIDs
+    """
+    return ["{{{}}}".format(str(uuid.UUID(int=random.getrandbits(128), version=4)).upper()) for _ in range(count)]
+
+
+def get_size(index):
+    """
+    Gets the size (in bytes) of a list or set and of the keys it stores
+    :param index: (list or set) The GlobalIDs or keys
+    :return: (int) The size
+    """
+    return sys.getsizeof(index) + sum(sys.getsizeof(key) for key in index)
+
+
+def main(args):
+    random.seed(args.seed)
+    target = generate_global_ids(args.target)
+    # The source has the copied GlobalIDs (in the archive format) and new ones
+    copied = int(args.source * args.copied)
+    source = random.sample(target, min(copied, len(target))) + generate_global_ids(args.source - min(copied,
+                                                                                                     len(target)))
+    random.shuffle(source)
+    pages = workforcehelpers.chunk_list([{"attributes": {"GlobalID": g}} for g in target], args.pageSize)
+    print("{} target GlobalIDs, {} source GlobalIDs ({} already copied)".format(len(target), len(source),
+                                                                              min(copied, len(target))))
+
+    # The original list, searched for a sample of the source GlobalIDs
+    global_id_list = [feature["attributes"]["GlobalID"] for page in pages for feature in page]
+    sample = source[:args.listSample]
+    start_time = time.time()
+    expected = [g not in global_id_list for g in sample]
+    list_seconds = (time.time() - start_time) * len(source) / max(len(sample), 1)
+    print("List: {:.3f} seconds (extrapolated from {} lookups), {}".format(
+        list_seconds, len(sample), workforcehelpers.format_size(get_size(global_id_list))))
+
+    start_time = time.time()
+    global_id_set = set(feature["attributes"]["GlobalID"] for page in pages for feature in page)
+    index_seconds = time.time() - start_time
+    start_time = time.time()
+    string_results = [g not in global_id_set for g in source]
+    string_seconds = time.time() - start_time
+    print("Set of strings: {:.3f} seconds (+ {:.3f} seconds to index), {}, {:.0f}x faster than the list".format(
+        string_seconds, index_seconds, workforcehelpers.format_size(get_size(global_id_set)),
+        list_seconds / max(string_seconds, 1e-9)))
+
+    start_time = time.time()
+    global_id_keys = workforcehelpers.index_global_ids(iter(pages), "GlobalID")
+    index_seconds = time.time() - start_time
+    start_time = time.time()
+    key_results = [workforcehelpers.get_global_id_key(g) not in global_id_keys for g in source]
+    key_seconds = time.time() - start_time
+    print("Set of 16 byte keys: {:.3f} seconds (+ {:.3f} seconds to index), {}, {:.0f}x faster than the list".format(
+        key_seconds, index_seconds, workforcehelpers.format_size(get_size(global_id_keys)),
+        list_seconds / max(key_seconds, 1e-9)))
+    # The list is only checked for the sample
+    mismatches = len([1 for i, k in enumerate(key_results)
+                      if k != string_results[i] or (i < len(expected) and k != expected[i])])
+    print("{} assignments to copy, {} mismatches".format(len([1 for k in key_results if k]), mismatches))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Benchmark the GlobalID lookups of copy_assignments_fs")
+    parser.add_argument('-target', dest='target', type=int, default=100000,
+                        help="The number of archived assignments (GlobalIDs) in the target")
+    parser.add_argument('-source', dest='source', type=int, default=100000,
+                        help="The number of assignments (GlobalIDs) to copy from the source")
+    parser.add_argument('-copied', dest='copied', type=float, default=0.5,
+                        help="The fraction of the source assignments that are already in the target")
+    parser.add_argument('-listSample', dest='listSample', type=int, default=500,
+                        help="The number of source GlobalIDs to search the list for")
+    parser.add_argument('-pageSize', dest='pageSize', type=int, default=1000,
+                        help="The number of target features in each page")
+    parser.add_argument('-seed', dest='seed', type=int, default=0, help="The seed for the random GlobalIDs")
+    main(parser.parse_args())
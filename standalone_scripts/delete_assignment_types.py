@@ -72,12 +72,43 @@ def delete_assignment_types(org_url, token, projectId):
     return response
 
 
+def plan_delete_assignment_types(org_url, token, projectId):
+    """
+    Estimates the impact of deleting the assignment types, using a count query
+    :param org_url: (string) The organizational url to use
+    :param token: (string) The token to authenticate with
+    :param projectId: (string) The project Id
+    :return: (list<tuple>) The plan
+    """
+    assignments_url = workforcehelpers.get_assignments_feature_layer_url(org_url, token, projectId)
+    assignment_fl = workforcehelpers.get(assignments_url, params={'token': token, 'f': 'json'})
+    assignment_types = []
+    for field in assignment_fl["fields"]:
+        if field["name"] == "assignmentType":
+            assignment_types = field["domain"]["codedValues"]
+            field["domain"]["codedValues"] = []
+            break
+    # These assignments are left with an assignment type that no longer exists
+    affected = workforcehelpers.query_count(assignments_url, token, where="assignmentType IS NOT NULL")
+    return [
+        ("Assignment types to delete", len(assignment_types)),
+        ("Assignments using an assignment type", affected),
+        ("Requests", "3 (project, assignments definition, updateDefinition)"),
+        ("Batches", "1 updateDefinition request"),
+        ("Estimated payload", workforcehelpers.format_size(len(json.dumps(assignment_fl))))
+    ]
+
+
 def main(args):
     logger = logging.getLogger()
     logger.info("Authenticating...")
     # First step is to get authenticate and get a valid token
-    logger.info("Deleting assignment types")
     token = workforcehelpers.get_token(args.org_url, args.username, args.password)
+    if args.plan:
+        logger.info("Planning...")
+        workforcehelpers.log_plan(plan_delete_assignment_types(args.org_url, token, args.projectId))
+        return
+    logger.info("Deleting assignment types")
     delete_assignment_types(args.org_url, token, args.projectId)
     logger.info("Completed")
 
@@ -91,6 +122,8 @@ if __name__ == "__main__":
     # Parameters for workforce
     parser.add_argument('-pid', dest='projectId', help="The id of the project to add assignments to", required=True)
     parser.add_argument('-logFile', dest='logFile', help='The log file to use', required=True)
+    parser.add_argument('-plan', dest='plan', action='store_true',
+                        help="Only report what would be deleted without deleting it")
     args = parser.parse_args()
     workforcehelpers.initialize_logging(args.logFile)
     try:
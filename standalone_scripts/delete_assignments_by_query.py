@@ -26,28 +26,135 @@ import argparse
 import logging
 import logging.handlers
 import traceback
+from multiprocessing.pool import ThreadPool
 import workforcehelpers
 
 
-def delete_assignments(assignment_fl_url, token, objectIDs, where):
-    # Set the required parameters for the request
-    params = dict(
-        token=token,
-        f="json"
-    )
-    # If we have objectIds, then add them to the parameters as CSVs
+def get_existing_oids(assignment_fl_url, token, oids, chunk_size=500):
+    """
+    Gets which of the OBJECTIDs still exist in the assignments layer (a chunk at a time)
+    :param assignment_fl_url: (string) The assignments feature layer url
+    :param token: (string) The token to authenticate with
+    :param oids: (list<int>) The OBJECTIDs to check
+    :param chunk_size: (int) The number of OBJECTIDs to query at a time
+    :return: (set<int>) The OBJECTIDs that exist
+    """
+    existing = set()
+    for chunk in workforcehelpers.chunk_list(oids, chunk_size):
+        where = "OBJECTID IN ({})".format(",".join(str(oid) for oid in chunk))
+        existing.update(workforcehelpers.query_object_ids(assignment_fl_url, token, where))
+    return existing
+
+
+def get_oids_to_delete(assignment_fl_url, token, objectIDs, where, journal_file=None):
+    """
+    Gets the OBJECTIDs of the assignments to delete. If the journal of an interrupted purge exists, the OBJECTIDs
+    planned by that purge (that were not already deleted) are used, so that the purge resumes where it stopped
+    :param assignment_fl_url: (string) The assignments feature layer url
+    :param token: (string) The token to authenticate with
+    :param objectIDs: (list<string>) The OBJECTIDs to delete
+    :param where: (string) The where clause used to find the assignments to delete
+    :param journal_file: (string) The journal file used to record the progress of the purge
+    :return: (list<int>) The OBJECTIDs to delete
+    """
+    entries = workforcehelpers.read_journal(journal_file)
+    if entries:
+        logging.getLogger().info("Resuming purge from journal: {}".format(journal_file))
+        planned = entries[0]["planned"]
+        deleted = set()
+        for entry in entries[1:]:
+            deleted.update(entry["deleted"])
+        remaining = [oid for oid in planned if oid not in deleted]
+        # Chunks that were deleted just before the purge stopped may not have been journaled, so the remaining
+        # OBJECTIDs are checked, and the ones that no longer exist are treated as deleted
+        existing = get_existing_oids(assignment_fl_url, token, remaining)
+        if len(existing) < len(remaining):
+            logging.getLogger().info("{} planned assignments were already deleted".format(
+                len(remaining) - len(existing)))
+        return [oid for oid in remaining if oid in existing]
+    # If we have objectIds, then use them, otherwise resolve the query to OBJECTIDs
     if objectIDs:
-        params["objectIds"] = ",".join(objectIDs)
-    # if we have a query, then use it
+        oids = sorted(int(oid) for oid in objectIDs)
     elif where:
-        params["where"] = where
-    # if for some reason we have neither, let's just set the query to delete nothing
+        oids = workforcehelpers.query_object_ids(assignment_fl_url, token, where)
+    # if for some reason we have neither, let's just delete nothing
     else:
-        params["where"] = "1=0"  # don't delete anything
-    # Build the delete features url
-    delete_url = "{}/deleteFeatures".format(assignment_fl_url.rstrip("/"))
-    response = workforcehelpers.post(delete_url, params)
-    return response
+        oids = []
+    workforcehelpers.write_journal_entry(journal_file, {"planned": oids})
+    return oids
+
+
+def delete_assignments(assignment_fl_url, token, objectIDs, where, chunk_size=500, threads=4, journal_file=None):
+    """
+    Deletes the assignments in chunks of OBJECTIDs, submitting up to "threads" chunks at the same time. The
+    deleteResults of each chunk are verified and recorded in the journal (if provided)
+    :param assignment_fl_url: (string) The assignments feature layer url
+    :param token: (string) The token to authenticate with
+    :param objectIDs: (list<string>) The OBJECTIDs to delete
+    :param where: (string) The where clause used to find the assignments to delete
+    :param chunk_size: (int) The number of assignments to delete per request
+    :param threads: (int) The maximum number of requests to submit at the same time
+    :param journal_file: (string) The journal file used to record the progress of the purge
+    :return: (tuple) The list of deleted OBJECTIDs and the list of OBJECTIDs that failed to be deleted
+    """
+    oids = get_oids_to_delete(assignment_fl_url, token, objectIDs, where, journal_file)
+    chunks = workforcehelpers.chunk_list(oids, chunk_size)
+    logging.getLogger().info("Deleting {} assignments in {} chunks...".format(len(oids), len(chunks)))
+    deleted = []
+    failed = []
+    pool = ThreadPool(threads)
+    try:
+        results = pool.imap_unordered(
+            lambda chunk: (chunk, workforcehelpers.delete_features(assignment_fl_url, token, chunk)), chunks)
+        # The results are verified and journaled by this thread only, as each chunk completes
+        for chunk, response in results:
+            chunk_deleted = [r["objectId"] for r in response.get("deleteResults", []) if r["success"]]
+            deleted_oids = set(chunk_deleted)
+            chunk_failed = [oid for oid in chunk if oid not in deleted_oids]
+            if "error" in response:
+                logging.getLogger().error(response["error"])
+            for result in response.get("deleteResults", []):
+                if not result["success"]:
+                    logging.getLogger().error("Failed to delete {}: {}".format(result["objectId"],
+                                                                               result.get("error")))
+            workforcehelpers.write_journal_entry(journal_file, {"deleted": chunk_deleted, "failed": chunk_failed})
+            deleted.extend(chunk_deleted)
+            failed.extend(chunk_failed)
+            logging.getLogger().info("Deleted {} of {} assignments ({} failed)".format(len(deleted), len(oids),
+                                                                                      len(failed)))
+    finally:
+        pool.close()
+        pool.join()
+    return deleted, failed
+
+
+def plan_delete(assignment_fl_url, token, objectIDs, where, chunk_size=500, threads=4, journal_file=None):
+    """
+    Estimates the cost of deleting the assignments, using only an OBJECTID query
+    :param assignment_fl_url: (string) The assignments feature layer url
+    :param token: (string) The token to authenticate with
+    :param objectIDs: (list<string>) The OBJECTIDs to delete
+    :param where: (string) The where clause used to find the assignments to delete
+    :param chunk_size: (int) The number of assignments to delete per request
+    :param threads: (int) The maximum number of requests to submit at the same time
+    :param journal_file: (string) The journal file used to record the progress of the purge
+    :return: (list<tuple>) The plan
+    """
+    # An existing journal is only read (a new journal is not started by a dry run)
+    resuming = bool(workforcehelpers.read_journal(journal_file))
+    oids = get_oids_to_delete(assignment_fl_url, token, objectIDs, where, journal_file if resuming else None)
+    chunks = workforcehelpers.chunk_list(oids, chunk_size)
+    # The body of each deleteFeatures request is dominated by the comma separated OBJECTIDs
+    chunk_sizes = [len(",".join(str(oid) for oid in chunk)) for chunk in chunks]
+    return [
+        ("Assignments to delete", len(oids)),
+        ("Resuming from journal", resuming),
+        ("Requests", len(chunks) + (0 if resuming or objectIDs else 1)),
+        ("Batches", "{} deleteFeatures requests of up to {} assignments, {} at a time".format(len(chunks), chunk_size,
+                                                                                            threads)),
+        ("Largest request", workforcehelpers.format_size(max(chunk_sizes or [0]))),
+        ("Total payload", workforcehelpers.format_size(sum(chunk_sizes)))
+    ]
 
 
 def main(args):
@@ -57,9 +164,19 @@ def main(args):
     # Get the assignments feature layer url
     logging.getLogger().info("Getting assignment feature layer...")
     assignment_fl_url = workforcehelpers.get_assignments_feature_layer_url(args.org_url, token, args.projectId)
+    if args.plan:
+        logging.getLogger().info("Planning...")
+        workforcehelpers.log_plan(plan_delete(assignment_fl_url, token, args.objectIDs, args.where, args.chunkSize,
+                                              args.threads, args.journal))
+        return
     logging.getLogger().info("Deleting assignments...")
-    response = delete_assignments(assignment_fl_url, token, args.objectIDs, args.where)
-    logging.getLogger().info(response)
+    deleted, failed = delete_assignments(assignment_fl_url, token, args.objectIDs, args.where, args.chunkSize,
+                                         args.threads, args.journal)
+    if failed:
+        logging.getLogger().error("Failed to delete {} assignments: {}".format(len(failed), failed))
+        if args.journal:
+            logging.getLogger().error("Run the script again with the same journal to retry them")
+    logging.getLogger().info("Deleted {} assignments".format(len(deleted)))
     logging.getLogger().info("Completed")
 
 
@@ -76,6 +193,14 @@ if __name__ == "__main__":
     group.add_argument('-where', dest='where', help="The where clause to use", default=None)
     group.add_argument('-objectIDs', dest='objectIDs', help="The objectIds to delete", nargs="+", default=[])
     parser.add_argument('-logFile', dest="logFile", help="The file to log to", required=True)
+    parser.add_argument('-chunkSize', dest='chunkSize', type=int, default=500,
+                        help="The number of assignments to delete per request")
+    parser.add_argument('-threads', dest='threads', type=int, default=4,
+                        help="The maximum number of delete requests to submit at the same time")
+    parser.add_argument('-journal', dest='journal', default=None,
+                        help="The journal file used to record (and resume) the progress of the purge")
+    parser.add_argument('-plan', dest='plan', action='store_true',
+                        help="Only report what would be deleted and how many requests it would take")
 
     args = parser.parse_args()
     workforcehelpers.initialize_logging(args.logFile)
@@ -20,109 +20,315 @@
 
    limitations under the License.​
 
-    This sample queries assignments from a workforce project and exports them to a CSV file
+    This sample queries assignments (or any other layer) from a workforce project and exports them to CSV files
 """
 import argparse
 import csv
+import datetime
+import itertools
 import logging
 import logging.handlers
+import os
 import traceback
 import arrow
+import trackcache
 import workforcehelpers
 
+# The field names and order in which to write assignments to the CSV
+# (workerName and dispatcherName are resolved from the workers and dispatchers layers)
+ASSIGNMENT_FIELDS = [
+    "OBJECTID",
+    "x",
+    "y",
+    "description",
+    "status",
+    "notes",
+    "priority",
+    "assignmentType",
+    "workOrderId",
+    "dueDate",
+    "workerId",
+    "GlobalID",
+    "location",
+    "declinedComment",
+    "assignedDate",
+    "assignmentRead",
+    "inProgressDate",
+    "completedDate",
+    "declinedDate",
+    "pausedDate",
+    "dispatcherId",
+    "CreationDate",
+    "Creator",
+    "EditDate",
+    "Editor",
+    "workerName",
+    "dispatcherName"
+]
+ASSIGNMENT_DATE_FIELDS = ["dueDate", "assignedDate", "inProgressDate", "completedDate", "declinedDate", "pausedDate",
+                          "CreationDate", "EditDate"]
+# The project layers that can be exported
+LAYERS = ["assignments", "workers", "dispatchers", "tracks"]
 
-def write_assignments_to_csv(csv_file, assignments, date_format="%d/%m/%Y %H:%M:%S", timezone="UTC"):
+
+def write_features_to_csv(csv_file, features, field_names, date_fields, date_format="%d/%m/%Y %H:%M:%S",
+                          timezone="UTC", lookups=None):
     """
-    Writes the list of assignments to a CSV file
+    Writes features to a CSV file, one feature at a time, so that any iterable (such as a generator of pages) can be
+    written without holding all of the features in memory
     :param csv_file: The file to write to
-    :param assignments: The list of assignments to write
+    :param features: The list (or any iterable) of features to write
+    :param field_names: The names of the fields (columns) to write
+    :param date_fields: The names of the date fields to format
     :param date_format: The format to use for the dates
     :param timezone: The timezone to export dates to
-    :return:
+    :param lookups: (dict) Maps each output field to a tuple of (id field, dict of id to value), used to join values
+    :return: The number of features that were written
     """
-
-    # (date values are stored as unix timestamp (number of milliseconds since 1/1/1970) in AGOL)
-    # The the field names and order in which to write them to the CSV
-    field_names = [
-        "OBJECTID",
-        "x",
-        "y",
-        "description",
-        "status",
-        "notes",
-        "priority",
-        "assignmentType",
-        "workOrderId",
-        "dueDate",
-        "workerId",
-        "GlobalID",
-        "location",
-        "declinedComment",
-        "assignedDate",
-        "assignmentRead",
-        "inProgressDate",
-        "completedDate",
-        "declinedDate",
-        "pausedDate",
-        "dispatcherId",
-        "CreationDate",
-        "Creator",
-        "EditDate",
-        "Editor"
-    ]
-    for assignment in assignments:
-        # Add the geometry attributes to the 'attributes' section of the dictionary
-        assignment["attributes"]["x"] = assignment["geometry"]["x"]
-        assignment["attributes"]["y"] = assignment["geometry"]["y"]
-        # format date if there is a value
-        # Divide by 1000 because REST API returns milliseconds
-        if assignment["attributes"]["dueDate"] and assignment["attributes"]["dueDate"] != "":
-            assignment["attributes"]["dueDate"] = arrow.get(
-                int(assignment["attributes"]["dueDate"] / 1000)).to(timezone).strftime(date_format)
-        if assignment["attributes"]["assignedDate"] and assignment["attributes"]["assignedDate"] != "":
-            assignment["attributes"]["assignedDate"] = arrow.get(
-                int(assignment["attributes"]["assignedDate"] / 1000)).to(timezone).strftime(date_format)
-        if assignment["attributes"]["inProgressDate"] and assignment["attributes"]["inProgressDate"] != "":
-            assignment["attributes"]["inProgressDate"] = arrow.get(
-                int(assignment["attributes"]["inProgressDate"] / 1000)).to(timezone).strftime(date_format)
-        if assignment["attributes"]["completedDate"] and assignment["attributes"]["completedDate"] != "":
-            assignment["attributes"]["completedDate"] = arrow.get(
-                int(assignment["attributes"]["completedDate"] / 1000)).to(timezone).strftime(date_format)
-        if assignment["attributes"]["declinedDate"] and assignment["attributes"]["declinedDate"] != "":
-            assignment["attributes"]["declinedDate"] = arrow.get(
-                int(assignment["attributes"]["declinedDate"] / 1000)).to(timezone).strftime(date_format)
-        if assignment["attributes"]["pausedDate"] and assignment["attributes"]["pausedDate"] != "":
-            assignment["attributes"]["pausedDate"] = arrow.get(
-                int(assignment["attributes"]["pausedDate"] / 1000)).to(timezone).strftime(date_format)
-        if assignment["attributes"]["CreationDate"] and assignment["attributes"]["CreationDate"] != "":
-            assignment["attributes"]["CreationDate"] = arrow.get(
-                int(assignment["attributes"]["CreationDate"] / 1000)).to(timezone).strftime(date_format)
-        if assignment["attributes"]["EditDate"] and assignment["attributes"]["EditDate"] != "":
-            assignment["attributes"]["EditDate"] = arrow.get(
-                int(assignment["attributes"]["EditDate"] / 1000)).to(timezone).strftime(date_format)
-    # Make a list of the assignments (list of dictionaries) where each dictionary is the attributes of the feature
-    assignment_attributes = [a['attributes'] for a in assignments]
-    logging.getLogger().debug("Writing assignments to CSV file: {}".format(csv_file))
-    # Write to the CSV file
+    lookups = lookups or {}
+    logging.getLogger().debug("Writing features to CSV file: {}".format(csv_file))
+    row_count = 0
     with open(csv_file, 'w') as f:
         writer = csv.DictWriter(f, fieldnames=field_names, extrasaction='ignore', lineterminator='\n')
         writer.writeheader()
-        writer.writerows(assignment_attributes)
+        for feature in features:
+            attributes = feature["attributes"]
+            # Add the geometry attributes to the 'attributes' section of the dictionary
+            if feature.get("geometry"):
+                attributes["x"] = feature["geometry"]["x"]
+                attributes["y"] = feature["geometry"]["y"]
+            # Join the looked up values (ex. workerId -> workerName)
+            for output_field, (id_field, values) in lookups.items():
+                attributes[output_field] = values.get(attributes.get(id_field))
+            # format date if there is a value
+            # Divide by 1000 because REST API returns milliseconds
+            for date_field in date_fields:
+                if attributes.get(date_field) and attributes[date_field] != "":
+                    attributes[date_field] = arrow.get(
+                        int(attributes[date_field] / 1000)).to(timezone).strftime(date_format)
+            writer.writerow(attributes)
+            row_count += 1
+    return row_count
+
+
+def write_assignments_to_csv(csv_file, assignments, date_format="%d/%m/%Y %H:%M:%S", timezone="UTC", lookups=None):
+    """
+    Writes the list of assignments to a CSV file
+    :param csv_file: The file to write to
+    :param assignments: The list (or any iterable) of assignments to write
+    :param date_format: The format to use for the dates
+    :param timezone: The timezone to export dates to
+    :param lookups: (dict) The lookups used to resolve the workerName and dispatcherName (see get_name_lookups)
+    :return: The number of assignments that were written
+    """
+    # (date values are stored as unix timestamp (number of milliseconds since 1/1/1970) in AGOL)
+    return write_features_to_csv(csv_file, assignments, ASSIGNMENT_FIELDS, ASSIGNMENT_DATE_FIELDS, date_format,
+                                 timezone, lookups)
+
+
+def get_lookup(feature_layer_url, token, value_field="name"):
+    """
+    Reads a whole (small) layer once, to make an in-memory lookup of OBJECTID to value
+    :param feature_layer_url: (string) The feature layer url
+    :param token: (string) The token to authenticate with
+    :param value_field: (string) The field to look up
+    :return: (dict) The lookup of OBJECTID to value
+    """
+    lookup = {}
+    for page in workforcehelpers.query_feature_layer_pages(feature_layer_url, token,
+                                                           outFields="OBJECTID,{}".format(value_field)):
+        for feature in page:
+            lookup[feature["attributes"]["OBJECTID"]] = feature["attributes"][value_field]
+    return lookup
+
+
+def get_name_lookups(project_data, token):
+    """
+    Gets the lookups used to resolve the workerId and dispatcherId of assignments to names
+    :param project_data: (dict) The project data
+    :param token: (string) The token to authenticate with
+    :return: (dict) The lookups to use with write_features_to_csv
+    """
+    logging.getLogger().info("Reading workers and dispatchers...")
+    return {
+        "workerName": ("workerId", get_lookup(project_data["workers"]["url"], token)),
+        "dispatcherName": ("dispatcherId", get_lookup(project_data["dispatchers"]["url"], token))
+    }
+
+
+def get_partition_file(csv_file, partition_start, partition):
+    """
+    Gets the name of the file of a time partition (ex. tracks.csv -> tracks_2017-05-01.csv)
+    :param csv_file: (string) The file name to base the partition file name on
+    :param partition_start: (datetime) The start of the partition
+    :param partition: (string) The size of the partitions (hour or day)
+    :return: (string) The file name of the partition
+    """
+    name, extension = os.path.splitext(csv_file)
+    key = partition_start.strftime("%Y-%m-%d_%H" if partition == "hour" else "%Y-%m-%d")
+    return "{}_{}{}".format(name, key, extension or ".csv")
+
+
+def get_timestamp(date):
+    """
+    Gets the timestamp of a (UTC) datetime
+    :param date: (datetime) The datetime
+    :return: (int) The timestamp (milliseconds since the epoch)
+    """
+    return int((date - datetime.datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+def get_partition_start(timestamp, partition):
+    """
+    Gets the start of the partition that a date is in
+    :param timestamp: (int) The date (milliseconds since the epoch)
+    :param partition: (string) The size of the partitions (hour or day)
+    :return: (datetime) The start of the partition (UTC)
+    """
+    partition_start = datetime.datetime.utcfromtimestamp(timestamp / 1000.0).replace(minute=0, second=0, microsecond=0)
+    if partition != "hour":
+        partition_start = partition_start.replace(hour=0)
+    return partition_start
+
+
+def export_tracks(tracks_fl_url, token, csv_file, where="1=1", out_sr=None, date_format="%d/%m/%Y %H:%M:%S",
+                  timezone="UTC", partition="day", track_cache=None, project_id=None):
+    """
+    Exports the tracks layer to one CSV file per time partition. Each partition is queried and written one page at
+    a time, so only a single page of tracks is ever held in memory. Only the partitions between the first and last
+    tracks are queried, and after each partition the export skips ahead to the partition of the next track, so that
+    empty partitions (ex. weekends) are not queried. If a track cache is provided, it is synced and the tracks are read
+    from it (the cache can only be used without a where clause or output spatial reference)
+    :param tracks_fl_url: (string) The tracks feature layer url
+    :param token: (string) The token to authenticate with
+    :param csv_file: (string) The file name to base the partition file names on
+    :param where: (string) The where clause to use
+    :param out_sr: (string) The output spatial reference to use (wkid)
+    :param date_format: (string) The format to use for the dates
+    :param timezone: (string) The timezone to export dates to
+    :param partition: (string) The size of the partitions (hour or day)
+    :param track_cache: (string) The track cache database (see trackcache.py) to read the tracks from
+    :param project_id: (string) The project of the tracks in the track cache
+    :return: (dict) The number of tracks written to each file
+    """
+    layer = workforcehelpers.get_feature_layer(tracks_fl_url, token)
+    field_names = ["x", "y"] + [field["name"] for field in layer["fields"]]
+    date_fields = [field["name"] for field in layer["fields"] if field["type"] == "esriFieldTypeDate"]
+    if track_cache and (where != "1=1" or out_sr):
+        logging.getLogger().warning("The track cache can not be used with a where clause or output spatial reference")
+        track_cache = None
+    if track_cache:
+        trackcache.sync_tracks(track_cache, project_id,
+                               lambda sync_where: workforcehelpers.query_feature_layer_pages(tracks_fl_url, token,
+                                                                                             where=sync_where))
+        min_date, max_date = trackcache.query_date_range(track_cache, project_id)
+    else:
+        min_date, max_date = workforcehelpers.query_date_range(tracks_fl_url, token, "CreationDate", where)
+    files = {}
+    if min_date is None:
+        return files
+    step = datetime.timedelta(hours=1) if partition == "hour" else datetime.timedelta(days=1)
+    partition_start = get_partition_start(min_date, partition)
+    last_date = datetime.datetime.utcfromtimestamp(max_date / 1000.0)
+    while partition_start <= last_date:
+        partition_end = partition_start + step
+        partition_where = "({}) AND CreationDate >= '{}' AND CreationDate < '{}'".format(
+            where, partition_start.strftime('%Y-%m-%d %H:%M:%S'), partition_end.strftime('%Y-%m-%d %H:%M:%S'))
+        if track_cache:
+            # The partition end is exclusive
+            pages = trackcache.query_track_pages(track_cache, project_id, start=get_timestamp(partition_start),
+                                                 end=get_timestamp(partition_end) - 1)
+        else:
+            pages = workforcehelpers.query_feature_layer_pages(tracks_fl_url, token, where=partition_where,
+                                                               outSR=out_sr)
+        # Don't write empty partitions
+        first_page = next(pages, None)
+        if first_page:
+            partition_file = get_partition_file(csv_file, partition_start, partition)
+            logging.getLogger().info("Writing tracks to: {}...".format(partition_file))
+            features = itertools.chain.from_iterable(itertools.chain([first_page], pages))
+            files[partition_file] = write_features_to_csv(partition_file, features, field_names, date_fields,
+                                                          date_format, timezone)
+        partition_start = partition_end
+        if not track_cache and partition_start <= last_date:
+            # Skip ahead to the partition of the next track (a statistics query, rather than an ID query per empty
+            # partition)
+            next_date, _ = workforcehelpers.query_date_range(tracks_fl_url, token, "CreationDate",
+                                                             "({}) AND CreationDate >= '{}'".format(
+                                                                 where, partition_start.strftime('%Y-%m-%d %H:%M:%S')))
+            if next_date is None:
+                break
+            partition_start = max(partition_start, get_partition_start(next_date, partition))
+    return files
+
+
+def export_layer(org_url, token, project_id, layer_name, csv_file, where="1=1", out_sr=None,
+                 date_format="%d/%m/%Y %H:%M:%S", timezone="UTC", partition="day", track_cache=None):
+    """
+    Exports a layer of a project (assignments, workers, dispatchers or tracks) to CSV
+    :param org_url: (string) The organizational url where the project resides and that the token is valid for
+    :param token: (string) The token to authenticate with
+    :param project_id: (string) The project ID (from AGOL)
+    :param layer_name: (string) The name of the layer to export
+    :param csv_file: (string) The file to write to (tracks are written to one file per partition)
+    :param where: (string) The where clause to use
+    :param out_sr: (string) The output spatial reference to use (wkid)
+    :param date_format: (string) The format to use for the dates
+    :param timezone: (string) The timezone to export dates to
+    :param partition: (string) The size of the tracks partitions (hour or day)
+    :param track_cache: (string) The track cache database (see trackcache.py) to read the tracks from
+    :return: (dict) The number of features written to each file
+    """
+    logging.getLogger().info("Getting {} feature layer...".format(layer_name))
+    project_data = workforcehelpers.get_project_data(org_url, token, project_id)
+    feature_layer_url = project_data[layer_name]["url"]
+    if layer_name == "tracks":
+        return export_tracks(feature_layer_url, token, csv_file, where, out_sr, date_format, timezone, partition,
+                             track_cache, project_id)
+    if layer_name == "assignments":
+        lookups = get_name_lookups(project_data, token)
+        field_names = ASSIGNMENT_FIELDS
+        date_fields = ASSIGNMENT_DATE_FIELDS
+    else:
+        lookups = None
+        layer = workforcehelpers.get_feature_layer(feature_layer_url, token)
+        field_names = ["x", "y"] + [field["name"] for field in layer["fields"]]
+        date_fields = [field["name"] for field in layer["fields"] if field["type"] == "esriFieldTypeDate"]
+    # Query the feature layer one page at a time
+    logging.getLogger().info("Querying {}...".format(layer_name))
+    pages = workforcehelpers.query_feature_layer_pages(feature_layer_url, token, where=where, outSR=out_sr)
+    # Write the features to the csv file
+    logging.getLogger().info("Writing to CSV...")
+    row_count = write_features_to_csv(csv_file, itertools.chain.from_iterable(pages), field_names, date_fields,
+                                      date_format, timezone, lookups)
+    return {csv_file: row_count}
+
+
+def export_assignments(org_url, token, project_id, csv_file, where="1=1", out_sr=None,
+                       date_format="%d/%m/%Y %H:%M:%S", timezone="UTC"):
+    """
+    Queries the assignments of a project (one page at a time) and writes them to a CSV file
+    :param org_url: (string) The organizational url where the project resides and that the token is valid for
+    :param token: (string) The token to authenticate with
+    :param project_id: (string) The project ID (from AGOL)
+    :param csv_file: (string) The file to write to
+    :param where: (string) The where clause to use
+    :param out_sr: (string) The output spatial reference to use (wkid)
+    :param date_format: (string) The format to use for the dates
+    :param timezone: (string) The timezone to export dates to
+    :return: (int) The number of assignments that were written
+    """
+    return sum(export_layer(org_url, token, project_id, "assignments", csv_file, where, out_sr, date_format,
+                            timezone).values())
 
 
 def main(args):
     # First step is to authenticate and get a valid token
     logging.getLogger().info("Authenticating...")
     token = workforcehelpers.get_token(args.org_url, args.username, args.password)
-    # Get the assignment feature layer
-    logging.getLogger().info("Getting assignment feature layer...")
-    assignment_fl_url = workforcehelpers.get_assignments_feature_layer_url(args.org_url, token, args.projectId)
-    # Query the assignment feature layer to get certain assignments
-    logging.getLogger().info("Querying assignments...")
-    assignments = workforcehelpers.query_feature_layer(assignment_fl_url, token, where=args.where, outSR=args.outSR)["features"]
-    # Write the assignments to the csv file
-    logging.getLogger().info("Writing to CSV...")
-    write_assignments_to_csv(args.outCSV, assignments, args.dateFormat, args.timezone)
+    files = export_layer(args.org_url, token, args.projectId, args.layer, args.outCSV, args.where, args.outSR,
+                         args.dateFormat, args.timezone, args.partition, args.trackCache)
+    logging.getLogger().info("Exported {} features to {} files".format(sum(files.values()), len(files)))
     logging.getLogger().info("Completed")
 
 
@@ -141,6 +347,11 @@ if __name__ == "__main__":
     parser.add_argument('-outSR', dest="outSR", help="The output spatial reference to use", default=None)
     parser.add_argument('-dateFormat', dest='dateFormat', help="The date format to use", default="%d/%m/%Y %H:%M:%S")
     parser.add_argument('-timezone', dest='timezone', default="UTC", help="The timezone to export to")
+    parser.add_argument('-layer', dest='layer', choices=LAYERS, default="assignments", help="The layer to export")
+    parser.add_argument('-partition', dest='partition', choices=["hour", "day"], default="day",
+                        help="The time partition to use when exporting tracks (one CSV file per partition)")
+    parser.add_argument('-trackCache', dest='trackCache', default=None,
+                        help="The SQLite track cache to sync and export the tracks from (see trackcache.py)")
     args = parser.parse_args()
     workforcehelpers.initialize_logging(args.logFile)
     try:
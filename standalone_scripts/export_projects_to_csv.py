@@ -0,0 +1,190 @@
+# -*- coding: UTF-8 -*-
+"""
+   Copyright 2016 Esri
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+
+   you may not use this file except in compliance with the License.
+
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+
+   distributed under the License is distributed on an "AS IS" BASIS,
+
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+
+   See the License for the specific language governing permissions and
+
+   limitations under the License.​
+
+    This sample exports the assignments (and other layers) of many workforce projects (concurrently) to CSV files
+"""
+import argparse
+import json
+import logging
+import logging.handlers
+import os
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
+import workforcehelpers
+import export_assignments_to_csv
+
+
+def get_project_ids(org_url, token, query):
+    """
+    Searches the organization/portal for the workforce projects that match the query
+    :param org_url: (string) The organizational url to search
+    :param token: (string) The token to authenticate with
+    :param query: (string) The search query to use (ex. 'group:<groupId>' or 'tags:nightly')
+    :return: (list<string>) The ids of the projects that were found
+    """
+    items = workforcehelpers.search_items(org_url, token, 'type:"Workforce Project" AND ({})'.format(query))
+    return [item["id"] for item in items if item["type"] == "Workforce Project"]
+
+
+def export_project(org_url, token, project_id, out_dir, layers=("assignments",), where="1=1", out_sr=None,
+                   date_format="%d/%m/%Y %H:%M:%S", timezone="UTC", partition="day", track_cache=None):
+    """
+    Exports the layers of a single project to its own folder (partition) within the output folder
+    :param org_url: (string) The organizational url where the project resides and that the token is valid for
+    :param token: (string) The token to authenticate with
+    :param project_id: (string) The project ID (from AGOL)
+    :param out_dir: (string) The folder to write the project folders to
+    :param layers: (list<string>) The names of the layers to export (assignments, workers, dispatchers, tracks)
+    :param where: (string) The where clause to use for the assignments (the other layers are exported in full)
+    :param out_sr: (string) The output spatial reference to use (wkid)
+    :param date_format: (string) The format to use for the dates
+    :param timezone: (string) The timezone to export dates to
+    :param partition: (string) The size of the tracks partitions (hour or day)
+    :param track_cache: (string) The track cache database (see trackcache.py) to export the tracks from
+    :return: (dict) The manifest entry of the project
+    """
+    project_dir = os.path.join(out_dir, project_id)
+    if not os.path.exists(project_dir):
+        os.makedirs(project_dir)
+    entry = {
+        "projectId": project_id,
+        "layers": {},
+        "rows": 0,
+        "status": "completed",
+        "error": None
+    }
+    start_time = time.time()
+    # A failed project is recorded in the manifest rather than stopping the other exports
+    try:
+        for layer_name in layers:
+            logging.getLogger().info("Exporting {} of project: {}...".format(layer_name, project_id))
+            layer_start_time = time.time()
+            csv_file = os.path.join(project_dir, "{}.csv".format(layer_name))
+            # The where clause uses the fields of the assignments (ex. status=3), which the other layers do not have
+            layer_where = where if layer_name == "assignments" else "1=1"
+            files = export_assignments_to_csv.export_layer(org_url, token, project_id, layer_name, csv_file,
+                                                           layer_where, out_sr, date_format, timezone, partition,
+                                                           track_cache)
+            entry["layers"][layer_name] = {
+                "files": dict((os.path.relpath(f, out_dir), rows) for f, rows in files.items()),
+                "rows": sum(files.values()),
+                "seconds": round(time.time() - layer_start_time, 3)
+            }
+            entry["rows"] += entry["layers"][layer_name]["rows"]
+    except Exception as e:
+        logging.getLogger().error("Failed to export project: {}".format(project_id))
+        logging.getLogger().error(traceback.format_exc().replace("\n", " | "))
+        entry["status"] = "failed"
+        entry["error"] = str(e)
+    entry["seconds"] = round(time.time() - start_time, 3)
+    logging.getLogger().info("Exported {} features from project {} in {} seconds".format(
+        entry["rows"], project_id, entry["seconds"]))
+    return entry
+
+
+def write_manifest(manifest_file, entries, started, completed):
+    """
+    Writes the summary manifest of the export job
+    :param manifest_file: (string) The file to write to
+    :param entries: (list<dict>) The manifest entries of the projects
+    :param started: (float) The time (seconds since the epoch) that the job started
+    :param completed: (float) The time (seconds since the epoch) that the job completed
+    :return:
+    """
+    manifest = {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(started)),
+        "completed": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(completed)),
+        "seconds": round(completed - started, 3),
+        "rows": sum(entry["rows"] for entry in entries),
+        "failed": len([entry for entry in entries if entry["status"] == "failed"]),
+        "projects": entries
+    }
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def main(args):
+    started = time.time()
+    # Authenticate once, the token (and the connection) is shared by all of the exports
+    logging.getLogger().info("Authenticating...")
+    token = workforcehelpers.get_token(args.org_url, args.username, args.password, args.tokenExpiration)
+    if args.projectIds:
+        project_ids = args.projectIds
+    else:
+        logging.getLogger().info("Searching for projects...")
+        project_ids = get_project_ids(args.org_url, token, args.query)
+    logging.getLogger().info("Exporting {} projects using {} threads...".format(len(project_ids), args.threads))
+    if not os.path.exists(args.outDir):
+        os.makedirs(args.outDir)
+    # The pool size is the global limit on the number of projects being exported at the same time
+    pool = ThreadPool(args.threads)
+    try:
+        entries = pool.map(lambda project_id: export_project(args.org_url, token, project_id, args.outDir, args.layers,
+                                                             args.where, args.outSR, args.dateFormat, args.timezone,
+                                                             args.partition, args.trackCache),
+                           project_ids)
+    finally:
+        pool.close()
+        pool.join()
+    manifest_file = os.path.join(args.outDir, "manifest.json")
+    logging.getLogger().info("Writing manifest: {}...".format(manifest_file))
+    write_manifest(manifest_file, entries, started, time.time())
+    logging.getLogger().info("Completed")
+
+
+if __name__ == "__main__":
+    # Get all of the commandline arguments
+    parser = argparse.ArgumentParser("Export assignments from many Workforce Projects")
+    parser.add_argument('-u', dest='username', help="The username to authenticate with", required=True)
+    parser.add_argument('-p', dest='password', help="The password to authenticate with", required=True)
+    parser.add_argument('-url', dest='org_url', help="The url of the org/portal to use", required=True)
+    # Parameters for workforce
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-pids', dest='projectIds', nargs="+", help="The ids of the projects to export", default=[])
+    group.add_argument('-query', dest='query',
+                       help="The search query used to find the projects to export (ex. 'group:<groupId>')")
+    parser.add_argument('-where', dest='where', default="1=1",
+                        help="The where clause to use for the assignments (the other layers are exported in full)")
+    parser.add_argument('-outDir', dest="outDir", help="The folder to save the output CSV files to", required=True)
+    parser.add_argument('-logFile', dest="logFile", help="The file to log to", required=True)
+    parser.add_argument('-outSR', dest="outSR", help="The output spatial reference to use", default=None)
+    parser.add_argument('-dateFormat', dest='dateFormat', help="The date format to use", default="%d/%m/%Y %H:%M:%S")
+    parser.add_argument('-timezone', dest='timezone', default="UTC", help="The timezone to export to")
+    parser.add_argument('-layers', dest='layers', nargs="+", choices=export_assignments_to_csv.LAYERS,
+                        default=["assignments"], help="The layers to export from each project")
+    parser.add_argument('-partition', dest='partition', choices=["hour", "day"], default="day",
+                        help="The time partition to use when exporting tracks (one CSV file per partition)")
+    parser.add_argument('-trackCache', dest='trackCache', default=None,
+                        help="The SQLite track cache to sync and export the tracks from (see trackcache.py)")
+    parser.add_argument('-threads', dest='threads', type=int, default=4,
+                        help="The maximum number of projects to export at the same time")
+    parser.add_argument('-tokenExpiration', dest='tokenExpiration', type=int, default=120,
+                        help="The length (in minutes) for which the shared token is valid")
+    args = parser.parse_args()
+    workforcehelpers.initialize_logging(args.logFile)
+    try:
+        main(args)
+    except Exception as e:
+        logging.getLogger().critical("Exception detected, script exiting")
+        logging.getLogger().critical(e)
+        logging.getLogger().critical(traceback.format_exc().replace("\n", " | "))
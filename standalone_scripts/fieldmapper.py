@@ -0,0 +1,146 @@
+# -*- coding: UTF-8 -*-
+"""
+   Copyright 2017 Esri
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+
+   you may not use this file except in compliance with the License.
+
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+
+   distributed under the License is distributed on an "AS IS" BASIS,
+
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+
+   See the License for the specific language governing permissions and
+
+   limitations under the License.​
+
+    Compiles field mappings (ex. fieldMappings.json) into a function that maps whole pages of attributes, rather than
+    looping over the mappings for every feature. The same file is used by the standalone, ArcREST and ArcGIS API for
+    Python scripts.
+
+    A mapping is either the name of the target field:
+
+        "notes": "Original_notes"
+
+    or an object with the target field and a type to coerce the value to (string, integer, double, boolean or guid):
+
+        "priority": {"field": "Original_priority", "type": "string"}
+
+    or an object with the target field and a value computed from the source attributes (the key is only a label):
+
+        "label": {"field": "Archive_label", "format": "{workOrderId} ({status})"}
+        "archived": {"field": "Archive_source", "value": "Workforce"}
+"""
+import operator
+import uuid
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+
+def to_boolean(value):
+    """
+    Coerces a value to a boolean, treating strings such as "false", "no" and "0" as False
+    :param value: The value
+    :return: (bool) The boolean
+    """
+    if isinstance(value, (str, text_type)):
+        return value.strip().lower() not in ("", "0", "false", "no", "n", "f")
+    return bool(value)
+
+
+def to_guid(value):
+    """
+    Coerces a value to a GlobalID string, in the format returned by feature services ({UPPERCASE})
+    :param value: The value
+    :return: (string) The GlobalID
+    """
+    return "{{{}}}".format(str(uuid.UUID(text_type(value))).upper())
+
+
+COERCIONS = {
+    "string": text_type,
+    "integer": int,
+    "double": float,
+    "boolean": to_boolean,
+    "guid": to_guid
+}
+
+
+def get_target_fields(field_mappings):
+    """
+    Gets the name of the target field of each mapping
+    :param field_mappings: (dict) The field mappings (as read from the JSON file)
+    :return: (dict) The names of the target fields by the key of their mappings
+    """
+    return dict((key, value if not isinstance(value, dict) else value["field"])
+                for key, value in field_mappings.items())
+
+
+def get_computed_value(mapping):
+    """
+    Makes the function that computes the value of a computed field
+    :param mapping: (dict) The mapping (with a format or value)
+    :return: (function) Computes the value from the source attributes
+    """
+    if "format" in mapping:
+        template = mapping["format"]
+        return lambda attributes: template.format(**attributes)
+    value = mapping["value"]
+    return lambda attributes: value
+
+
+def compile_field_mappings(field_mappings):
+    """
+    Compiles the field mappings into a function that maps a page of source attributes to target attributes. The plain
+    mappings are read with a single itemgetter, and only the coerced and computed fields are handled one by one
+    :param field_mappings: (dict) The field mappings (as read from the JSON file)
+    :return: (function) Maps a list of source attributes (dicts) to a list of target attributes (dicts)
+    """
+    sources = []
+    targets = []
+    coerced = []
+    computed = []
+    for key, value in sorted(field_mappings.items()):
+        if not isinstance(value, dict):
+            sources.append(key)
+            targets.append(value)
+        elif "format" in value or "value" in value:
+            computed.append((value["field"], get_computed_value(value)))
+        elif value.get("type"):
+            if value["type"] not in COERCIONS:
+                raise ValueError("Unknown type '{}' for field '{}'".format(value["type"], key))
+            coerced.append((key, value["field"], COERCIONS[value["type"]]))
+        else:
+            sources.append(key)
+            targets.append(value["field"])
+    targets = tuple(targets)
+    if len(sources) == 1:
+        # itemgetter returns a single value rather than a tuple for one field
+        source = sources[0]
+        get_values = lambda attributes: (attributes[source],)
+    elif sources:
+        get_values = operator.itemgetter(*sources)
+    else:
+        get_values = lambda attributes: ()
+
+    def map_page(page):
+        mapped_page = []
+        for attributes in page:
+            mapped = dict(zip(targets, get_values(attributes)))
+            for source_field, target_field, coerce in coerced:
+                value = attributes[source_field]
+                mapped[target_field] = None if value is None else coerce(value)
+            for target_field, compute in computed:
+                mapped[target_field] = compute(attributes)
+            mapped_page.append(mapped)
+        return mapped_page
+    return map_page
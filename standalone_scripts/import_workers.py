@@ -32,6 +32,7 @@ import logging.handlers
 import mimetypes
 import os
 import traceback
+import userdirectory
 import workforcehelpers
 
 
@@ -70,22 +71,29 @@ def get_workers_from_csv(csvFile, name_field="name", status_field="status", user
     return new_workers
 
 
-def user_exists(org_url, token, username):
+def search_users(org_url, token, query):
     """
-    Searchs the organization/portal to see if a user exists
+    Searches the organization/portal for users, a page of 100 users at a time
     :param org_url: (string) The organization to search
     :param token: (string) The token to use for authentication
-    :param username: (string) The username to search for
-    :return: True if user exists, False if not
+    :param query: (string) The query (ex. from userdirectory.get_user_query)
+    :return: List<string> The usernames of the users that were found
     """
     url = "{}/sharing/rest/community/users".format(org_url)
-    params = {
-        "token": token,
-        "f": "json",
-        "q": username
-    }
-    search_results = workforcehelpers.get(url, params=params)
-    return username in [x["username"] for x in search_results["results"]]
+    usernames = []
+    start = 1
+    while start > 0:
+        params = {
+            "token": token,
+            "f": "json",
+            "q": query,
+            "num": 100,
+            "start": start
+        }
+        search_results = workforcehelpers.get(url, params=params)
+        usernames.extend(x["username"] for x in search_results["results"])
+        start = search_results.get("nextStart", -1)
+    return usernames
 
 
 def filter_workers(org_url, token, project_id, workers):
@@ -102,11 +110,15 @@ def filter_workers(org_url, token, project_id, workers):
     worker_fl_url = workforcehelpers.get_workers_feature_layer_url(org_url, token, project_id)
     worker_dict = workforcehelpers.query_feature_layer(worker_fl_url, token)
 
+    # Look up all of the users at once (in batches), rather than searching for each worker
+    users = userdirectory.find_users(lambda query: search_users(org_url, token, query), org_url,
+                                     [worker["attributes"]["userId"] for worker in workers])
+    workers_in_fs = set(feature["attributes"]["userId"] for feature in worker_dict["features"])
     workers_to_add = []
     for worker in workers:
-        if not user_exists(org_url, token, worker["attributes"]["userId"]):
+        if worker["attributes"]["userId"] not in users:
             logger.warning("User '{}' does not exist in your org and will not be added".format(worker["attributes"]["userId"]))
-        elif worker["attributes"]["userId"] in [feature["attributes"]["userId"] for feature in worker_dict["features"]]:
+        elif worker["attributes"]["userId"] in workers_in_fs:
             logger.warning("User '{}' is already part of this project and will not be added".format(worker["attributes"]["userId"]))
         else:
             workers_to_add.append(worker)
@@ -0,0 +1,250 @@
+# -*- coding: UTF-8 -*-
+"""
+   Copyright 2017 Esri
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+
+   you may not use this file except in compliance with the License.
+
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+
+   distributed under the License is distributed on an "AS IS" BASIS,
+
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+
+   See the License for the specific language governing permissions and
+
+   limitations under the License.​
+
+    A local cache of the tracks of projects (a SQLite database), so that the tracks are only downloaded once and can be
+    shared by scripts (ex. check_completion_location.py and export_assignments_to_csv.py) and ad-hoc analyses.
+
+    The tracks are stored by project and day, and are synced incrementally by CreationDate. Their locations are indexed
+    with an R*-tree (when SQLite includes it), so they can be queried by editor, time range and bounding box
+"""
+import json
+import logging
+import sqlite3
+import trackhelpers
+
+# The length of a day (in milliseconds), the tracks are stored by day
+DAY = 86400000
+# How long (in seconds) to wait for another sync (ex. of another project) to finish writing to the cache
+TIMEOUT = 300
+
+
+def initialize_cache(db):
+    """
+    Initializes the cache database and creates the tables if necessary
+    :param db: (string) The database to use
+    :return:
+    """
+    conn = sqlite3.connect(db, timeout=TIMEOUT)
+    c = conn.cursor()
+    c.execute("CREATE TABLE IF NOT EXISTS `Tracks` ( "
+              "`id` INTEGER PRIMARY KEY, "
+              "`project` TEXT, "
+              "`OBJECTID` INTEGER, "
+              "`Editor` TEXT, "
+              "`CreationDate` INTEGER, "
+              "`day` INTEGER, "
+              "`x` REAL, "
+              "`y` REAL, "
+              "`Accuracy` REAL, "
+              "`attributes` TEXT, "
+              "UNIQUE(`project`, `OBJECTID`) )")
+    c.execute("CREATE INDEX IF NOT EXISTS `TracksByEditor` ON `Tracks` (`project`, `Editor`, `CreationDate`)")
+    c.execute("CREATE INDEX IF NOT EXISTS `TracksByDay` ON `Tracks` (`project`, `day`)")
+    c.execute("CREATE TABLE IF NOT EXISTS `Syncs` ( "
+              "`project` TEXT, "
+              "`CreationDate` INTEGER, "
+              "`syncDate` INTEGER, "
+              "PRIMARY KEY(`project`) )")
+    try:
+        c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS `TrackLocations` USING rtree(`id`, `min_x`, `max_x`, `min_y`, "
+                  "`max_y`)")
+    except sqlite3.OperationalError:
+        logging.getLogger().warning("SQLite does not include the R*-tree module, bounding boxes will not be indexed")
+    conn.commit()
+    conn.close()
+
+
+def has_rtree(c):
+    """
+    Checks if the locations of the tracks are indexed with an R*-tree
+    :param c: (Cursor) The cursor to use
+    :return: (bool) True if the R*-tree exists
+    """
+    c.execute("SELECT name FROM sqlite_master WHERE name = 'TrackLocations'")
+    return c.fetchone() is not None
+
+
+def get_last_sync(db, project_id):
+    """
+    Gets the latest CreationDate of the tracks of a project that are in the cache
+    :param db: (string) The database to use
+    :param project_id: (string) The project
+    :return: (int) The latest CreationDate (milliseconds since the epoch), None if the project has not been synced
+    """
+    conn = sqlite3.connect(db, timeout=TIMEOUT)
+    c = conn.cursor()
+    c.execute("SELECT CreationDate FROM Syncs WHERE project = ?", (project_id,))
+    row = c.fetchone()
+    conn.close()
+    return row[0] if row else None
+
+
+def sync_tracks(db, project_id, query_pages, settle_time=DAY):
+    """
+    Adds the tracks that were created since the last sync to the cache. Tracks can be uploaded some time after they are
+    created (ex. when the worker was offline), so the tracks created during the settle time before the last sync are
+    queried again (the tracks that are already cached are skipped)
+    :param db: (string) The database to use
+    :param project_id: (string) The project
+    :param query_pages: (function) Queries the tracks layer with a where clause, returning pages of features (dicts)
+    :param settle_time: (int) How long (in milliseconds) to wait for tracks to be uploaded
+    :return: (int) The number of tracks that were added
+    """
+    initialize_cache(db)
+    last_sync = get_last_sync(db, project_id)
+    where = "1=1"
+    if last_sync is not None:
+        where = "CreationDate >= '{}'".format(trackhelpers.format_query_date(last_sync - settle_time))
+    logging.getLogger().info("Syncing tracks ({})...".format(where))
+    conn = sqlite3.connect(db, timeout=TIMEOUT)
+    c = conn.cursor()
+    rtree = has_rtree(c)
+    added = 0
+    for page in query_pages(where):
+        c.execute("SELECT max(id) FROM Tracks")
+        last_id = c.fetchone()[0] or 0
+        c.executemany("INSERT OR IGNORE INTO Tracks (project, OBJECTID, Editor, CreationDate, day, x, y, Accuracy, "
+                      "attributes) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                      [(project_id, track["attributes"]["OBJECTID"], track["attributes"]["Editor"],
+                        track["attributes"]["CreationDate"], track["attributes"]["CreationDate"] // DAY,
+                        track["geometry"]["x"], track["geometry"]["y"], track["attributes"]["Accuracy"],
+                        json.dumps(track["attributes"])) for track in page if track.get("geometry")])
+        # The new tracks are the ones after the largest id before the page was added
+        if rtree:
+            c.execute("INSERT INTO TrackLocations SELECT id, x, x, y, y FROM Tracks WHERE id > ?", (last_id,))
+        c.execute("SELECT count(*) FROM Tracks WHERE id > ?", (last_id,))
+        added += c.fetchone()[0]
+        # Commit each page, so that an interrupted sync keeps the tracks it added
+        conn.commit()
+    c.execute("SELECT max(CreationDate) FROM Tracks WHERE project = ?", (project_id,))
+    last_date = c.fetchone()[0]
+    if last_date is not None:
+        c.execute("INSERT OR REPLACE INTO Syncs VALUES (?, ?, strftime('%s', 'now') * 1000)", (project_id, last_date))
+    conn.commit()
+    conn.close()
+    logging.getLogger().info("Added {} tracks to the cache".format(added))
+    return added
+
+
+def get_query(c, columns, project_id, editor=None, start=None, end=None, bbox=None, max_accuracy=None):
+    """
+    Makes the SQL statement that selects the cached tracks
+    :param c: (Cursor) The cursor to use
+    :param columns: (string) The columns to select (from the Tracks table, aliased as t)
+    :param project_id: (string) The project
+    :param editor: (string) The user that created the tracks (the worker)
+    :param start: (int) The earliest CreationDate (milliseconds since the epoch)
+    :param end: (int) The latest CreationDate (milliseconds since the epoch)
+    :param bbox: (tuple) The xmin, ymin, xmax and ymax of the tracks
+    :param max_accuracy: (int or float) The largest Accuracy of the tracks
+    :return: (tuple) The statement and its parameters
+    """
+    sql = "SELECT {} FROM Tracks t".format(columns)
+    conditions = ["t.project = ?"]
+    params = [project_id]
+    if bbox is not None:
+        if has_rtree(c):
+            # The R*Tree stores its bounds as 32 bit floats (rounded outwards), so it is only used to find the tracks
+            # that overlap the bbox, and the tracks are then filtered by their exact coordinates
+            sql += " JOIN TrackLocations r ON r.id = t.id"
+            conditions.append("r.max_x >= ? AND r.min_x <= ? AND r.max_y >= ? AND r.min_y <= ?")
+            params.extend([bbox[0], bbox[2], bbox[1], bbox[3]])
+        conditions.append("t.x >= ? AND t.x <= ? AND t.y >= ? AND t.y <= ?")
+        params.extend([bbox[0], bbox[2], bbox[1], bbox[3]])
+    if editor is not None:
+        conditions.append("t.Editor = ?")
+        params.append(editor)
+    if start is not None:
+        conditions.append("t.CreationDate >= ?")
+        params.append(start)
+    if end is not None:
+        conditions.append("t.CreationDate <= ?")
+        params.append(end)
+    if max_accuracy is not None:
+        conditions.append("t.Accuracy <= ?")
+        params.append(float(max_accuracy))
+    return "{} WHERE {} ORDER BY t.CreationDate".format(sql, " AND ".join(conditions)), params
+
+
+def query_tracks(db, project_id, editor=None, start=None, end=None, bbox=None, max_accuracy=None):
+    """
+    Queries the cached tracks
+    :param db: (string) The database to use
+    :param project_id: (string) The project
+    :param editor: (string) The user that created the tracks (the worker)
+    :param start: (int) The earliest CreationDate (milliseconds since the epoch)
+    :param end: (int) The latest CreationDate (milliseconds since the epoch)
+    :param bbox: (tuple) The xmin, ymin, xmax and ymax of the tracks
+    :param max_accuracy: (int or float) The largest Accuracy of the tracks
+    :return: (list<tuple>) The tracks (CreationDate, x, y, Accuracy), sorted by CreationDate
+    """
+    conn = sqlite3.connect(db, timeout=TIMEOUT)
+    c = conn.cursor()
+    sql, params = get_query(c, "t.CreationDate, t.x, t.y, t.Accuracy", project_id, editor, start, end, bbox,
+                            max_accuracy)
+    c.execute(sql, params)
+    tracks = c.fetchall()
+    conn.close()
+    return tracks
+
+
+def query_track_pages(db, project_id, editor=None, start=None, end=None, bbox=None, max_accuracy=None,
+                      page_size=1000):
+    """
+    Queries the cached tracks as features (with all of their attributes), one page at a time
+    :param db: (string) The database to use
+    :param project_id: (string) The project
+    :param editor: (string) The user that created the tracks (the worker)
+    :param start: (int) The earliest CreationDate (milliseconds since the epoch)
+    :param end: (int) The latest CreationDate (milliseconds since the epoch)
+    :param bbox: (tuple) The xmin, ymin, xmax and ymax of the tracks
+    :param max_accuracy: (int or float) The largest Accuracy of the tracks
+    :param page_size: (int) The number of tracks in each page
+    :return: (generator<list<dict>>) The pages of features
+    """
+    conn = sqlite3.connect(db, timeout=TIMEOUT)
+    c = conn.cursor()
+    sql, params = get_query(c, "t.x, t.y, t.attributes", project_id, editor, start, end, bbox, max_accuracy)
+    c.execute(sql, params)
+    try:
+        while True:
+            rows = c.fetchmany(page_size)
+            if not rows:
+                break
+            yield [{"attributes": json.loads(attributes), "geometry": {"x": x, "y": y}} for x, y, attributes in rows]
+    finally:
+        conn.close()
+
+
+def query_date_range(db, project_id):
+    """
+    Gets the earliest and latest CreationDate of the cached tracks of a project
+    :param db: (string) The database to use
+    :param project_id: (string) The project
+    :return: (tuple) The earliest and latest CreationDate (milliseconds since the epoch), None if there are none
+    """
+    conn = sqlite3.connect(db, timeout=TIMEOUT)
+    c = conn.cursor()
+    c.execute("SELECT min(CreationDate), max(CreationDate) FROM Tracks WHERE project = ?", (project_id,))
+    row = c.fetchone()
+    conn.close()
+    return row[0], row[1]
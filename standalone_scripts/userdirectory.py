@@ -0,0 +1,75 @@
+# -*- coding: UTF-8 -*-
+"""
+   Copyright 2017 Esri
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+
+   you may not use this file except in compliance with the License.
+
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+
+   distributed under the License is distributed on an "AS IS" BASIS,
+
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+
+   See the License for the specific language governing permissions and
+
+   limitations under the License.​
+
+    A directory of the users of an organization/portal, used to check that the workers and dispatchers being added
+    have named users. Rather than searching the organization for each user, the usernames are looked up in batches
+    (one search of "username:a OR username:b ..." per batch), and the result of each username is kept for a while
+    (the TTL), so that checking the same users again is a lookup in memory. The same file is used by the standalone
+    and ArcGIS API for Python scripts, each of which provides the function that runs a search
+"""
+import logging
+import time
+
+# The number of usernames looked up per search
+BATCH_SIZE = 50
+# The number of seconds that the result of a username is kept for
+TTL = 3600
+
+# The result (exists and when it was looked up) of each username, by organization
+DIRECTORY = {}
+
+
+def get_user_query(usernames):
+    """
+    Makes the search query that finds any of the usernames. The terms are grouped, so that a filter added to the query
+    (ex. the accountid that UserManager.search appends) applies to all of them
+    :param usernames: (list<string>) The usernames
+    :return: (string) The query
+    """
+    return "(" + " OR ".join('username:"{}"'.format(username.replace('"', '')) for username in usernames) + ")"
+
+
+def find_users(search, org, usernames, batch_size=BATCH_SIZE, ttl=TTL):
+    """
+    Checks which users exist in an organization/portal, searching only for the usernames that were not looked up in
+    the last ttl seconds
+    :param search: (function) Searches the organization with a query, returning the usernames of all of the results
+    :param org: (string) The organization (ex. its url), the results are kept per organization
+    :param usernames: (iterable<string>) The usernames to check
+    :param batch_size: (int) The maximum number of usernames per search
+    :param ttl: (int) The number of seconds that the result of a username is kept for
+    :return: (set<string>) The usernames that exist
+    """
+    usernames = list(usernames)
+    directory = DIRECTORY.setdefault(org, {})
+    now = time.time()
+    missing = sorted(set(username for username in usernames
+                         if username and (username not in directory or now - directory[username][1] > ttl)))
+    for i in range(0, len(missing), batch_size):
+        batch = missing[i:i + batch_size]
+        found = set(search(get_user_query(batch)))
+        for username in batch:
+            directory[username] = (username in found, now)
+    if missing:
+        logging.getLogger().debug("Looked up {} users in {} searches".format(
+            len(missing), (len(missing) + batch_size - 1) // batch_size))
+    return set(username for username in usernames if username in directory and directory[username][0])
@@ -23,10 +23,17 @@
    This contains helper functions for workforce and the REST API
 """
 
+import datetime
+import json
 import logging
+import os
 import sys
+import uuid
 import requests
 
+# A single session is shared by every request so that connections (and their TLS handshakes) are reused
+session = requests.Session()
+
 
 def post(url, data=None, files=None):
     """
@@ -37,7 +44,7 @@ def post(url, data=None, files=None):
     :return:
     """
     logging.getLogger().debug("Posting to: {}".format(url))
-    response = requests.post(url, data, files=files).json()
+    response = session.post(url, data, files=files).json()
     logging.getLogger().debug(response)
     return response
 
@@ -51,7 +58,7 @@ def get(url, params=None):
     """
     params['f'] = 'json'
     logging.getLogger().debug("Getting: {}".format(url))
-    response = requests.get(url, params).json()
+    response = session.get(url, params=params).json()
     logging.getLogger().debug(response)
     return response
 
@@ -100,7 +107,7 @@ def query_feature_layer(feature_layer_url, token, where=None, oids=None, outSR=N
     if where:
         params["where"] = where
     elif oids:
-        params["objectIds"] = ",".format(oids)
+        params["objectIds"] = ",".join(str(oid) for oid in oids)
     else:
         params["where"] = "1=1"
     if outSR:
@@ -109,6 +116,309 @@ def query_feature_layer(feature_layer_url, token, where=None, oids=None, outSR=N
     return response
 
 
+def check_response(response):
+    """
+    Raises the error of a response (ex. an expired token or an invalid where clause), so that it is not mistaken for
+    an empty result
+    :param response: (dict) The response
+    :return: (dict) The response, if it is not an error
+    """
+    if "error" in response:
+        error = response["error"]
+        message = error.get("message") if isinstance(error, dict) else error
+        details = error.get("details") if isinstance(error, dict) else None
+        raise ValueError("The request failed: {}{}".format(message,
+                                                           " ({})".format(" ".join(details)) if details else ""))
+    return response
+
+
+def query_object_ids(feature_layer_url, token, where="1=1"):
+    """
+    Gets the OBJECTIDs of the features that match the where clause (this is not limited by maxRecordCount)
+    :param feature_layer_url: (string) The feature layer url
+    :param token: (string) The token to authenticate with
+    :param where: (string) The where clause to use
+    :return: (list<int>) The sorted OBJECTIDs
+    """
+    query_url = "{}/query".format(feature_layer_url.rstrip("/"))
+    data = {
+        'token': token,
+        'f': 'json',
+        'where': where,
+        'returnIdsOnly': 'true'
+    }
+    response = check_response(post(query_url, data))
+    return sorted(response.get("objectIds") or [])
+
+
+def query_feature_layer_pages(feature_layer_url, token, where="1=1", outSR=None, outFields="*", page_size=1000):
+    """
+    Queries the specified feature layer url one page at a time, so that layers larger than maxRecordCount can be read
+    without holding all of the features in memory
+    :param feature_layer_url: (string) The feature layer url
+    :param token: (string) The token to authenticate with
+    :param where: (string) The where clause to use
+    :param outSR: (string) The output spatial reference to use (wkid)
+    :param outFields: (CSV string) The fields to return
+    :param page_size: (int) The number of features to request at a time (should not exceed maxRecordCount)
+    :return: (generator<list<dict>>) The pages of features
+    """
+    query_url = "{}/query".format(feature_layer_url.rstrip("/"))
+    oids = query_object_ids(feature_layer_url, token, where)
+    for i in range(0, len(oids), page_size):
+        # The OBJECTIDs are POSTed so that long lists do not exceed the url length limit
+        data = {
+            'token': token,
+            'f': 'json',
+            'objectIds': ",".join(str(oid) for oid in oids[i:i + page_size]),
+            'outFields': outFields
+        }
+        if outSR:
+            data["outSR"] = outSR
+        yield check_response(post(query_url, data))["features"]
+
+
+def query_count(feature_layer_url, token, where="1=1"):
+    """
+    Gets the number of features that match the where clause (returnCountOnly)
+    :param feature_layer_url: (string) The feature layer url
+    :param token: (string) The token to authenticate with
+    :param where: (string) The where clause to use
+    :return: (int) The number of features
+    """
+    query_url = "{}/query".format(feature_layer_url.rstrip("/"))
+    data = {
+        'token': token,
+        'f': 'json',
+        'where': where,
+        'returnCountOnly': 'true'
+    }
+    return check_response(post(query_url, data))["count"]
+
+
+def estimate_feature_size(feature_layer_url, token, oids, outFields="*", sample_size=10):
+    """
+    Estimates the size of the json of a feature by querying a small sample of the features
+    :param feature_layer_url: (string) The feature layer url
+    :param token: (string) The token to authenticate with
+    :param oids: (list<int>) The OBJECTIDs of the features to sample from
+    :param outFields: (CSV string) The fields to include
+    :param sample_size: (int) The number of features to sample
+    :return: (int) The average size (in bytes) of a feature, 0 if there are no features
+    """
+    if not oids:
+        return 0
+    # Sample OBJECTIDs from across the whole list
+    step = max(1, len(oids) // sample_size)
+    data = {
+        'token': token,
+        'f': 'json',
+        'objectIds': ",".join(str(oid) for oid in oids[::step][:sample_size]),
+        'outFields': outFields
+    }
+    sample = post("{}/query".format(feature_layer_url.rstrip("/")), data)["features"]
+    if not sample:
+        return 0
+    return sum(len(json.dumps(feature)) for feature in sample) // len(sample)
+
+
+def format_size(size):
+    """
+    Formats a number of bytes so that it is easy to read
+    :param size: (int) The number of bytes
+    :return: (string) The formatted size (ex. 1.5 MB)
+    """
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024 or unit == "GB":
+            return "{:.1f} {}".format(size, unit) if unit != "B" else "{} B".format(size)
+        size /= 1024.0
+
+
+def query_date_range(feature_layer_url, token, date_field, where="1=1"):
+    """
+    Gets the smallest and largest values of a date field using an outStatistics query
+    :param feature_layer_url: (string) The feature layer url
+    :param token: (string) The token to authenticate with
+    :param date_field: (string) The name of the date field
+    :param where: (string) The where clause to use
+    :return: (tuple) The min and max dates (milliseconds since the epoch), (None, None) if there are no features
+    """
+    query_url = "{}/query".format(feature_layer_url.rstrip("/"))
+    data = {
+        'token': token,
+        'f': 'json',
+        'where': where,
+        'outStatistics': json.dumps([
+            {"statisticType": "min", "onStatisticField": date_field, "outStatisticFieldName": "minDate"},
+            {"statisticType": "max", "onStatisticField": date_field, "outStatisticFieldName": "maxDate"}
+        ])
+    }
+    features = check_response(post(query_url, data))["features"]
+    if not features:
+        return None, None
+    return features[0]["attributes"]["minDate"], features[0]["attributes"]["maxDate"]
+
+
+def format_query_date(timestamp):
+    """
+    Formats a date so that it can be used in a where clause
+    :param timestamp: (int) The date in milliseconds since the epoch (UTC)
+    :return: (string) The date as 'YYYY-MM-DD HH:MM:SS'
+    """
+    return datetime.datetime.utcfromtimestamp(timestamp / 1000.0).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def add_features(feature_layer_url, token, features):
+    """
+    Adds features. The results are reported per feature (rollbackOnFailure is disabled)
+    :param feature_layer_url: (string) The feature layer url
+    :param token: (string) The token to authenticate with
+    :param features: (list<dict>) The features to add
+    :return: (dict) The json response of the addFeatures REST API Call
+    """
+    add_url = "{}/addFeatures".format(feature_layer_url.rstrip("/"))
+    data = {
+        'token': token,
+        'f': 'json',
+        'features': json.dumps(features),
+        'rollbackOnFailure': 'false'
+    }
+    return post(add_url, data)
+
+
+def apply_edits(feature_layer_url, token, adds=None, updates=None, use_global_ids=False):
+    """
+    Adds and updates features in a single request. The results are reported per feature (rollbackOnFailure is
+    disabled)
+    :param feature_layer_url: (string) The feature layer url
+    :param token: (string) The token to authenticate with
+    :param adds: (list<dict>) The features to add
+    :param updates: (list<dict>) The features to update
+    :param use_global_ids: (bool) Identify the features by their GlobalIDs rather than their OBJECTIDs (the features
+    that are added must then have GlobalIDs)
+    :return: (dict) The json response of the applyEdits REST API Call
+    """
+    apply_edits_url = "{}/applyEdits".format(feature_layer_url.rstrip("/"))
+    data = {
+        'token': token,
+        'f': 'json',
+        'adds': json.dumps(adds or []),
+        'updates': json.dumps(updates or []),
+        'useGlobalIds': 'true' if use_global_ids else 'false',
+        'rollbackOnFailure': 'false'
+    }
+    return post(apply_edits_url, data)
+
+
+def delete_features(feature_layer_url, token, oids):
+    """
+    Deletes features by OBJECTID. The results are reported per feature (rollbackOnFailure is disabled)
+    :param feature_layer_url: (string) The feature layer url
+    :param token: (string) The token to authenticate with
+    :param oids: (list<int>) The OBJECTIDs of the features to delete
+    :return: (dict) The json response of the deleteFeatures REST API Call
+    """
+    delete_url = "{}/deleteFeatures".format(feature_layer_url.rstrip("/"))
+    data = {
+        'token': token,
+        'f': 'json',
+        'objectIds': ",".join(str(oid) for oid in oids),
+        'rollbackOnFailure': 'false'
+    }
+    return post(delete_url, data)
+
+
+def chunk_list(items, chunk_size):
+    """
+    Splits a list into smaller lists
+    :param items: (list) The list to split
+    :param chunk_size: (int) The maximum size of each smaller list
+    :return: (list<list>) The smaller lists
+    """
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+
+def get_global_id_key(global_id):
+    """
+    Converts a GlobalID to a compact key for lookups (the 16 bytes of the UUID, rather than its 38 character string).
+    Braces and case are ignored, so "{0A1B...}" and "0a1b..." have the same key
+    :param global_id: (string) The GlobalID
+    :return: (bytes) The key, or the GlobalID itself if it is not a UUID
+    """
+    try:
+        return uuid.UUID(global_id).bytes
+    except (AttributeError, TypeError, ValueError):
+        return global_id
+
+
+def index_global_ids(pages, global_id_field):
+    """
+    Builds a set of the GlobalID keys of the features as the pages are read, so that only the keys (and not every
+    feature) are held in memory
+    :param pages: (iterable<list<dict>>) The pages of features (as dictionaries)
+    :param global_id_field: (string) The field that stores the GlobalID
+    :return: (set<bytes>) The GlobalID keys
+    """
+    keys = set()
+    for page in pages:
+        keys.update(get_global_id_key(feature["attributes"][global_id_field]) for feature in page)
+    return keys
+
+
+def read_journal(journal_file):
+    """
+    Reads the entries of a journal (a file with one json entry per line)
+    :param journal_file: (string) The journal file to read
+    :return: (list<dict>) The entries, an empty list if the file does not exist
+    """
+    if not journal_file or not os.path.exists(journal_file):
+        return []
+    entries = []
+    with open(journal_file, 'r') as f:
+        for line in f:
+            # A partially written last line (the process was killed) is ignored
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                logging.getLogger().warning("Ignoring invalid journal entry: {}".format(line.strip()))
+    return entries
+
+
+def write_journal_entry(journal_file, entry):
+    """
+    Appends an entry to a journal (a file with one json entry per line)
+    :param journal_file: (string) The journal file to write to
+    :param entry: (dict) The entry to append
+    :return:
+    """
+    if not journal_file:
+        return
+    # If the last entry was only partially written (the process was killed), it is ended first, so that the new entry
+    # is not joined to it
+    terminated = True
+    if os.path.exists(journal_file) and os.path.getsize(journal_file):
+        with open(journal_file, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            terminated = f.read(1) == b"\n"
+    with open(journal_file, 'a') as f:
+        if not terminated:
+            f.write("\n")
+        f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def log_plan(plan):
+    """
+    Logs the plan of a dry run (-plan)
+    :param plan: (list<tuple>) The (label, value) pairs to log
+    :return:
+    """
+    logging.getLogger().info("Plan (nothing has been changed):")
+    for label, value in plan:
+        logging.getLogger().info("    {}: {}".format(label, value))
+
+
 def get_feature_layer(feature_layer_url, token):
     """
     This gets the feature layer metadata
@@ -123,6 +433,23 @@ def get_feature_layer(feature_layer_url, token):
     return get(feature_layer_url, params)
 
 
+def get_project_data(org_url, token, project_id):
+    """
+    Gets the project data (the json that holds the layer urls, groupId, etc.) from the project ID
+    :param org_url: (string) The organizational url where the project resides and that the token is valid for
+    :param token:  (string) The authenticated token to use
+    :param project_id: (string) The project ID (from AGOL)
+    :return: (dict) The project data
+    """
+    project_path = "{}/sharing/rest/content/items/{}/data".format(org_url, project_id)
+    params = {
+        "token": token,
+        "f": "json",
+        "referer": org_url
+    }
+    return get(project_path, params)
+
+
 def get_assignments_feature_layer_url(org_url, token, projectId):
     """
     Gets the assignments url from the project ID
@@ -236,4 +563,31 @@ def get_group_id(org_url, token, project_id):
         "referer": org_url
     }
     res = get(project_path, params)
-    return res["groupId"]
\ No newline at end of file
+    return res["groupId"]
+
+
+def search_items(org_url, token, query, page_size=100):
+    """
+    Searches the organization/portal for items, following the paging of the search results
+    :param org_url: (string) The organizational url to search
+    :param token: (string) The authenticated token to use
+    :param query: (string) The search query (ex. 'type:"Workforce Project" AND tags:nightly')
+    :param page_size: (int) The number of results to request at a time (max 100)
+    :return: (list<dict>) The items that were found
+    """
+    url = "{}/sharing/rest/search".format(org_url.rstrip("/"))
+    items = []
+    start = 1
+    # nextStart is -1 when there are no more results
+    while start != -1:
+        params = {
+            "token": token,
+            "f": "json",
+            "q": query,
+            "start": start,
+            "num": page_size
+        }
+        response = get(url, params)
+        items.extend(response["results"])
+        start = response["nextStart"]
+    return items